@@ -0,0 +1,60 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Buffered, sampled access log for the tile server.
+#
+# Requests only append a record to a bounded ring; a background task
+# drains the ring and writes JSON lines from an executor thread, so
+# formatting and I/O stay off the request path.  A full ring overwrites
+# its oldest records rather than blocking or growing.  Each line carries
+# "ts" (seconds since the epoch) and "uri", the fields
+# utilities/visualize_tiles_map.py reads from tiles.log.json.
+#
+
+import json
+import random
+import sys
+from collections import deque, namedtuple
+
+AccessRecord = namedtuple('accessrecord', 'ts method uri status duration size remote_ip')
+
+
+class AccessLog(object):
+    def __init__(self, path, capacity, sample_rate=1.0, rng=random.random):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.rng = rng
+        self.dropped = 0
+        self._records = deque(maxlen=capacity)
+
+    def __len__(self):
+        return len(self._records)
+
+    def sampled(self):
+        return self.sample_rate >= 1.0 or self.rng() < self.sample_rate
+
+    def add(self, record):
+        if len(self._records) == self._records.maxlen:
+            self.dropped += 1
+        self._records.append(record)
+
+    def drain(self):
+        """Return the buffered records and the count overwritten since the
+        last drain, emptying the ring."""
+        records = list(self._records)
+        self._records.clear()
+        dropped = self.dropped
+        self.dropped = 0
+        return records, dropped
+
+    def write(self, records):
+        if not records:
+            return
+        lines = ''.join([json.dumps(record._asdict()) + '\n' for record in records])
+        if self.path == '-':
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+            return
+        # reopened on every write so the file can be rotated underneath
+        with open(self.path, 'a', encoding='utf8') as f:
+            f.write(lines)
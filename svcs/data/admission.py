@@ -0,0 +1,73 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Admission control for tile generation.
+#
+# At most `limit` generations run at once.  Up to `queue_size` more wait
+# in FIFO order for at most `wait` seconds each; anything beyond that, or
+# still waiting at its deadline, is refused with Overloaded straight away
+# instead of queueing for a database connection the client may have given
+# up on by the time it is granted.
+#
+
+import asyncio
+from collections import deque
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionGate(object):
+    def __init__(self, limit, queue_size, wait):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait = wait
+        self.active = 0
+        self._waiters = deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue_size:
+            raise Overloaded('admission queue is full')
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        timer = loop.call_later(self.wait, self._expire, waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # cancelled after release() handed this waiter the slot
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            timer.cancel()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            waiter.set_exception(Overloaded('waited {0}s for admission'.format(self.wait)))
+
+    def release(self):
+        # the slot passes straight to the oldest live waiter
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
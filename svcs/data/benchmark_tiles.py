@@ -0,0 +1,204 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Measure tile generation latency against a PostGIS database provisioned
+# by ingest.py.  Tiles are read as "x,y,z" lines, the output format of
+# enumerate_tiles.py, for example:
+#
+#   python enumerate_tiles.py 16 district-of-columbia.poly | \
+#       python benchmark_tiles.py --dsn "host=localhost dbname=osm user=postgres password=secret"
+#
+# Every method generates each tile --repeat times with --concurrency
+# requests in flight, after an unmeasured warm-up pass, and the report
+# compares each method's latency with the first one.  To compare the
+# database drivers side by side on the DC extract:
+#
+#   python benchmark_tiles.py dc-tiles.txt --methods prepared asyncpg
+#
+# and to measure per-tile latency before and after road intersections and
+# building entrances were precomputed into osm_intersections and
+# osm_entrance_lists:
+#
+#   python benchmark_tiles.py dc-tiles.txt --methods recomputed prepared
+#
+# and, once ingest.py --render-tiles has run, to compare lookups of the
+# rendered tiles with generating them:
+#
+#   python benchmark_tiles.py dc-tiles.txt --methods prepared materialized
+#
+
+import argparse
+import asyncio
+import sys
+import time
+
+from psycopg2.extras import NamedTupleCursor
+
+import gentiles
+
+legacy_query = """
+    SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+# soundscape_tile as it was before osm_intersections and osm_entrance_lists,
+# dumping the vertices of every road and building in the tile to find the
+# intersections and entrances on each request
+recomputed_tile_query = """
+   SELECT 'Feature' as type, osm_ids, feature_type, feature_value, ST_AsGeoJson(geometry, 6)::jsonb as geometry, hstore_to_jsonb(properties) as properties
+             FROM (
+               WITH roads as (
+                 SELECT osm_id as osm_id, feature_type, feature_value, geometry, properties from osm_roads where geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326) and service != 'parking_aisle' order by osm_id
+               ), places as (
+                 SELECT osm_id, feature_type, feature_value, geometry, properties from osm_places where geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326) and not (properties ? 'boundary' and properties ? 'historic')
+               ), entrances as (
+                 SELECT osm_id, feature_value, properties, geometry from osm_entrances where geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326)
+               )
+               SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties from places
+               UNION
+               SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties from roads
+               UNION
+               SELECT DISTINCT array_agg(osm_id) as osm_ids, 'highway' as feature_type, 'gd_intersection' as feature_value, point AS geometry, hstore('') as properties
+                 FROM ( SELECT osm_id, (ST_DumpPoints(geometry)).geom as point
+                        FROM roads
+                 ) as ps
+                 WHERE ST_Within(point, TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326))
+               GROUP BY point HAVING COUNT(osm_id) > 1
+               UNION
+               SELECT building.osm_id || array_agg(e.osm_id) as osm_ids, 'gd_entrance_list' as feature_type, 'yes' as feature_value, ST_Collect(e.geometry) as geometry, hstore('') as properties
+                 FROM (
+                   SELECT properties, osm_id, (ST_DumpPoints(geometry)).geom as building_point from places where feature_type='building'
+                 ) as building, entrances e
+               WHERE building.building_point = e.geometry group by building.osm_id
+               UNION
+               SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geom as geometry, properties
+                 FROM non_osm_data WHERE geom && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326)
+            ) as elements
+            ORDER BY osm_ids
+"""
+
+def read_tiles(lines):
+    tiles = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        x, y, z = line.split(',')
+        tiles.append((int(z), int(x), int(y)))
+    return tiles
+
+# The tile server before the statement timeout moved to connection setup:
+# two round trips per tile and an unprepared query
+class RoundTripTileEngine(gentiles.AiopgTileEngine):
+    async def prepare(self, conn):
+        pass
+
+    async def generate_on_conn(self, conn, zoom, x, y):
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            await cursor.execute(gentiles.timeout_set)
+            await cursor.execute(legacy_query, {'zoom': zoom, 'tile_x': x, 'tile_y': y})
+            value = await cursor.fetchall()
+            return gentiles.serialize_tile(list(map(lambda x: x._asdict(), value))).encode('utf8')
+
+class RecomputedTileEngine(gentiles.AiopgTileEngine):
+    async def prepare(self, conn):
+        async with conn.cursor() as cursor:
+            await cursor.execute(gentiles.timeout_set)
+
+    async def generate_on_conn(self, conn, zoom, x, y):
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            await cursor.execute(recomputed_tile_query, {'zoom': zoom, 'tile_x': x, 'tile_y': y})
+            value = await cursor.fetchall()
+            return gentiles.serialize_tile(list(map(lambda x: x._asdict(), value))).encode('utf8')
+
+# name -> engine factory taking (dsn, pool size)
+methods = {
+    'round-trips': lambda dsn, size: RoundTripTileEngine(dsn, maxsize=size),
+    'recomputed': lambda dsn, size: RecomputedTileEngine(dsn, maxsize=size),
+    'prepared': lambda dsn, size: gentiles.AiopgTileEngine(dsn, maxsize=size),
+    'prepared-db-json': lambda dsn, size: gentiles.AiopgTileEngine(dsn, db_json=True, maxsize=size),
+    'asyncpg': lambda dsn, size: gentiles.AsyncpgTileEngine(dsn, maxsize=size),
+    'asyncpg-db-json': lambda dsn, size: gentiles.AsyncpgTileEngine(dsn, db_json=True, maxsize=size),
+    'materialized': lambda dsn, size: gentiles.AiopgTileEngine(dsn, maxsize=size, materialized=True),
+}
+
+async def measure(generate, tiles, repeat, concurrency):
+    pending = [tile for _ in range(repeat) for tile in tiles]
+    pending.reverse()
+    latencies = []
+
+    async def worker():
+        while pending:
+            tile = pending.pop()
+            start = time.perf_counter()
+            await generate(*tile)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - start
+
+async def benchmark_method(name, dsn, tiles, repeat, concurrency):
+    engine = methods[name](dsn, concurrency)
+    await engine.start()
+    try:
+        await measure(engine.generate, tiles, 1, concurrency)
+        return await measure(engine.generate, tiles, repeat, concurrency)
+    finally:
+        await engine.close()
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p90': percentile(latencies, 0.90),
+        'p99': percentile(latencies, 0.99),
+        'mean': sum(latencies) / len(latencies),
+        'throughput': len(latencies) / elapsed,
+    }
+
+def report(results):
+    lines = ['{0:<20} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10}'.format(
+        'method', 'requests', 'p50 ms', 'p90 ms', 'p99 ms', 'mean ms', 'tiles/s')]
+    for name, stats in results:
+        lines.append('{0:<20} {1:>9} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>10.1f}'.format(
+            name, stats['requests'], stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000,
+            stats['mean'] * 1000, stats['throughput']))
+    (baseline_name, baseline) = results[0]
+    for name, stats in results[1:]:
+        lines.append('{0} vs {1}: p50 {2:+.1f}%, p99 {3:+.1f}%, throughput {4:+.1f}%'.format(
+            name, baseline_name,
+            (stats['p50'] / baseline['p50'] - 1) * 100,
+            (stats['p99'] / baseline['p99'] - 1) * 100,
+            (stats['throughput'] / baseline['throughput'] - 1) * 100))
+    return '\n'.join(lines)
+
+async def run_benchmark(args, tiles):
+    results = []
+    for name in args.methods:
+        if name.startswith('asyncpg') and gentiles.asyncpg is None:
+            raise SystemExit('method {0} requires the asyncpg package'.format(name))
+        latencies, elapsed = await benchmark_method(name, args.dsn, tiles, args.repeat, args.concurrency)
+        results.append((name, summarize(latencies, elapsed)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='tile generation benchmark for Soundscape')
+    parser.add_argument('tiles', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='file of x,y,z tile lines')
+    parser.add_argument('--dsn', type=str, help='specify dsn', default='dbname=osm')
+    parser.add_argument('--methods', nargs='+', choices=list(methods), default=['round-trips', 'prepared'])
+    parser.add_argument('--repeat', type=int, default=3, help='times each tile is generated')
+    parser.add_argument('--concurrency', type=int, default=4, help='tile requests in flight')
+    args = parser.parse_args()
+
+    tiles = read_tiles(args.tiles)
+    if not tiles:
+        parser.error('no tiles to benchmark')
+    print(report(asyncio.run(run_benchmark(args, tiles))))
+
+if __name__ == '__main__':
+    main()
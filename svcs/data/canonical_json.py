@@ -0,0 +1,95 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Canonical serialization of tiles.
+#
+# A tile is published as json.dumps(tile, sort_keys=True), so the same
+# features always produce the same bytes and tiles can be diffed across
+# imports.  The serializers here all produce exactly those bytes; 'fast'
+# gets there quicker by writing the FeatureCollection and Feature framing
+# itself, which has a fixed key order, and by handing coordinate arrays to
+# orjson when it is installed.  Anything it does not recognise goes through
+# the stdlib encoder unchanged.
+#
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json.dumps() builds a new encoder per call when sort_keys is set
+_encode = json.JSONEncoder(sort_keys=True).encode
+
+FEATURE_KEYS = frozenset(['type', 'osm_ids', 'feature_type', 'feature_value', 'geometry', 'properties'])
+GEOMETRY_KEYS = frozenset(['type', 'coordinates'])
+
+# bytes orjson may emit for a coordinate array that the stdlib encoder
+# would write the same way, once ', ' separators are restored; exponents,
+# NaN and anything else fall back to the stdlib
+COORDINATE_BYTES = b'0123456789.-[],'
+# orjson writes values below 1e-4 without an exponent, float.__repr__ does not
+SMALL_FLOAT_PREFIX = b'0.0000'
+
+
+def serialize_tile_json(features):
+    obj = {
+        'type': 'FeatureCollection',
+        'features': features
+    }
+    return json.dumps(obj, sort_keys=True)
+
+
+def encode_coordinates(coordinates):
+    if orjson is None:
+        return _encode(coordinates)
+    try:
+        encoded = orjson.dumps(coordinates)
+    except TypeError:
+        return _encode(coordinates)
+    if encoded.translate(None, COORDINATE_BYTES) or SMALL_FLOAT_PREFIX in encoded:
+        return _encode(coordinates)
+    return encoded.replace(b',', b', ').decode('ascii')
+
+
+def encode_geometry(geometry):
+    if type(geometry) is not dict or geometry.keys() != GEOMETRY_KEYS:
+        return _encode(geometry)
+    return '{"coordinates": ' + encode_coordinates(geometry['coordinates']) + \
+        ', "type": ' + _encode(geometry['type']) + '}'
+
+
+def encode_feature(feature):
+    if type(feature) is not dict or feature.keys() != FEATURE_KEYS:
+        return _encode(feature)
+    return '{"feature_type": ' + _encode(feature['feature_type']) + \
+        ', "feature_value": ' + _encode(feature['feature_value']) + \
+        ', "geometry": ' + encode_geometry(feature['geometry']) + \
+        ', "osm_ids": ' + _encode(feature['osm_ids']) + \
+        ', "properties": ' + _encode(feature['properties']) + \
+        ', "type": ' + _encode(feature['type']) + '}'
+
+
+# A tile written piece by piece is TILE_HEAD, the features separated by
+# FEATURE_SEPARATOR, then TILE_TAIL
+TILE_HEAD = '{"features": ['
+FEATURE_SEPARATOR = ', '
+TILE_TAIL = '], "type": "FeatureCollection"}'
+
+
+def serialize_features(features):
+    """Features as they appear between TILE_HEAD and TILE_TAIL."""
+    return FEATURE_SEPARATOR.join(map(encode_feature, features))
+
+
+def serialize_tile_fast(features):
+    return TILE_HEAD + serialize_features(features) + TILE_TAIL
+
+
+# name -> function turning a list of feature dicts into the tile text
+serializers = {
+    'json': serialize_tile_json,
+    'fast': serialize_tile_fast,
+}
+serializer_default = 'fast'
@@ -0,0 +1,100 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Reader for the expired tile lists written by `imposm run`.
+#
+# Imposm writes one file per applied diff under
+# <expiretiles_dir>/YYYYMMDD/HHMMSS.mmm.tiles, each line naming a z/x/y
+# tile touched by the diff.  File names sort chronologically, which lets a
+# watcher remember the newest file it has processed instead of every file.
+#
+
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+EXPIRE_FILE_GLOB = '*.tiles'
+
+
+def parse_expire_line(line):
+    parts = line.strip().split('/')
+    if len(parts) != 3:
+        return None
+    try:
+        return tuple(int(part) for part in parts)
+    except ValueError:
+        return None
+
+
+def tiles_at_zoom(tile, zoom):
+    """Map an expired tile onto the tiles it covers at the given zoom."""
+    (z, x, y) = tile
+    if z >= zoom:
+        shift = z - zoom
+        return [(zoom, x >> shift, y >> shift)]
+    scale = 1 << (zoom - z)
+    return [(zoom, x * scale + dx, y * scale + dy) for dx in range(scale) for dy in range(scale)]
+
+
+def read_expire_file(path, zoom):
+    tiles = set()
+    with open(path, encoding='utf8') as expire_file:
+        for line in expire_file:
+            if not line.strip():
+                continue
+            tile = parse_expire_line(line)
+            if tile is None:
+                logger.warning('Ignoring malformed expired tile %r in %s', line.strip(), path)
+                continue
+            tiles.update(tiles_at_zoom(tile, zoom))
+    return tiles
+
+
+class ExpireTileWatcher(object):
+    def __init__(self, directory, zoom):
+        self.directory = Path(directory)
+        self.zoom = zoom
+        self.last = None
+        self.files_processed = 0
+
+    def pending_files(self):
+        if not self.directory.is_dir():
+            return []
+        last_day = self.last.split('/')[0] if self.last else None
+        names = []
+        for day in sorted(entry.name for entry in self.directory.iterdir() if entry.is_dir()):
+            if last_day is not None and day < last_day:
+                continue
+            for path in (self.directory / day).glob(EXPIRE_FILE_GLOB):
+                name = '{0}/{1}'.format(day, path.name)
+                if self.last is None or name > self.last:
+                    names.append(name)
+        return sorted(names)
+
+    def skip_existing(self):
+        names = self.pending_files()
+        if names:
+            self.last = names[-1]
+
+    def replay(self):
+        """Return {tile: mtime of the newest expire file naming it} for every
+        file not yet processed, marking them processed."""
+        expired = {}
+        for name in self.pending_files():
+            path = self.directory / name
+            mtime = path.stat().st_mtime
+            for tile in read_expire_file(path, self.zoom):
+                expired[tile] = max(mtime, expired.get(tile, mtime))
+            self.last = name
+            self.files_processed += 1
+        return expired
+
+    def poll(self):
+        """Return the tiles named by expire files written since the last poll."""
+        tiles = set()
+        for name in self.pending_files():
+            tiles.update(read_expire_file(self.directory / name, self.zoom))
+            self.last = name
+            self.files_processed += 1
+        return tiles
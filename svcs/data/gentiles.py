@@ -10,33 +10,101 @@
 #
 
 import os
+import sys
 import math
 import time
+import signal
+import shutil
+import socket
+import tempfile
+import asyncio
+import contextlib
+import gzip
+import bz2
+import hashlib
 from datetime import datetime
 
 import json
-from collections import namedtuple
+import itertools
+from collections import deque, namedtuple
 import argparse
 import logging
 
 import aiopg
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 from psycopg2.extras import NamedTupleCursor
 
 from aiohttp import web
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from tile_cache import TileCache
+from access_log import AccessLog, AccessRecord
+from admission import AdmissionGate, Overloaded
+from tile_store import TileStore
+from warmup import WarmUp, read_hot_tiles
+from expire_tiles import ExpireTileWatcher
+from tile_cover import TooManyTiles, corridor_tiles
+import canonical_json
+
 class StatCounter(object):
-    def __init__(self, name, help):
+    # counts made before --workers forks are inherited by every worker, so
+    # those combine with max instead of adding up
+    def __init__(self, name, help, combine=sum):
         self.name = name
         self.help = help
         self.value = 0
+        self.combine_values = combine
+
+    def inc(self, amount=1):
+        self.value += amount
 
-    def inc(self):
-        self.value += 1
+    def snapshot(self):
+        return self.value
 
-    def report(self):
+    def combine(self, snapshots):
+        return self.combine_values(snapshots)
+
+    def report(self, value=None):
+        if value is None:
+            value = self.value
         f = '# HELP {name} {help}\n# TYPE {name} counter\n{name} {value}\n'
-        s = f.format(name=self.name, help = self.help, value = self.value)
+        s = f.format(name=self.name, help = self.help, value = value)
+        return s
+
+class StatGauge(object):
+    # most gauges here count things held per process, so workers add up;
+    # those describing state every worker shares combine with max instead
+    def __init__(self, name, help, combine=sum):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.combine_values = combine
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+    def combine(self, snapshots):
+        return self.combine_values(snapshots)
+
+    def report(self, value=None):
+        if value is None:
+            value = self.value
+        f = '# HELP {name} {help}\n# TYPE {name} gauge\n{name} {value}\n'
+        s = f.format(name=self.name, help = self.help, value = value)
         return s
 
 class StatHistogram(object):
@@ -59,24 +127,89 @@ class StatHistogram(object):
                 index -= 1
             self.buckets[index] += 1
 
-    def report(self):
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'sum': self.sum, 'count': self.count}
+
+    def combine(self, snapshots):
+        return {
+            'buckets': [sum(counts) for counts in zip(*[s['buckets'] for s in snapshots])],
+            'sum': sum([s['sum'] for s in snapshots]),
+            'count': sum([s['count'] for s in snapshots]),
+        }
+
+    def report(self, value=None):
+        if value is None:
+            value = self.snapshot()
         header = '# HELP {0} {1}\n# TYPE {0} histogram\n'.format(self.name, self.help)
         bucket_f = '{0}_bucket{{le="{1}"}} {2}\n'
-        buckets = ''.join([bucket_f.format(self.name, (i+1)*self.interval, self.buckets[i]) for i in range(0, self.bucket_count)])
-        total = bucket_f.format(self.name, '+Inf', self.count)
-        sum = '{0}_sum {1}\n'.format(self.name, self.sum)
-        count = '{0}_count {1}\n'.format(self.name, self.count)
+        buckets = ''.join([bucket_f.format(self.name, (i+1)*self.interval, value['buckets'][i]) for i in range(0, self.bucket_count)])
+        total = bucket_f.format(self.name, '+Inf', value['count'])
+        sum = '{0}_sum {1}\n'.format(self.name, value['sum'])
+        count = '{0}_count {1}\n'.format(self.name, value['count'])
         return ''.join([header, buckets, total, sum, count])
 
 tilesrv_metrics_scraped = StatCounter('tilesrv_metrics_scraped', 'count of times scraped')
 tilesrv_aliveprobe = StatCounter('tilesrv_aliveprobe_count', 'count of times probe for aliveness')
-tilesrv_start = StatCounter('tilesrv_start_count', 'count of times tile server started')
+tilesrv_start = StatCounter('tilesrv_start_count', 'count of times tile server started', max)
 tile_served = StatCounter('tile_served_count', 'count of tiles served')
 tile_exception = StatCounter('tile_exception_count', 'count of tiles requests that ended in exception')
 tile_queryfail = StatCounter('tile_queryfail_count', 'count of tiles requests that experienced query failure')
+tile_served_gzip = StatCounter('tile_served_gzip_count', 'count of tiles served gzip encoded')
+tile_served_brotli = StatCounter('tile_served_br_count', 'count of tiles served brotli encoded')
+tile_not_modified = StatCounter('tile_not_modified_count', 'count of tile requests answered 304 from If-None-Match')
+tile_cache_hit = StatCounter('tile_cache_hit_count', 'count of tile requests served from the tile cache')
+tile_cache_miss = StatCounter('tile_cache_miss_count', 'count of tile requests that missed the tile cache')
+tile_cache_eviction = StatCounter('tile_cache_eviction_count', 'count of tiles evicted to keep the tile cache within its byte budget')
+tile_cache_expired = StatCounter('tile_cache_expired_count', 'count of cached tiles dropped because imposm expired them')
+tile_expire_files = StatCounter('tile_expire_files_count', 'count of imposm expire tile files processed')
+tile_coalesced = StatCounter('tile_coalesced_count', 'count of tile requests that joined an identical in-flight tile generation')
+tile_store_hit = StatCounter('tile_store_hit_count', 'count of tile cache misses served from the shared tile store')
+tile_store_miss = StatCounter('tile_store_miss_count', 'count of tile cache misses not found in the shared tile store')
+tile_store_error = StatCounter('tile_store_error_count', 'count of failed reads and writes of the shared tile store')
+tile_static_hit = StatCounter('tile_static_hit_count', 'count of tile cache misses served from the static tile tree')
+tile_static_miss = StatCounter('tile_static_miss_count', 'count of tile cache misses missing from the static tile tree')
+tile_static_stale = StatCounter('tile_static_stale_count', 'count of static tiles passed over as stale')
+tile_replica_ejected = StatCounter('tile_replica_ejected_count', 'count of times a database was taken out of tile query routing')
+tile_shed = StatCounter('tile_shed_count', 'count of tile generations refused by admission control')
+tile_access_log_records = StatCounter('tile_access_log_record_count', 'count of access log records written')
+tile_access_log_dropped = StatCounter('tile_access_log_dropped_count', 'count of access log records overwritten before they were written')
+tile_batch_requests = StatCounter('tile_batch_request_count', 'count of batch tile requests')
+tile_prefetch_requests = StatCounter('tile_prefetch_request_count', 'count of radius and route prefetch requests')
+tile_materialized_hit = StatCounter('tile_materialized_hit_count', 'count of tiles read from the soundscape_tiles table ingest.py rendered')
+tile_materialized_miss = StatCounter('tile_materialized_miss_count', 'count of tiles generated because soundscape_tiles did not hold them')
+tile_streamed = StatCounter('tile_streamed_count', 'count of tiles streamed from a server-side cursor')
+tile_composed = StatCounter('tile_composed_count', 'count of lower zoom and filtered tiles composed from default zoom tiles')
+tile_batch_tiles = StatCounter('tile_batch_tile_count', 'count of tiles served by batch and prefetch requests')
+tile_cache_bytes = StatGauge('tile_cache_bytes', 'bytes of tile data held in the tile cache')
+tile_cache_entries = StatGauge('tile_cache_entries', 'count of tiles held in the tile cache')
+tile_inflight = StatGauge('tile_inflight', 'count of tile generations in flight')
+tile_generation = StatGauge('tile_data_generation', 'data generation tiles are cached and stored under, 0 while it is unsettled', max)
+tile_inflight_waiters = StatGauge('tile_inflight_waiters', 'count of requests waiting on another request\'s tile generation')
+
+tile_warmup_tiles = StatGauge('tile_warmup_tiles', 'count of tiles to warm the cache with from --warm-from')
+tile_warmup_done = StatGauge('tile_warmup_done', 'count of warm-up tiles fetched so far, failures included')
+tile_warmup_failed = StatGauge('tile_warmup_failed', 'count of warm-up tiles that could not be fetched')
+tile_warmup_ready = StatGauge('tile_warmup_ready', '1 once warm-up has done --warm-ready of its tiles in every worker', min)
+tile_admission_active = StatGauge('tile_admission_active', 'count of tile generations admitted and running')
+tile_admission_queue = StatGauge('tile_admission_queue', 'count of tile generations queued for admission')
+tile_pool_max = StatGauge('tile_pool_max', 'maximum database connections in the pool')
+tile_pool_size = StatGauge('tile_pool_size', 'database connections open in the pool')
+tile_pool_in_use = StatGauge('tile_pool_in_use', 'database connections in use generating tiles')
+tile_replicas_healthy = StatGauge('tile_replicas_healthy', 'count of databases, primary included, tile queries are routed to with --replica', max)
+tile_pool_waiters = StatGauge('tile_pool_waiters', 'count of tile generations waiting for a database connection')
 
 tile_querytime = StatHistogram('tile_querytime_seconds', 'histogram of tile query performance', 0.20, 20)
 tile_size = StatHistogram('tile_size', 'histogram of tile size', 1024 * 8, 32)
+# Stages of a tile request; execute and fetch are separate only for aiopg,
+# asyncpg decodes rows while fetching them
+tile_stage_admission_wait = StatHistogram('tile_stage_admission_wait_seconds', 'histogram of time tile generations waited for admission', 0.01, 50)
+tile_stage_pool_wait = StatHistogram('tile_stage_pool_wait_seconds', 'histogram of time waiting for a pooled database connection', 0.01, 50)
+tile_stage_execute = StatHistogram('tile_stage_execute_seconds', 'histogram of tile query execution time', 0.01, 50)
+tile_stage_fetch = StatHistogram('tile_stage_fetch_seconds', 'histogram of time fetching tile query rows', 0.01, 50)
+tile_stage_decode = StatHistogram('tile_stage_decode_seconds', 'histogram of time turning tile query rows into features', 0.002, 50)
+tile_stage_serialize = StatHistogram('tile_stage_serialize_seconds', 'histogram of tile serialization time', 0.002, 50)
+tile_stage_compress = StatHistogram('tile_stage_compress_seconds', 'histogram of tile compression time', 0.002, 50)
+tile_stage_write = StatHistogram('tile_stage_write_seconds', 'histogram of time writing tile responses', 0.002, 50)
 
 # Metrics
 #  - scrapes - counter
@@ -96,94 +229,1408 @@ metrics = [
     tile_served,
     tile_exception,
     tile_queryfail,
+    tile_served_gzip,
+    tile_served_brotli,
+    tile_not_modified,
+    tile_cache_hit,
+    tile_cache_miss,
+    tile_cache_eviction,
+    tile_cache_expired,
+    tile_expire_files,
+    tile_coalesced,
+    tile_store_hit,
+    tile_store_miss,
+    tile_store_error,
+    tile_static_hit,
+    tile_static_miss,
+    tile_static_stale,
+    tile_shed,
+    tile_replica_ejected,
+    tile_access_log_records,
+    tile_access_log_dropped,
+    tile_batch_requests,
+    tile_prefetch_requests,
+    tile_batch_tiles,
+    tile_composed,
+    tile_streamed,
+    tile_materialized_hit,
+    tile_materialized_miss,
+    tile_cache_bytes,
+    tile_cache_entries,
+    tile_inflight,
+    tile_inflight_waiters,
+    tile_generation,
+    tile_warmup_tiles,
+    tile_warmup_done,
+    tile_warmup_failed,
+    tile_warmup_ready,
+    tile_admission_active,
+    tile_admission_queue,
+    tile_pool_max,
+    tile_pool_size,
+    tile_pool_in_use,
+    tile_pool_waiters,
+    tile_replicas_healthy,
     tile_querytime,
-    tile_size
+    tile_size,
+    tile_stage_admission_wait,
+    tile_stage_pool_wait,
+    tile_stage_execute,
+    tile_stage_fetch,
+    tile_stage_decode,
+    tile_stage_serialize,
+    tile_stage_compress,
+    tile_stage_write
 ]
 
 TileGen = namedtuple('tilegen', 'count generator')
 TileResult = namedtuple('tileresult', 'cost zoom x y data')
 TileCloudStat = namedtuple('tilecloud', 'generated uploaded cost upload_cost')
+# body is the canonical tile, gzip and brotli hold its precompressed forms
+# or None when compression would not make the tile smaller, and etag is the
+# content hash of body
+TileEntry = namedtuple('tileentry', 'body gzip brotli etag')
+# index of this worker among count forked by --workers, which publish
+# their metrics to metrics_dir for each other's /metrics
+WorkerInfo = namedtuple('workerinfo', 'index count metrics_dir')
 
 zoom_default = 16
+# lowest zoom served, by composing default zoom tiles: 16 of them at 14
+composed_min_zoom = 14
 connection_pooling = True
+pool_size_default = 10
+engines = ['aiopg', 'asyncpg']
+cache_size_default = 128  # MiB
+cache_ttl_default = 60 * 60  # seconds
+expire_poll_default = 60  # seconds
+gzip_level = 6
+brotli_quality = 6
+# tiles at least this large are compressed off the event loop
+compress_offload_size = 64 * 1024
+# rows fetched from the server-side cursor at a time with --stream, and the
+# largest streamed tile still kept in the cache and store
+stream_chunk_rows = 256
+stream_keep_bytes = 1024 * 1024
+batch_max_tiles = 256
+batch_concurrency_default = 4
+prefetch_radius_default = 100  # metres
+prefetch_max_radius = 2000  # metres
+prefetch_max_route_points = 256
+metrics_publish_interval = 1  # seconds
+access_log_interval = 1  # seconds
+access_log_capacity = 10000
+admission_queue_default = 32
+admission_wait_default = 1.0  # seconds
+admission_retry_after = 1  # seconds
+generation_poll_default = 60  # seconds
+warm_tiles_default = 1000
+warm_concurrency_default = 2
+replica_check_default = 5  # seconds
+replica_failure_limit = 3
+# latitude limit of the web mercator tile grid
+max_tile_lat = 85.0511287798
+
+# Tile queries are prepared once per connection by prepare_connection,
+# which also sets the statement timeout, so a tile costs one round trip
+tile_prepare = """
+    PREPARE soundscape_tile_rows (int, int, int) AS
+        SELECT * from soundscape_tile($1, $2, $3)
+"""
 
 tile_query = """
-    SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+    EXECUTE soundscape_tile_rows(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+# soundscape_tile_json renders the canonical FeatureCollection inside
+# PostGIS; converting it to bytea hands it over without a text decode
+tile_json_prepare = """
+    PREPARE soundscape_tile_json_bytes (int, int, int) AS
+        SELECT convert_to(soundscape_tile_json($1, $2, $3), 'UTF8')
 """
 
-timeout_set = "set statement_timeout=2000"
+tile_json_query = """
+    EXECUTE soundscape_tile_json_bytes(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+# --materialized looks a tile up in the soundscape_tiles table ingest.py
+# --render-tiles fills before generating it, with its etag and compressed
+# forms
+materialized_prepare = """
+    PREPARE soundscape_materialized_tile_entry (int, int, int) AS
+        SELECT body, gzip, brotli, etag FROM soundscape_tile_materialized($1, $2, $3)
+"""
+
+materialized_query = """
+    EXECUTE soundscape_materialized_tile_entry(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+statement_timeout_ms = 2000
+timeout_set = "set statement_timeout={0}".format(statement_timeout_ms)
+
+# asyncpg prepares and caches these per connection by itself
+asyncpg_tile_query = "SELECT * from soundscape_tile($1, $2, $3)"
+asyncpg_tile_json_query = "SELECT convert_to(soundscape_tile_json($1, $2, $3), 'UTF8')"
+asyncpg_materialized_query = "SELECT body, gzip, brotli, etag FROM soundscape_tile_materialized($1, $2, $3)"
+
+async def prepare_connection(conn, db_json=False, materialized=False):
+    statements = [timeout_set, tile_prepare]
+    if db_json:
+        statements.append(tile_json_prepare)
+    if materialized:
+        statements.append(materialized_prepare)
+    async with conn.cursor() as cursor:
+        await cursor.execute(';'.join(statements))
 
 def tile_name(zoom, x, y,):
     return '{0}/{1}/{2}.json'.format(zoom, x, y)
 
+# canonical json.dumps(tile, sort_keys=True) text, see canonical_json.py
+tile_serializer = canonical_json.serializers[canonical_json.serializer_default]
+
+def serialize_tile(features):
+    return tile_serializer(features)
+
 async def gentile_async(cursor, zoom, x, y, gather_metrics=False):
     try:
         if gather_metrics:
             query_start = time.perf_counter()
-        await cursor.execute(timeout_set)
         await cursor.execute(tile_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+        if gather_metrics:
+            executed = time.perf_counter()
+            tile_stage_execute.sample(executed - query_start)
         value = await cursor.fetchall()
         if gather_metrics:
             query_end = time.perf_counter()
+            tile_stage_fetch.sample(query_end - executed)
             tile_querytime.sample(query_end - query_start)
-        obj = {}
-        obj['type'] = 'FeatureCollection'
-        obj = {
-            'type': 'FeatureCollection',
-            'features': list(map(lambda x: x._asdict(), value))
-        }
-        tile = json.dumps(obj, sort_keys=True)
+        features = list(map(lambda x: x._asdict(), value))
         if gather_metrics:
+            decoded = time.perf_counter()
+            tile_stage_decode.sample(decoded - query_end)
+        tile = serialize_tile(features)
+        if gather_metrics:
+            tile_stage_serialize.sample(time.perf_counter() - decoded)
             tile_size.sample(len(tile))
         return tile
     except psycopg2.Error as e:
         print(e)
         raise
 
-async def tile_handler_on_conn(conn, request):
-    start = datetime.utcnow()
-    async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
-        zoom = request.match_info['zoom']
-        if int(zoom) != zoom_default:
-            raise web.HTTPNotFound()
-        x = int(request.match_info['x'])
-        y = int(request.match_info['y'])
-        tile_data = await gentile_async(cursor, zoom, x, y, True)
-        if tile_data == None:
-            logger.info('ERROR GET {0}/{1}/{2}.json'.format(zoom, x, y))
-            always_log('TILE_ERROR')
-            tile_queryfail.inc()
-            raise web.HTTPServiceUnavailable()
-        else:
-            tile_served.inc()
-            end = datetime.utcnow()
-            telemetry_log('request', start, end)
-            return web.Response(text=tile_data, content_type='application/json')
+# Returns the tile as bytes exactly as produced by PostGIS
+async def gentile_json_async(cursor, zoom, x, y, gather_metrics=False):
+    try:
+        if gather_metrics:
+            query_start = time.perf_counter()
+        await cursor.execute(tile_json_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+        if gather_metrics:
+            executed = time.perf_counter()
+            tile_stage_execute.sample(executed - query_start)
+        (value,) = await cursor.fetchone()
+        if gather_metrics:
+            query_end = time.perf_counter()
+            tile_stage_fetch.sample(query_end - executed)
+            tile_querytime.sample(query_end - query_start)
+        tile = bytes(value)
+        if gather_metrics:
+            tile_size.sample(len(tile))
+        return tile
+    except psycopg2.Error as e:
+        print(e)
+        raise
+
+# The rendered tile as a TileEntry, or None when it has to be generated
+async def materialized_tile_async(cursor, zoom, x, y):
+    await cursor.execute(materialized_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+    return materialized_tile(await cursor.fetchone())
 
-async def tile_handler_no_pooling(request):
+def materialized_tile(row):
+    if row is None:
+        tile_materialized_miss.inc()
+        return None
+    tile_materialized_hit.inc()
+    (body, gzipped, brotlied, etag) = row
+    return TileEntry(bytes(body), gzipped and bytes(gzipped), brotlied and bytes(brotlied), etag)
+
+# A pooled connection, timing the wait for it and counting the waiters
+@contextlib.asynccontextmanager
+async def pooled_connection(engine):
+    engine.waiters += 1
+    waiting = True
+    start = time.perf_counter()
     try:
-        async with aiopg.connect(request.app['dsn']) as conn:
-            response = await tile_handler_on_conn(conn, request)
-            return response
+        async with engine.pool.acquire() as conn:
+            engine.waiters -= 1
+            waiting = False
+            tile_stage_pool_wait.sample(time.perf_counter() - start)
+            yield conn
+    finally:
+        if waiting:
+            engine.waiters -= 1
+
+class AiopgTileEngine(object):
+    name = 'aiopg'
+
+    def __init__(self, dsn, db_json=False, maxsize=pool_size_default, materialized=False):
+        self.dsn = dsn
+        self.db_json = db_json
+        self.materialized = materialized
+        self.maxsize = maxsize
+        self.pool = None
+        self.waiters = 0
+
+    async def start(self):
+        if connection_pooling:
+            self.pool = await aiopg.create_pool(self.dsn, minsize=0, maxsize=self.maxsize, pool_recycle=30*60,
+                                                on_connect=self.prepare)
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+
+    # (max, open, in use, waiting) connections
+    def pool_stats(self):
+        if self.pool is None:
+            return (self.maxsize, 0, 0, self.waiters)
+        return (self.pool.maxsize, self.pool.size, self.pool.size - self.pool.freesize, self.waiters)
+
+    async def prepare(self, conn):
+        await prepare_connection(conn, self.db_json, self.materialized)
+
+    async def generate_on_conn(self, conn, zoom, x, y):
+        if self.materialized:
+            async with conn.cursor() as cursor:
+                tile = await materialized_tile_async(cursor, zoom, x, y)
+            if tile is not None:
+                return tile
+        if self.db_json:
+            async with conn.cursor() as cursor:
+                return await gentile_json_async(cursor, zoom, x, y, True)
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            tile = await gentile_async(cursor, zoom, x, y, True)
+            return tile.encode('utf8')
+
+    async def generate(self, zoom, x, y):
+        if self.pool is not None:
+            async with pooled_connection(self) as conn:
+                return await self.generate_on_conn(conn, zoom, x, y)
+        async with aiopg.connect(self.dsn) as conn:
+            await self.prepare(conn)
+            return await self.generate_on_conn(conn, zoom, x, y)
+
+    # aiopg connections are in autocommit mode and have no named cursors,
+    # so the server-side cursor is declared in an explicit transaction
+    async def stream_on_conn(self, conn, zoom, x, y, chunk_rows):
+        async with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            await cursor.execute('BEGIN')
+            try:
+                await cursor.execute(stream_declare_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
+                while True:
+                    await cursor.execute(stream_fetch_query.format(int(chunk_rows)))
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    yield [row._asdict() for row in rows]
+            finally:
+                await cursor.execute('COMMIT')
+
+    async def stream(self, zoom, x, y, chunk_rows):
+        if self.pool is not None:
+            async with pooled_connection(self) as conn:
+                async for features in self.stream_on_conn(conn, zoom, x, y, chunk_rows):
+                    yield features
+            return
+        async with aiopg.connect(self.dsn) as conn:
+            await self.prepare(conn)
+            async for features in self.stream_on_conn(conn, zoom, x, y, chunk_rows):
+                yield features
+
+    async def generation_on_conn(self, conn):
+        async with conn.cursor() as cursor:
+            await cursor.execute(generation_query)
+            (generation,) = await cursor.fetchone()
+            return generation
+
+    async def generation(self):
+        if self.pool is not None:
+            async with self.pool.acquire() as conn:
+                return await self.generation_on_conn(conn)
+        async with aiopg.connect(self.dsn) as conn:
+            return await self.generation_on_conn(conn)
+
+    async def import_sequence_on_conn(self, conn):
+        async with conn.cursor() as cursor:
+            try:
+                await cursor.execute(import_sequence_query)
+            except psycopg2.errors.UndefinedTable:
+                return 0
+            (sequence,) = await cursor.fetchone()
+            return sequence
+
+    async def import_sequence(self):
+        if self.pool is not None:
+            async with self.pool.acquire() as conn:
+                return await self.import_sequence_on_conn(conn)
+        async with aiopg.connect(self.dsn) as conn:
+            return await self.import_sequence_on_conn(conn)
+
+# --stream reads soundscape_tile through a server-side cursor instead of
+# the prepared statement, which a cursor cannot be declared for
+stream_declare_query = """
+    DECLARE soundscape_tile_stream NO SCROLL CURSOR FOR
+        SELECT * FROM soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+stream_fetch_query = 'FETCH {0} FROM soundscape_tile_stream'
+
+# Every full import writes new tables and rotates them into place, so the
+# oid of osm_roads changes exactly when the whole data set does; diffs
+# applied in place are handled through the expired tile lists instead.
+# soundscape_tile_generation reads 0 until the derived tables are rebuilt
+# from the new tables.
+generation_query = """
+    SELECT soundscape_tile_generation()
+"""
+
+# generation_query's answer while an import's derived tables are rebuilt
+unsettled_generation = 0
+
+# Last OSM diff applied by ingest.py; a database without the table (never
+# updated since its import) reads as 0
+import_sequence_query = """
+    SELECT coalesce(max(sequence_number), 0) FROM soundscape_osm_import_state
+"""
+
+# asyncpg only understands URI DSNs, so libpq keyword DSNs are translated
+def asyncpg_connect_args(dsn):
+    params = psycopg2.extensions.parse_dsn(dsn)
+    names = {'host': 'host', 'port': 'port', 'user': 'user', 'password': 'password',
+             'dbname': 'database', 'sslmode': 'ssl', 'passfile': 'passfile'}
+    connect_args = {}
+    for key, value in params.items():
+        if key not in names:
+            raise ValueError('dsn parameter {0} is not supported by the asyncpg engine'.format(key))
+        connect_args[names[key]] = int(value) if key == 'port' else value
+    return connect_args
+
+# Uses asyncpg's binary protocol and statement cache.  Rows are decoded the
+# same way psycopg2 decodes them so tiles are byte-identical to aiopg's.
+class AsyncpgTileEngine(object):
+    name = 'asyncpg'
+
+    def __init__(self, dsn, db_json=False, maxsize=pool_size_default, materialized=False):
+        self.dsn = dsn
+        self.db_json = db_json
+        self.materialized = materialized
+        self.maxsize = maxsize
+        self.pool = None
+        self.waiters = 0
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(min_size=0, max_size=self.maxsize,
+                                              max_inactive_connection_lifetime=30*60,
+                                              init=self.prepare,
+                                              server_settings={'statement_timeout': str(statement_timeout_ms)},
+                                              **asyncpg_connect_args(self.dsn))
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    def pool_stats(self):
+        size = self.pool.get_size()
+        return (self.pool.get_max_size(), size, size - self.pool.get_idle_size(), self.waiters)
+
+    async def prepare(self, conn):
+        await conn.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    async def generate(self, zoom, x, y):
+        async with pooled_connection(self) as conn:
+            if self.materialized:
+                tile = materialized_tile(await conn.fetchrow(asyncpg_materialized_query, zoom, x, y))
+                if tile is not None:
+                    return tile
+            query_start = time.perf_counter()
+            if self.db_json:
+                tile = await conn.fetchval(asyncpg_tile_json_query, zoom, x, y)
+                query_time = time.perf_counter() - query_start
+                tile_stage_execute.sample(query_time)
+                tile_querytime.sample(query_time)
+            else:
+                rows = await conn.fetch(asyncpg_tile_query, zoom, x, y)
+                query_end = time.perf_counter()
+                tile_stage_execute.sample(query_end - query_start)
+                tile_querytime.sample(query_end - query_start)
+                features = [dict(row) for row in rows]
+                decoded = time.perf_counter()
+                tile_stage_decode.sample(decoded - query_end)
+                tile = serialize_tile(features).encode('utf8')
+                tile_stage_serialize.sample(time.perf_counter() - decoded)
+            tile_size.sample(len(tile))
+            return tile
+
+    async def stream(self, zoom, x, y, chunk_rows):
+        async with pooled_connection(self) as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(asyncpg_tile_query, zoom, x, y)
+                while True:
+                    rows = await cursor.fetch(chunk_rows)
+                    if not rows:
+                        break
+                    yield [dict(row) for row in rows]
+
+    async def generation(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(generation_query)
+
+    async def import_sequence(self):
+        async with self.pool.acquire() as conn:
+            try:
+                return await conn.fetchval(import_sequence_query)
+            except asyncpg.exceptions.UndefinedTableError:
+                return 0
+
+class Replica(object):
+    def __init__(self, index, engine):
+        self.index = index
+        self.engine = engine
+        self.active = 0
+        self.failures = 0
+        self.healthy = True
+        self.sequence = None
+
+    def load(self):
+        return self.active / self.engine.maxsize
+
+# Spreads tile generation over the primary and its read replicas, one pool
+# each.  Every generation goes to the least loaded healthy database.  A
+# database is ejected after replica_failure_limit generations in a row
+# fail, when it cannot answer a health check, or, for a replica, when its
+# import sequence is behind the primary's; a passing health check brings
+# it back.  With nothing healthy every database is tried rather than none.
+class ReplicaTileEngine(object):
+    def __init__(self, engines, check_interval=replica_check_default):
+        self.replicas = [Replica(index, engine) for (index, engine) in enumerate(engines)]
+        self.name = engines[0].name
+        self.maxsize = sum([engine.maxsize for engine in engines])
+        self.check_interval = check_interval
+        self.checker = None
+
+    async def start(self):
+        await asyncio.gather(*[replica.engine.start() for replica in self.replicas])
+        self.checker = asyncio.ensure_future(self.watch())
+
+    async def close(self):
+        if self.checker is not None:
+            self.checker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.checker
+        await asyncio.gather(*[replica.engine.close() for replica in self.replicas])
+
+    def pool_stats(self):
+        stats = [replica.engine.pool_stats() for replica in self.replicas]
+        return tuple(sum(column) for column in zip(*stats))
+
+    def healthy(self):
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def choose(self):
+        candidates = self.healthy() or self.replicas
+        return min(candidates, key=lambda replica: (replica.load(), replica.index))
+
+    def eject(self, replica, reason):
+        if replica.healthy:
+            replica.healthy = False
+            tile_replica_ejected.inc()
+            always_log('ejected database {0}: {1}'.format(replica.index, reason))
+
+    def admit(self, replica):
+        replica.failures = 0
+        if not replica.healthy:
+            replica.healthy = True
+            always_log('database {0} is healthy again'.format(replica.index))
+
+    def failed(self, replica):
+        replica.failures += 1
+        if replica.failures >= replica_failure_limit:
+            self.eject(replica, '{0} tile generations failed in a row'.format(replica.failures))
+
+    async def generate(self, zoom, x, y):
+        replica = self.choose()
+        replica.active += 1
+        try:
+            tile = await replica.engine.generate(zoom, x, y)
+        except Exception:
+            self.failed(replica)
+            raise
+        finally:
+            replica.active -= 1
+        replica.failures = 0
+        return tile
+
+    async def stream(self, zoom, x, y, chunk_rows):
+        replica = self.choose()
+        replica.active += 1
+        try:
+            async for features in replica.engine.stream(zoom, x, y, chunk_rows):
+                yield features
+        except Exception:
+            self.failed(replica)
+            raise
+        finally:
+            replica.active -= 1
+        replica.failures = 0
+
+    # the generation names the primary's tables; replicas that have not
+    # caught up with it are ejected by the import sequence check
+    async def generation(self):
+        return await self.replicas[0].engine.generation()
+
+    async def read_sequence(self, replica):
+        try:
+            replica.sequence = await asyncio.wait_for(replica.engine.import_sequence(), self.check_interval)
+        except Exception as e:
+            replica.sequence = None
+            self.eject(replica, 'health check failed: {0!r}'.format(e))
+
+    async def check(self):
+        await asyncio.gather(*[self.read_sequence(replica) for replica in self.replicas])
+        primary = self.replicas[0].sequence
+        for replica in self.replicas:
+            if replica.sequence is None:
+                continue
+            if primary is not None and replica.sequence < primary:
+                self.eject(replica, 'import sequence {0} is behind the primary\'s {1}'.format(replica.sequence, primary))
+            else:
+                self.admit(replica)
+        tile_replicas_healthy.set(len(self.healthy()))
+
+    async def watch(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.check_interval)
+
+def create_engine(args, pool_size=None):
+    if pool_size is None:
+        pool_size = args.pool_size
+    engine_class = AsyncpgTileEngine if args.engine == 'asyncpg' else AiopgTileEngine
+    if not args.replica:
+        return engine_class(args.dsn, args.db_json, pool_size, args.materialized)
+    engines = [engine_class(dsn, args.db_json, pool_size, args.materialized) for dsn in [args.dsn] + args.replica]
+    return ReplicaTileEngine(engines, args.replica_check)
+
+# --pool-size is the total across workers, so Postgres sees the same
+# number of connections whatever --workers is
+def worker_pool_size(pool_size, worker):
+    if worker is None:
+        return pool_size
+    return pool_size // worker.count + (1 if worker.index < pool_size % worker.count else 0)
+
+# Database generation is admitted through app['admission']; cache, store
+# and static tile hits never queue behind it
+@contextlib.asynccontextmanager
+async def admitted(app):
+    admission = app['admission']
+    start = time.perf_counter()
+    try:
+        await admission.acquire()
+    except Overloaded:
+        tile_shed.inc()
+        raise
+    tile_stage_admission_wait.sample(time.perf_counter() - start)
+    try:
+        yield
+    finally:
+        admission.release()
+
+# The tile body as bytes, or with --materialized a whole TileEntry when it
+# was rendered ahead of time
+async def generate_tile(app, zoom, x, y):
+    async with admitted(app):
+        return await app['engine'].generate(zoom, x, y)
+
+async def close_engine(app):
+    await app['engine'].close()
+
+# tiles are canonical, so a hash of the body is a stable strong validator
+def tile_etag(body):
+    return hashlib.sha256(body).hexdigest()[:32]
+
+def compress_tile(body):
+    # mtime=0 keeps the gzip bytes identical wherever the tile is generated
+    gzipped = gzip.compress(body, compresslevel=gzip_level, mtime=0)
+    if len(gzipped) >= len(body):
+        gzipped = None
+    brotlied = None
+    if brotli is not None:
+        brotlied = brotli.compress(body, quality=brotli_quality)
+        if len(brotlied) >= len(body):
+            brotlied = None
+    return TileEntry(body, gzipped, brotlied, tile_etag(body))
+
+async def make_tile_entry(body):
+    if len(body) >= compress_offload_size:
+        return await asyncio.get_running_loop().run_in_executor(None, compress_tile, body)
+    return compress_tile(body)
+
+def tile_entry_size(entry):
+    return sum(len(data) for data in (entry.body, entry.gzip, entry.brotli) if data is not None)
+
+def accepted_encodings(header):
+    encodings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encodings[coding] = quality
+    return encodings
+
+# Pick the form of the tile the client prefers by q-value, the smallest
+# of equally preferred ones.  Identity the client does not mention is
+# acceptable at the lowest quality a client can give; identity;q=0, or
+# *;q=0 without naming it, refuses it.  With nothing acceptable the
+# encoding is None and so is the body.
+def choose_encoding(entry, accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    default = accepted.get('*', 0)
+    candidates = [(accepted.get(coding, default), coding, body)
+                  for (coding, body) in (('br', entry.brotli), ('gzip', entry.gzip)) if body is not None]
+    candidates.append((accepted.get('identity', accepted.get('*', 0.001)), None, entry.body))
+    # max keeps the first of equal qualities, the smaller body
+    (quality, coding, body) = max(candidates, key=lambda candidate: candidate[0])
+    if quality <= 0:
+        return None, None
+    return coding, body
+
+# Each content coding is a different representation, so it gets its own tag
+def representation_etag(entry, encoding):
+    if encoding is None:
+        return '"{0}"'.format(entry.etag)
+    return '"{0}-{1}"'.format(entry.etag, encoding)
+
+def etag_matches(if_none_match, etag):
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def cache_tile(cache, key, tile):
+    size = tile_entry_size(tile.tile if isinstance(tile, ComposedTile) else tile)
+    tile_cache_eviction.inc(cache.put(key, tile, size))
+    tile_cache_bytes.set(cache.size)
+    tile_cache_entries.set(len(cache))
+
+# app['static_expired'] maps each expired tile to when it was expired
+def invalidate_tiles(app, tiles, expired_at=None):
+    if app['static_dir'] is not None:
+        if expired_at is None:
+            expired_at = time.time()
+        static_expired = app['static_expired']
+        for tile in tiles:
+            static_expired[tile] = max(expired_at, static_expired.get(tile, expired_at))
+    cache = app['cache']
+    dropped = 0
+    for tile in tiles:
+        if cache.discard(tile):
+            dropped += 1
+    tile_cache_expired.inc(dropped)
+    tile_cache_bytes.set(cache.size)
+    tile_cache_entries.set(len(cache))
+    return dropped
+
+async def watch_expired_tiles(app, watcher, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            processed = watcher.files_processed
+            tiles = await loop.run_in_executor(None, watcher.poll)
+        except Exception:
+            logger.exception('failed to read expired tiles from {0}'.format(watcher.directory))
+            continue
+        if watcher.files_processed != processed:
+            tile_expire_files.inc(watcher.files_processed - processed)
+            dropped = invalidate_tiles(app, tiles)
+            if app['store'] is not None:
+                try:
+                    await loop.run_in_executor(None, app['store'].discard, tiles)
+                except Exception:
+                    tile_store_error.inc()
+                    logger.exception('failed to drop expired tiles from the tile store')
+            always_log('expired {0} tiles through {1}, dropped {2} from cache'.format(len(tiles), watcher.last, dropped))
+
+async def expire_watcher_ctx(app):
+    watcher = ExpireTileWatcher(args.expiredir, zoom_default)
+    loop = asyncio.get_running_loop()
+    if app['static_dir'] is not None:
+        # static tiles written before a diff expired them stay stale across
+        # restarts, so the lists written before startup are replayed
+        expired = await loop.run_in_executor(None, watcher.replay)
+        for (tile, expired_at) in expired.items():
+            invalidate_tiles(app, [tile], expired_at)
+        always_log('replayed {0} expired tiles through {1} for the static tree'.format(len(expired), watcher.last))
+    else:
+        # anything written before startup cannot be in the (empty) cache
+        await loop.run_in_executor(None, watcher.skip_existing)
+    task = asyncio.create_task(watch_expired_tiles(app, watcher, args.expire_poll))
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+# The data generation tiles are stored under, None until it is first read
+# and while it is unsettled.  It changes after startup, so it is held here
+# rather than in the app.
+class DataGeneration(object):
+    def __init__(self):
+        self.current = None
+        self.read = False
+
+# A new generation clears the tile cache, with or without --store.  With
+# --store, tiles a previous generation stored and anything past --store-ttl
+# are pruned when this process reads a new generation; the full table scan
+# is not repeated on every poll.
+async def refresh_generation(app):
+    store = app['store']
+    data_generation = app['generation']
+    try:
+        generation = await app['engine'].generation()
     except Exception:
-        tile_exception.inc()
+        logger.exception('failed to read the data generation')
+        return
+    if generation == unsettled_generation:
+        # tiles served until the derived tables are rebuilt are neither
+        # stored nor kept in the cache past the rebuild
+        generation = None
+    if data_generation.read and generation == data_generation.current:
+        return
+    if data_generation.read:
+        always_log('data generation changed from {0} to {1}'.format(data_generation.current, generation))
+        app['cache'].clear()
+        tile_cache_bytes.set(0)
+        tile_cache_entries.set(0)
+    data_generation.read = True
+    data_generation.current = generation
+    tile_generation.set(generation or unsettled_generation)
+    if store is None or generation is None:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, store.prune, generation)
+    except Exception:
+        tile_store_error.inc()
+        logger.exception('failed to prune the tile store')
+
+async def watch_generation(app, interval):
+    while True:
+        await asyncio.sleep(interval)
+        await refresh_generation(app)
+
+async def data_generation_ctx(app):
+    await refresh_generation(app)
+    task = asyncio.create_task(watch_generation(app, args.generation_poll))
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+async def tile_store_ctx(app):
+    yield
+    app['store'].close()
+
+async def read_stored_tile(app, key):
+    try:
+        stored = await asyncio.get_running_loop().run_in_executor(None, app['store'].get, key, app['generation'].current)
+    except Exception:
+        tile_store_error.inc()
+        logger.exception('failed to read {0} from the tile store'.format(tile_name(*key)))
+        return None
+    if stored is None:
+        tile_store_miss.inc()
+        return None
+    tile_store_hit.inc()
+    return TileEntry(*stored)
+
+def stored_tile_written(future):
+    if future.exception() is not None:
+        tile_store_error.inc()
+        logger.error('failed to write to the tile store: {0}'.format(future.exception()))
+
+# The tree make_static_tiles.py writes: <dir>/z/x/y.json.bz2, holding the
+# same canonical text the tile server generates
+def static_tile_path(directory, key):
+    (zoom, x, y) = key
+    return os.path.join(directory, str(zoom), str(x), '{0}.json.bz2'.format(y))
+
+# (mtime, body) of a static tile, or None when the tree does not have it
+def read_static_tile(path):
+    try:
+        with open(path, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            return (mtime, bz2.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+
+# Static tiles are stale once older than --static-max-age or once an
+# expired tile list written after the static file names them
+async def read_fresh_static_tile(app, key):
+    path = static_tile_path(app['static_dir'], key)
+    try:
+        static = await asyncio.get_running_loop().run_in_executor(None, read_static_tile, path)
+    except Exception:
+        logger.exception('failed to read static tile {0}'.format(path))
+        static = None
+    if static is None:
+        tile_static_miss.inc()
+        return None
+    (mtime, body) = static
+    expired_at = app['static_expired'].get(key)
+    if (expired_at is not None and mtime <= expired_at) or (args.static_max_age and mtime < time.time() - args.static_max_age):
+        tile_static_stale.inc()
+        return None
+    tile_static_hit.inc()
+    return body
+
+# A tile from the static tree or the shared store, cached on the way
+async def load_saved_tile(app, key):
+    if app['static_dir'] is not None:
+        body = await read_fresh_static_tile(app, key)
+        if body is not None:
+            compress_start = time.perf_counter()
+            tile = await make_tile_entry(body)
+            tile_stage_compress.sample(time.perf_counter() - compress_start)
+            cache_tile(app['cache'], key, tile)
+            return tile
+    if app['store'] is not None and app['generation'].current is not None:
+        tile = await read_stored_tile(app, key)
+        if tile is not None:
+            cache_tile(app['cache'], key, tile)
+            return tile
+    return None
+
+# Caches a generated tile and writes it to the shared store
+def keep_tile(app, key, tile):
+    cache_tile(app['cache'], key, tile)
+    store = app['store']
+    generation = app['generation'].current
+    if store is not None and generation is not None:
+        # the response does not wait for the write
+        written = asyncio.get_running_loop().run_in_executor(None, store.put, key, generation, tile)
+        written.add_done_callback(stored_tile_written)
+
+async def load_tile(app, key):
+    tile = await load_saved_tile(app, key)
+    if tile is not None:
+        return tile
+    tile_data = await generate_tile(app, *key)
+    if tile_data == None:
+        return None
+    if isinstance(tile_data, TileEntry):
+        # rendered ahead of time, already hashed and compressed
+        tile = tile_data
+    else:
+        compress_start = time.perf_counter()
+        tile = await make_tile_entry(tile_data)
+        tile_stage_compress.sample(time.perf_counter() - compress_start)
+    keep_tile(app, key, tile)
+    return tile
+
+def finish_flight(app, key):
+    del app['inflight'][key]
+    tile_inflight.set(len(app['inflight']))
+
+# Concurrent misses for the same tile share a single generation.  The
+# generation runs as its own task so a leader whose client goes away does
+# not cancel it for the requests waiting on it.
+async def coalesced_load_tile(app, key):
+    inflight = app['inflight']
+    flight = inflight.get(key)
+    while isinstance(flight, StreamFlight):
+        tile_coalesced.inc()
+        tile = await asyncio.shield(flight)
+        if tile is not None:
+            return tile
+        flight = inflight.get(key)
+    if flight is None:
+        flight = asyncio.ensure_future(load_tile(app, key))
+        inflight[key] = flight
+        tile_inflight.set(len(inflight))
+        flight.add_done_callback(lambda _: finish_flight(app, key))
+        return await asyncio.shield(flight)
+    tile_coalesced.inc()
+    tile_inflight_waiters.set(tile_inflight_waiters.value + 1)
+    try:
+        return await asyncio.shield(flight)
+    finally:
+        tile_inflight_waiters.set(tile_inflight_waiters.value - 1)
+
+# Returns the tile as a TileEntry, from the tile cache when possible
+async def fetch_tile(app, zoom, x, y):
+    key = (zoom, x, y)
+    tile = app['cache'].get(key)
+    if tile is not None:
+        tile_cache_hit.inc()
+        return tile
+    tile_cache_miss.inc()
+    return await coalesced_load_tile(app, key)
+
+# A tile already generated or being generated, without generating it
+async def fetch_saved_tile(app, key):
+    tile = app['cache'].get(key)
+    if tile is not None:
+        tile_cache_hit.inc()
+        return tile
+    tile_cache_miss.inc()
+    flight = app['inflight'].get(key)
+    if flight is not None:
+        tile_coalesced.inc()
+        return await asyncio.shield(flight)
+    return await load_saved_tile(app, key)
+
+# With --stream a tile that has to be generated is read as the rows of the
+# tile query arrive from a server-side cursor, so memory per request stays
+# bounded however dense the tile is.  A tile that ends within
+# stream_keep_bytes is buffered, then cached, stored and answered like any
+# other, ETag included.  Past that it is written as it arrives, without an
+# ETag, and not kept.  Returns (response, None) for a tile written that
+# way and (None, tile) for a buffered one.
+async def write_streamed_tile(request, key):
+    app = request.app
+    response = None
+    head = canonical_json.TILE_HEAD.encode('utf8')
+    kept = [head]
+    size = len(head)
+    separator = ''
+    try:
+        async with admitted(app):
+            async with contextlib.aclosing(app['engine'].stream(*key, stream_chunk_rows)) as chunks:
+                async for features in chunks:
+                    if not features:
+                        continue
+                    text = (separator + canonical_json.serialize_features(features)).encode('utf8')
+                    separator = canonical_json.FEATURE_SEPARATOR
+                    size += len(text)
+                    if response is None and size > stream_keep_bytes:
+                        response = web.StreamResponse(headers={'Vary': 'Accept-Encoding'})
+                        response.content_type = 'application/json'
+                        response.enable_compression()
+                        await response.prepare(request)
+                        await response.write(b''.join(kept))
+                        kept = None
+                    if response is None:
+                        kept.append(text)
+                    else:
+                        await response.write(text)
+    except BaseException:
+        if response is not None and request.transport is not None:
+            # a clean end would pass the truncated tile off as a whole one
+            request.transport.abort()
         raise
+    tail = canonical_json.TILE_TAIL.encode('utf8')
+    tile_streamed.inc()
+    tile_size.sample(size + len(tail))
+    if response is None:
+        tile = await make_tile_entry(b''.join(kept) + tail)
+        keep_tile(app, key, tile)
+        return (None, tile)
+    await response.write(tail)
+    await response.write_eof()
+    tile_served.inc()
+    return (response, None)
+
+# A stream in app['inflight'].  Requests of the tile wait for it and are
+# answered with the tile it buffered; a tile written as it arrived was not
+# kept, so each waiter streams it, or for a batch generates it, anew.
+class StreamFlight(asyncio.Future):
+    pass
 
-async def tile_handler_pooling(request):
+# The first request of a tile streams it as a flight other requests of the
+# tile wait for, as fetch_saved_tile does.  Returns (response, tile) as
+# write_streamed_tile does.
+async def stream_tile(request, key):
+    app = request.app
+    inflight = app['inflight']
+    if key in inflight:
+        return await write_streamed_tile(request, key)
+    flight = StreamFlight()
+    inflight[key] = flight
+    tile_inflight.set(len(inflight))
+    tile = None
     try:
-        async with request.app['pool'].acquire() as conn:
-            always_log('pool: {0}/{1}/{2}'.format(request.app['pool'].minsize, request.app['pool'].size, request.app['pool'].maxsize))
-            response = await tile_handler_on_conn(conn, request)
-            return response
+        (response, tile) = await write_streamed_tile(request, key)
+    finally:
+        flight.set_result(tile)
+        finish_flight(app, key)
+    return (response, tile)
+
+# feature fields composed tiles can be filtered on, each given as a comma
+# separated list of the values to keep
+feature_filters = ('feature_type', 'feature_value')
+
+def parse_feature_filter(query):
+    selected = {}
+    for name in feature_filters:
+        if name in query:
+            selected[name] = frozenset(value for value in query[name].split(',') if value)
+    return selected
+
+# default zoom tiles covering a tile at a lower zoom, row by row
+def child_tiles(zoom, x, y):
+    scale = 2 ** (zoom_default - zoom)
+    return [(zoom_default, x * scale + i, y * scale + j) for j in range(scale) for i in range(scale)]
+
+# An entrance list names a building and the entrances of it inside one
+# tile, ordered by entrance id, so each child holds part of the list
+entrance_list_value = 'gd_entrance_list'
+
+def entrance_points(feature):
+    geometry = feature['geometry']
+    points = geometry['coordinates'] if geometry['type'] == 'MultiPoint' else [geometry['coordinates']]
+    return list(zip(feature['osm_ids'][1:], points))
+
+# The whole list of a building from its parts; an entrance on the edge
+# between two children is in both parts but listed as often as in one
+def merge_entrance_lists(parts):
+    counts = {}
+    for part in parts:
+        part_counts = {}
+        for (osm_id, point) in entrance_points(part):
+            key = (osm_id, json.dumps(point))
+            part_counts[key] = part_counts.get(key, 0) + 1
+        for key, count in part_counts.items():
+            counts[key] = max(count, counts.get(key, 0))
+    entrances = sorted(counts, key=lambda key: key[0])
+    merged = dict(parts[0])
+    merged['osm_ids'] = parts[0]['osm_ids'][:1] + [osm_id for (osm_id, point) in entrances for _ in range(counts[(osm_id, point)])]
+    merged['geometry'] = {'type': 'MultiPoint', 'coordinates': [json.loads(point) for (osm_id, point) in entrances for _ in range(counts[(osm_id, point)])]}
+    return merged
+
+# Tile queries select whole geometries by bounding box, so a feature
+# crossing tiles is the same in each child and is kept once.  osm_ids alone
+# do not identify a feature: imposm writes a row per matched tag, and two
+# roads may meet at more than one intersection.  Features are ordered by
+# osm_ids as soundscape_tile orders them.
+def compose_tile(bodies, selected):
+    features = {}
+    entrance_lists = {}
+    for body in bodies:
+        for feature in json.loads(body)['features']:
+            if not all(feature.get(name) in values for (name, values) in selected.items()):
+                continue
+            if feature.get('feature_type') == entrance_list_value:
+                entrance_lists.setdefault(feature['osm_ids'][0], []).append(feature)
+                continue
+            features.setdefault(json.dumps(feature, sort_keys=True), feature)
+    for parts in entrance_lists.values():
+        feature = parts[0] if len(parts) == 1 else merge_entrance_lists(parts)
+        features.setdefault(json.dumps(feature, sort_keys=True), feature)
+    ordered = sorted(features.items(), key=lambda item: (item[1]['osm_ids'], item[0]))
+    return serialize_tile([feature for (_, feature) in ordered]).encode('utf8')
+
+# cache key of a composed tile; filters are order insensitive
+def composed_key(zoom, x, y, selected):
+    return (zoom, x, y, tuple(sorted((name, tuple(sorted(values))) for (name, values) in selected.items())))
+
+ComposedTile = namedtuple('composedtile', 'children tile')
+
+# A lower zoom or filtered tile, merged from default zoom tiles fetched as
+# any other tile is, so no wider tile query ever reaches the database.  The
+# result is cached with the etags of the children it was built from and
+# rebuilt once any of them changes.
+async def fetch_composed_tile(app, zoom, x, y, selected):
+    children = await asyncio.gather(*[fetch_tile(app, *key) for key in child_tiles(zoom, x, y)])
+    if any(child == None for child in children):
+        return None
+    key = composed_key(zoom, x, y, selected)
+    etags = tuple(child.etag for child in children)
+    cached = app['cache'].get(key)
+    if cached is not None and cached.children == etags:
+        return cached.tile
+    body = await asyncio.get_running_loop().run_in_executor(
+        None, compose_tile, [child.body for child in children], selected)
+    tile_composed.inc()
+    tile = await make_tile_entry(body)
+    cache_tile(app['cache'], key, ComposedTile(etags, tile))
+    return tile
+
+async def tile_handler(request):
+    start = datetime.utcnow()
+    zoom = int(request.match_info['zoom'])
+    if not composed_min_zoom <= zoom <= zoom_default:
+        raise web.HTTPNotFound()
+    x = int(request.match_info['x'])
+    y = int(request.match_info['y'])
+    selected = parse_feature_filter(request.query)
+    try:
+        if zoom == zoom_default and not selected and args.stream:
+            tile = await fetch_saved_tile(request.app, (zoom, x, y))
+            if tile is None:
+                (response, tile) = await stream_tile(request, (zoom, x, y))
+                if response is not None:
+                    return response
+        elif zoom == zoom_default and not selected:
+            tile = await fetch_tile(request.app, zoom, x, y)
+        else:
+            tile = await fetch_composed_tile(request.app, zoom, x, y, selected)
+    except Overloaded:
+        raise web.HTTPServiceUnavailable(headers={'Retry-After': str(admission_retry_after)})
     except Exception:
         tile_exception.inc()
         raise
+    if tile == None:
+        logger.info('ERROR GET {0}/{1}/{2}.json'.format(zoom, x, y))
+        always_log('TILE_ERROR')
+        tile_queryfail.inc()
+        raise web.HTTPServiceUnavailable()
+    else:
+        encoding, body = choose_encoding(tile, request.headers.get('Accept-Encoding', ''))
+        if body is None:
+            raise web.HTTPNotAcceptable(text='no acceptable content coding')
+        etag = representation_etag(tile, encoding)
+        headers = {'Vary': 'Accept-Encoding', 'ETag': etag}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            tile_not_modified.inc()
+            return web.Response(status=304, headers=headers)
+        tile_served.inc()
+        if encoding == 'gzip':
+            tile_served_gzip.inc()
+            headers['Content-Encoding'] = encoding
+        elif encoding == 'br':
+            tile_served_brotli.inc()
+            headers['Content-Encoding'] = encoding
+        response = web.Response(body=body, headers=headers, content_type='application/json')
+        write_start = time.perf_counter()
+        await response.prepare(request)
+        await response.write_eof()
+        tile_stage_write.sample(time.perf_counter() - write_start)
+        end = datetime.utcnow()
+        telemetry_log('request', start, end)
+        return response
+
+# "16/x/y,16/x/y" -> [(16, x, y), ...]
+def parse_tile_list(value):
+    tiles = []
+    for name in value.split(','):
+        parts = name.strip().split('/')
+        if len(parts) != 3 or not all(part.isdigit() for part in parts):
+            raise web.HTTPBadRequest(text='malformed tile {0!r}, expected z/x/y'.format(name))
+        tiles.append(tuple(int(part) for part in parts))
+    return tiles
+
+def parse_coords(name, value, count):
+    try:
+        coords = [float(part) for part in value.split(',')]
+    except ValueError:
+        coords = []
+    if len(coords) != count or not all(math.isfinite(c) for c in coords):
+        raise web.HTTPBadRequest(text='{0} expects {1} comma separated numbers'.format(name, count))
+    return coords
 
-async def logger_middleware(app, handler):
-    async def logger_m(request):
-        logger.warning('REQUEST {0}'.format(request.method))
+def check_lat_lon(name, lat, lon):
+    if abs(lat) > max_tile_lat or abs(lon) > 180.0:
+        raise web.HTTPBadRequest(text='{0} is outside the tile grid'.format(name))
+
+# tiles=z/x/y,... or bbox=minlat,minlon,maxlat,maxlon at the default zoom
+def batch_request_tiles(query):
+    if 'tiles' in query:
+        tiles = parse_tile_list(query['tiles'])
+    elif 'bbox' in query:
+        coord_bbox = parse_coords('bbox', query['bbox'], 4)
+        check_lat_lon('bbox', coord_bbox[0], coord_bbox[1])
+        check_lat_lon('bbox', coord_bbox[2], coord_bbox[3])
+        (minx, miny, maxx, maxy) = tile_bbox_from_coords(zoom_default, coord_bbox)
+        if (maxx - minx + 1) * (maxy - miny + 1) > batch_max_tiles:
+            raise web.HTTPBadRequest(text='bbox covers more than {0} tiles'.format(batch_max_tiles))
+        tiles = [(zoom_default, x, y) for y in range(miny, maxy + 1) for x in range(minx, maxx + 1)]
+    else:
+        raise web.HTTPBadRequest(text='expected tiles or bbox')
+    if any(zoom != zoom_default for (zoom, _, _) in tiles):
+        raise web.HTTPBadRequest(text='only zoom {0} tiles are available'.format(zoom_default))
+    tiles = list(dict.fromkeys(tiles))
+    if len(tiles) > batch_max_tiles:
+        raise web.HTTPBadRequest(text='at most {0} tiles per request'.format(batch_max_tiles))
+    return tiles
+
+# One NDJSON line per tile: the tile itself is embedded unchanged, so its
+# bytes and etag are the same as from the single tile endpoint
+async def batch_line(key, flight):
+    (zoom, x, y) = key
+    error = '{{"z": {0}, "x": {1}, "y": {2}, "error": 503}}\n'.format(zoom, x, y).encode('ascii')
+    try:
+        tile = await flight
+    except Overloaded:
+        return error
+    except Exception:
+        logger.exception('failed to generate {0}'.format(tile_name(zoom, x, y)))
+        tile_exception.inc()
+        tile = None
+    if tile == None:
+        tile_queryfail.inc()
+        return error
+    tile_batch_tiles.inc()
+    head = '{{"z": {0}, "x": {1}, "y": {2}, "etag": "{3}", "tile": '.format(zoom, x, y, tile.etag)
+    return head.encode('ascii') + tile.body + b'}\n'
+
+# Streams tiles in the order given while keeping up to --batch-concurrency
+# of them generating ahead of the one being written
+async def stream_tiles(request, tiles):
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    response.enable_compression()
+    await response.prepare(request)
+    remaining = iter(tiles)
+    pending = deque((key, asyncio.ensure_future(fetch_tile(request.app, *key)))
+                    for key in itertools.islice(remaining, args.batch_concurrency))
+    try:
+        while pending:
+            (key, flight) = pending.popleft()
+            line = await batch_line(key, flight)
+            following = next(remaining, None)
+            if following is not None:
+                pending.append((following, asyncio.ensure_future(fetch_tile(request.app, *following))))
+            write_start = time.perf_counter()
+            await response.write(line)
+            tile_stage_write.sample(time.perf_counter() - write_start)
+    finally:
+        for (_, flight) in pending:
+            flight.cancel()
+    await response.write_eof()
+    return response
+
+async def batch_handler(request):
+    start = datetime.utcnow()
+    tiles = batch_request_tiles(request.query)
+    tile_batch_requests.inc()
+    response = await stream_tiles(request, tiles)
+    telemetry_log('batch', start, datetime.utcnow(), {'tiles': len(tiles)})
+    return response
+
+# lat=&lon= or route=lat,lon,lat,lon,... with an optional radius in metres,
+# covered at the default zoom in the order a client leaving the start
+# point needs the tiles
+def prefetch_request_tiles(query):
+    radius = prefetch_radius_default
+    if 'radius' in query:
+        (radius,) = parse_coords('radius', query['radius'], 1)
+        if not 0 <= radius <= prefetch_max_radius:
+            raise web.HTTPBadRequest(text='radius must be between 0 and {0} metres'.format(prefetch_max_radius))
+    if 'route' in query:
+        coords = parse_coords('route', query['route'], query['route'].count(',') + 1)
+        if len(coords) % 2 or len(coords) > 2 * prefetch_max_route_points:
+            raise web.HTTPBadRequest(text='route expects up to {0} lat,lon pairs'.format(prefetch_max_route_points))
+        points = list(zip(coords[0::2], coords[1::2]))
+    elif 'lat' in query and 'lon' in query:
+        points = [(parse_coords('lat', query['lat'], 1)[0], parse_coords('lon', query['lon'], 1)[0])]
+    else:
+        raise web.HTTPBadRequest(text='expected lat and lon, or route')
+    for (lat, lon) in points:
+        check_lat_lon('route' if 'route' in query else 'lat,lon', lat, lon)
+    try:
+        return corridor_tiles(points, radius, zoom_default, batch_max_tiles)
+    except TooManyTiles as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+async def prefetch_handler(request):
+    start = datetime.utcnow()
+    tiles = prefetch_request_tiles(request.query)
+    tile_prefetch_requests.inc()
+    response = await stream_tiles(request, tiles)
+    telemetry_log('prefetch', start, datetime.utcnow(), {'tiles': len(tiles)})
+    return response
+
+# Requests only append a record here; access_log_ctx formats and writes
+# them in the background
+@web.middleware
+async def access_log_middleware(request, handler):
+    log = request.app['access_log']
+    if not log.sampled():
         return await handler(request)
-    return logger_m
+    ts = time.time()
+    start = time.perf_counter()
+    status = 500
+    size = 0
+    try:
+        response = await handler(request)
+        status = response.status
+        size = response.body_length or response.content_length or 0
+        return response
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        log.add(AccessRecord(ts, request.method, request.path_qs, status, round(time.perf_counter() - start, 6), size,
+                             request.headers.get('X-Real-IP', request.remote)))
+
+async def flush_access_log(log):
+    (records, dropped) = log.drain()
+    tile_access_log_dropped.inc(dropped)
+    if records:
+        await asyncio.get_running_loop().run_in_executor(None, log.write, records)
+        tile_access_log_records.inc(len(records))
+
+async def write_access_log(log):
+    while True:
+        await asyncio.sleep(access_log_interval)
+        try:
+            await flush_access_log(log)
+        except Exception:
+            logger.exception('failed to write the access log to {0}'.format(log.path))
+
+# Hot default zoom tiles, lower zoom tiles standing for the children they
+# are composed from, keeping the first limit in rank order
+def warm_up_tiles(hot, limit):
+    keys = {}
+    for (zoom, x, y) in hot:
+        if zoom == zoom_default:
+            keys.setdefault((zoom, x, y))
+        elif composed_min_zoom <= zoom < zoom_default:
+            for key in child_tiles(zoom, x, y):
+                keys.setdefault(key)
+        if len(keys) >= limit:
+            break
+    return list(keys)[:limit]
+
+async def warm_cache(app, path):
+    warmup = app['warmup']
+    try:
+        hot = await asyncio.get_running_loop().run_in_executor(None, read_hot_tiles, path)
+    except Exception:
+        # a missing or unreadable list must not keep the instance unready
+        logger.exception('failed to read warm-up tiles from {0}'.format(path))
+        warmup.finished = True
+        return
+    start = time.perf_counter()
+    await warmup.run(warm_up_tiles(hot, args.warm_tiles), lambda key: fetch_tile(app, *key), args.warm_concurrency)
+    always_log('warmed {0} tiles ({1} failed) from {2} in {3:.1f}s'.format(
+        warmup.done, warmup.failed, path, time.perf_counter() - start))
+
+async def warm_up_ctx(app):
+    task = asyncio.create_task(warm_cache(app, args.warm_from))
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+async def access_log_ctx(app):
+    log = app['access_log']
+    task = asyncio.create_task(write_access_log(log))
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    await flush_access_log(log)
 
 @web.middleware
 async def error_middleware(request, handler):
@@ -200,12 +1647,97 @@ async def alive_handler(request):
     tilesrv_aliveprobe.inc()
     return web.Response()
 
+# Ready once --warm-from warm-up has done --warm-ready of its tiles, so a
+# new instance is only switched to with a warm cache.  Each worker warms
+# its own cache and any of them may answer, so with --workers the others'
+# published warm-up state must be ready too.
+async def ready_handler(request):
+    warmup = request.app['warmup']
+    if warmup is None:
+        return web.Response()
+    if not warmup.ready:
+        total = '?' if warmup.tiles is None else len(warmup.tiles)
+        raise web.HTTPServiceUnavailable(text='warming up, {0} of {1} tiles done'.format(warmup.done, total))
+    worker = request.app['worker']
+    if worker is not None:
+        others = await asyncio.get_running_loop().run_in_executor(None, read_worker_snapshots, worker)
+        warm = len([snapshot for snapshot in others if snapshot.get(tile_warmup_ready.name) == 1])
+        if warm < worker.count - 1:
+            raise web.HTTPServiceUnavailable(text='warming up, {0} of {1} workers ready'.format(warm + 1, worker.count))
+    return web.Response()
+
 def metrics_to_string(m):
     return ''.join([x.report() for x in metrics])
 
+def metrics_snapshot():
+    return {m.name: m.snapshot() for m in metrics}
+
+def combined_metrics_to_string(snapshots):
+    return ''.join([m.report(m.combine([s[m.name] for s in snapshots if m.name in s])) for m in metrics])
+
+def worker_metrics_path(worker):
+    return os.path.join(worker.metrics_dir, '{0}.json'.format(worker.index))
+
+def write_metrics_snapshot(worker, snapshot):
+    path = worker_metrics_path(worker)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+# the latest snapshot published by every other worker
+def read_worker_snapshots(worker):
+    snapshots = []
+    for index in range(worker.count):
+        if index == worker.index:
+            continue
+        try:
+            with open(worker_metrics_path(worker._replace(index=index))) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return snapshots
+
+def update_pool_gauges(app):
+    (maximum, size, in_use, waiters) = app['engine'].pool_stats()
+    tile_pool_max.set(maximum)
+    tile_pool_size.set(size)
+    tile_pool_in_use.set(in_use)
+    tile_pool_waiters.set(waiters)
+    tile_admission_active.set(app['admission'].active)
+    tile_admission_queue.set(app['admission'].queued)
+    warmup = app['warmup']
+    if warmup is not None:
+        tile_warmup_tiles.set(len(warmup.tiles or ()))
+        tile_warmup_done.set(warmup.done)
+        tile_warmup_failed.set(warmup.failed)
+        tile_warmup_ready.set(1 if warmup.ready else 0)
+
+async def publish_metrics(app):
+    worker = app['worker']
+    loop = asyncio.get_running_loop()
+    while True:
+        update_pool_gauges(app)
+        try:
+            await loop.run_in_executor(None, write_metrics_snapshot, worker, metrics_snapshot())
+        except OSError:
+            logger.exception('failed to publish metrics to {0}'.format(worker.metrics_dir))
+        await asyncio.sleep(metrics_publish_interval)
+
+async def metrics_publisher_ctx(app):
+    task = asyncio.create_task(publish_metrics(app))
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
 async def metrics_handler(request):
     tilesrv_metrics_scraped.inc()
-    return web.Response(text=metrics_to_string(metrics))
+    update_pool_gauges(request.app)
+    worker = request.app['worker']
+    if worker is None:
+        return web.Response(text=metrics_to_string(metrics))
+    others = await asyncio.get_running_loop().run_in_executor(None, read_worker_snapshots, worker)
+    return web.Response(text=combined_metrics_to_string([metrics_snapshot()] + others))
 
 # standard tile to coordinates and reverse versions from
 # https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
@@ -243,37 +1775,207 @@ def telemetry_log(event_name, start, end, extra=None):
         extra['start'] = start.isoformat()
         extra['end'] = end.isoformat()
 
-async def app_factory():
+async def app_factory(worker=None):
+    global tile_serializer
+    tile_serializer = canonical_json.serializers[args.serializer]
     app = web.Application()
-    if args.verbose:
-        app.middlewares.append(logger_middleware)
+    if args.access_log:
+        app['access_log'] = AccessLog(args.access_log, access_log_capacity, args.access_log_sample)
+        app.middlewares.append(access_log_middleware)
+        app.cleanup_ctx.append(access_log_ctx)
     app.middlewares.append(error_middleware)
     app['dsn'] = args.dsn
-    if connection_pooling:
-        app['pool'] = await aiopg.create_pool(app['dsn'], minsize=0, pool_recycle=30*60)
+    app['cache'] = TileCache(args.cache_size * 1024 * 1024, args.cache_ttl)
+    app['inflight'] = {}
+    app['worker'] = worker
+    app['store'] = None
+    app['generation'] = DataGeneration()
+    app['static_dir'] = args.static_dir
+    app['static_expired'] = {}
+    app['warmup'] = None
+    if args.store:
+        app['store'] = TileStore(args.store, args.store_ttl)
+        app.cleanup_ctx.append(tile_store_ctx)
+    # polled with or without --store, so a new import clears the cache
+    app.cleanup_ctx.append(data_generation_ctx)
+    # after the generation is read, so warm-up reads and writes the store
+    # under it
+    if args.warm_from:
+        app['warmup'] = WarmUp(args.warm_ready)
+        app.cleanup_ctx.append(warm_up_ctx)
+    if worker is not None:
+        app.cleanup_ctx.append(metrics_publisher_ctx)
+    if args.expiredir:
+        app.cleanup_ctx.append(expire_watcher_ctx)
+    pool_size = worker_pool_size(args.pool_size, worker)
+    app['engine'] = create_engine(args, pool_size)
+    # admitting no more generations than there are connections keeps the
+    # queue here, where it has a deadline, rather than in pool acquire
+    app['admission'] = AdmissionGate(args.admission_limit or app['engine'].maxsize, args.admission_queue, args.admission_wait)
+    await app['engine'].start()
+    app.on_cleanup.append(close_engine)
 
     # assume ingress addding /tiles/
     app.add_routes([web.get(r'/{zoom:\d+}/{x:\d+}/{y:\d+}.json', tile_handler),
                     web.get(r'/tiles/{zoom:\d+}/{x:\d+}/{y:\d+}.json', tile_handler), # also respond to requests for /tiles/...
+                    web.get('/batch', batch_handler),
+                    web.get('/tiles/batch', batch_handler),
+                    web.get('/prefetch', prefetch_handler),
+                    web.get('/tiles/prefetch', prefetch_handler),
                     web.get('/probe/alive', alive_handler),
+                    web.get('/probe/ready', ready_handler),
                     web.get('/metrics', metrics_handler)])
     return app
 
-def main():
-    global args
-    global logger
-    global tc
-    global tile_handler
-
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='tile generator for Soundscape')
     parser.add_argument('--server', nargs=1, type=int, default=8080, help='server port')
+    parser.add_argument('--workers', type=int, default=1, help='server processes sharing the port with SO_REUSEPORT')
     parser.add_argument('--dsn', type=str, help='specify dsn', default='dbname=osm')
-    parser.add_argument('--verbose', '-v', action='store_true', help='verbose')
+    parser.add_argument('--replica', type=str, action='append', default=[], help='dsn of a read replica to spread tile queries over, may be repeated')
+    parser.add_argument('--replica-check', type=float, default=replica_check_default, help='seconds between health checks of the primary and replicas')
+    parser.add_argument('--verbose', '-v', action='store_true', help='log info messages; requests are logged with --access-log')
     parser.add_argument('--telemetry', action='store_true', help='enable telemetry')
+    parser.add_argument('--access-log', type=str, default=None, help='JSON lines access log file, - for stdout')
+    parser.add_argument('--access-log-sample', type=float, default=1.0, help='fraction of requests written to the access log')
+    parser.add_argument('--cache-size', type=int, default=cache_size_default, help='tile cache budget in MiB, 0 disables caching')
+    parser.add_argument('--cache-ttl', type=float, default=cache_ttl_default, help='seconds a cached tile may be served')
+    parser.add_argument('--engine', choices=engines, default='aiopg', help='database driver used to generate tiles')
+    parser.add_argument('--pool-size', type=int, default=pool_size_default, help='maximum database connections')
+    parser.add_argument('--serializer', choices=list(canonical_json.serializers), default=canonical_json.serializer_default, help='tile JSON serializer, all produce identical bytes')
+    parser.add_argument('--db-json', action='store_true', help='have PostGIS assemble tiles with soundscape_tile_json')
+    parser.add_argument('--stream', action='store_true', help='stream generated tiles from a server-side cursor as rows arrive')
+    parser.add_argument('--materialized', action='store_true', help='serve tiles ingest.py --render-tiles rendered into soundscape_tiles, generating only the rest')
+    parser.add_argument('--expiredir', type=str, help='imposm expired tiles directory used to invalidate cached tiles', default=None)
+    parser.add_argument('--admission-limit', type=int, default=None, help='tile generations run at once per process, defaults to the pool size')
+    parser.add_argument('--admission-queue', type=int, default=admission_queue_default, help='tile generations that may wait for admission before requests are shed')
+    parser.add_argument('--admission-wait', type=float, default=admission_wait_default, help='seconds a tile generation may wait for admission')
+    parser.add_argument('--batch-concurrency', type=int, default=batch_concurrency_default, help='tiles generated at once for each batch request')
+    parser.add_argument('--store', type=str, help='SQLite file holding tiles shared between processes and restarts', default=None)
+    parser.add_argument('--store-ttl', type=float, default=None, help='seconds a stored tile may be served, by default until the data generation changes')
+    parser.add_argument('--static-dir', type=str, help='serve tiles from this make_static_tiles.py output, falling back to the database', default=None)
+    parser.add_argument('--static-max-age', type=float, default=None, help='seconds after which a static tile is stale and regenerated')
+    parser.add_argument('--warm-from', type=str, default=None, help='tiles.log.json access log or ranked z/x/y list to warm the cache from at startup')
+    parser.add_argument('--warm-tiles', type=int, default=warm_tiles_default, help='hottest tiles to warm, keep within --cache-size')
+    parser.add_argument('--warm-concurrency', type=int, default=warm_concurrency_default, help='tiles generated at once while warming')
+    parser.add_argument('--warm-ready', type=float, default=1.0, help='fraction of warm-up tiles done before /probe/ready succeeds')
+    parser.add_argument('--generation-poll', type=float, default=generation_poll_default, help='seconds between checks for a new data generation')
+    parser.add_argument('--expire-poll', type=float, default=expire_poll_default, help='seconds between scans of --expiredir')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not 0 < args.access_log_sample <= 1:
+        parser.error('--access-log-sample must be greater than 0 and at most 1')
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+    if args.cache_ttl <= 0:
+        parser.error('--cache-ttl must be greater than zero')
+    if args.store_ttl is not None and args.store_ttl <= 0:
+        parser.error('--store-ttl must be greater than zero')
+    if args.static_max_age is not None and args.static_max_age <= 0:
+        parser.error('--static-max-age must be greater than zero')
+    if args.generation_poll <= 0:
+        parser.error('--generation-poll must be greater than zero')
+    if args.expire_poll <= 0:
+        parser.error('--expire-poll must be greater than zero')
+    if args.admission_limit is not None and args.admission_limit <= 0:
+        parser.error('--admission-limit must be greater than zero')
+    if args.admission_queue < 0:
+        parser.error('--admission-queue must not be negative')
+    if args.admission_wait <= 0:
+        parser.error('--admission-wait must be greater than zero')
+    if args.warm_tiles < 0:
+        parser.error('--warm-tiles must not be negative')
+    if args.warm_concurrency <= 0:
+        parser.error('--warm-concurrency must be greater than zero')
+    if not 0 <= args.warm_ready <= 1:
+        parser.error('--warm-ready must be between 0 and 1')
+    if args.batch_concurrency <= 0:
+        parser.error('--batch-concurrency must be greater than zero')
+    if args.pool_size <= 0:
+        parser.error('--pool-size must be greater than zero')
+    if args.replica_check <= 0:
+        parser.error('--replica-check must be greater than zero')
+    if args.workers <= 0:
+        parser.error('--workers must be greater than zero')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers requires SO_REUSEPORT')
+    if args.pool_size < args.workers:
+        parser.error('--pool-size must be at least --workers')
+    if args.stream and args.db_json:
+        parser.error('--stream cannot be used with --db-json, which builds the whole tile in PostGIS')
+    if args.stream and args.materialized:
+        parser.error('--stream cannot be used with --materialized, which reads whole tiles from soundscape_tiles')
+    if args.engine == 'asyncpg' and asyncpg is None:
+        parser.error('--engine asyncpg requires the asyncpg package')
+    return args
 
-    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s')
+def server_port(args):
+    if isinstance(args.server, list):
+        return args.server[0]
+    return args.server
+
+def run_worker(worker):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    always_log('worker {0} of {1} started, pool size {2}'.format(worker.index, worker.count, worker_pool_size(args.pool_size, worker)))
+    web.run_app(app_factory(worker), port=server_port(args), reuse_port=True, print=None)
+
+# Forks count workers that each bind the port with SO_REUSEPORT, so the
+# kernel spreads connections across them, and replaces any that exit
+# until the server is told to stop
+def run_workers(count):
+    metrics_dir = tempfile.mkdtemp(prefix='tilesrv-metrics-')
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(WorkerInfo(index, count, metrics_dir))
+            except BaseException:
+                logger.exception('worker {0} failed'.format(index))
+                os._exit(1)
+            os._exit(0)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for index in range(count):
+            spawn(index)
+        while children:
+            try:
+                (pid, status) = os.wait()
+            except ChildProcessError:
+                break
+            index = children.pop(pid, None)
+            if index is None or stopping:
+                continue
+            always_log('worker {0} exited with status {1}, restarting'.format(index, status))
+            time.sleep(1)
+            if not stopping:
+                spawn(index)
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+def main():
+    global args
+    global logger
+    global tc
+
+    args = parse_args()
+
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
     logger = logging.getLogger()
     if args.telemetry:
         pass
@@ -281,12 +1983,10 @@ def main():
     always_log('start server')
     tilesrv_start.inc()
 
-    if connection_pooling:
-        tile_handler = tile_handler_pooling
+    if args.workers > 1:
+        run_workers(args.workers)
     else:
-        tile_handler = tile_handler_no_pooling
-
-    web.run_app(app_factory())
+        web.run_app(app_factory(), port=server_port(args))
 
 if __name__ == '__main__':
     main()
@@ -6,20 +6,25 @@ import argparse
 import asyncio
 import contextlib
 import fcntl
+import gzip
 import hashlib
+import itertools
 import json
 import logging
+import math
 import os
 import subprocess
 import threading
 import time
 import urllib.parse
 import urllib.request
+from collections.abc import Iterable, Iterator
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
 
 import aiopg
+import brotli
 import psycopg2
 import psycopg2.extensions
 from prometheus_client import REGISTRY, Gauge, Histogram, start_http_server
@@ -60,6 +65,12 @@ INGEST_MODE_WEEKLY_PBF = "weekly-pbf"
 INGEST_MODE_IMPOSM_RUN = "imposm-run"
 INGEST_MODES = (INGEST_MODE_WEEKLY_PBF, INGEST_MODE_IMPOSM_RUN)
 IMPORT_STATE_TABLE = "soundscape_osm_import_state"
+# Zoom of the tiles served by gentiles.py, so expire lists name them directly
+EXPIRE_TILES_ZOOM = 16
+MAX_TILE_LAT = 85.0511287798
+RENDER_CONCURRENCY_DEFAULT = 4
+# Tiles rendered by each INSERT of --render-tiles
+RENDER_BATCH_TILES = 64
 
 logger = logging.getLogger(__name__)
 
@@ -108,6 +119,8 @@ class IngestConfig:
     ntfy_server: str
     ntfy_token: str | None
     ntfy_priority: str
+    render_tiles: bool = False
+    render_concurrency: int = RENDER_CONCURRENCY_DEFAULT
 
 
 def build_postgres_dsn(dbname: str) -> str:
@@ -201,6 +214,17 @@ def parse_args(argv=None) -> IngestConfig:
     parser.add_argument("--dsn-init", dest="dsn_init", type=str, help="postgres dsn init", default=None)
     parser.add_argument("--dsn", type=str, help="postgres dsn", default=None)
     parser.add_argument("--verbose", action="store_true", help="verbose")
+    parser.add_argument(
+        "--render-tiles",
+        action="store_true",
+        help="render every tile of the region into soundscape_tiles after each import",
+    )
+    parser.add_argument(
+        "--render-concurrency",
+        type=int,
+        default=RENDER_CONCURRENCY_DEFAULT,
+        help="database connections rendering tiles at once",
+    )
 
     parser.add_argument("--ntfy-topic", default=os.environ.get("NTFY_TOPIC"))
     parser.add_argument("--ntfy-server", default=os.environ.get("NTFY_SERVER", "https://ntfy.sh"))
@@ -216,6 +240,12 @@ def parse_args(argv=None) -> IngestConfig:
         parser.error("--retry-days must be greater than zero")
     if args.pbf_reuse_days <= 0:
         parser.error("--pbf-reuse-days must be greater than zero")
+    if args.render_concurrency <= 0:
+        parser.error("--render-concurrency must be greater than zero")
+    if args.render_tiles and args.ingest_mode == INGEST_MODE_IMPOSM_RUN:
+        parser.error(
+            f"--render-tiles requires --ingest-mode {INGEST_MODE_WEEKLY_PBF}; diffs would leave rendered tiles stale"
+        )
 
     return IngestConfig(
         ingest_mode=args.ingest_mode,
@@ -244,6 +274,8 @@ def parse_args(argv=None) -> IngestConfig:
         ntfy_server=args.ntfy_server,
         ntfy_token=args.ntfy_token,
         ntfy_priority=args.ntfy_priority,
+        render_tiles=args.render_tiles,
+        render_concurrency=args.render_concurrency,
     )
 
 
@@ -546,6 +578,7 @@ def build_imposm_config(config: IngestConfig, extract: dict) -> dict:
         "replication_url": extract["replication_url"],
         "replication_interval": extract.get("replication_interval", "24h"),
         "expiretiles_dir": config.expiredir,
+        "expiretiles_zoom": EXPIRE_TILES_ZOOM,
         "schemas": {
             "import": "import",
             "production": "public",
@@ -697,6 +730,14 @@ async def provision_database_async(osm_dsn: str):
         await provision_non_osm_data_async(osm_dsn)
 
 
+# tilefunc.sql functions rebuilding the tables soundscape_tile reads
+# precomputed features from: (function, table, what a row is)
+DERIVED_TABLE_REFRESHES = (
+    ("soundscape_refresh_intersections", "osm_intersections", "road intersections"),
+    ("soundscape_refresh_entrance_lists", "osm_entrance_lists", "building entrances"),
+)
+
+
 async def provision_database_soundscape_async(osm_dsn: str):
     ingest_path = os.environ["INGEST"]
     async with aiopg.connect(dsn=osm_dsn) as conn:
@@ -705,6 +746,12 @@ async def provision_database_soundscape_async(osm_dsn: str):
             await cursor.execute(sql.read())
         with open(Path(ingest_path) / "tilefunc.sql", encoding="utf8") as sql:
             await cursor.execute(sql.read())
+        # each is a no-op unless an import replaced its source tables since the last build
+        for (refresh, table, rows) in DERIVED_TABLE_REFRESHES:
+            await cursor.execute(f"SELECT {refresh}()")
+            (written,) = await cursor.fetchone()
+            if written is not None:
+                logger.info("Rebuilt %s: %s %s", table, written, rows)
 
 
 def run_async(coro):
@@ -734,6 +781,249 @@ def provision_database_soundscape(config: IngestConfig):
     run_async(provision_database_soundscape_async(config.dsn))
 
 
+# standard tile numbering from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+def tile_for_coords(lat: float, lon: float, zoom: int) -> tuple[int, int]:
+    n = 2**zoom
+    lat_rad = math.radians(max(-MAX_TILE_LAT, min(MAX_TILE_LAT, lat)))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return (min(max(x, 0), n - 1), min(max(y, 0), n - 1))
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """(min_lon, min_lat, max_lon, max_lat) of a tile."""
+    n = 2**zoom
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y))
+
+
+def read_poly(lines) -> list[list[tuple[float, float]]]:
+    """Every ring of an Osmosis polygon filter file, holes included, as
+    (lon, lat) points.  Rings are tested even-odd, so holes need no marking."""
+    rings = []
+    ring = None
+    for line in lines[1:]:
+        line = line.strip()
+        if not line:
+            continue
+        if line == "END":
+            if ring is None:
+                break
+            rings.append(ring)
+            ring = None
+        elif ring is None:
+            ring = []
+        else:
+            lon, lat = line.split()[:2]
+            ring.append((float(lon), float(lat)))
+    return rings
+
+
+def point_in_rings(lon: float, lat: float, rings) -> bool:
+    inside = False
+    for ring in rings:
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+
+def segment_meets_box(start, end, bounds) -> bool:
+    # Liang-Barsky clipping of the segment against the box
+    (min_x, min_y, max_x, max_y) = bounds
+    (x1, y1), (x2, y2) = start, end
+    dx, dy = x2 - x1, y2 - y1
+    low, high = 0.0, 1.0
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1), (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            low = max(low, q / p)
+        else:
+            high = min(high, q / p)
+        if low > high:
+            return False
+    return True
+
+
+def tile_meets_poly(bounds, rings) -> bool:
+    (min_x, min_y, max_x, max_y) = bounds
+    if point_in_rings((min_x + max_x) / 2, (min_y + max_y) / 2, rings):
+        return True
+    return any(
+        segment_meets_box(start, end, bounds) for ring in rings for start, end in zip(ring, ring[1:] + ring[:1])
+    )
+
+
+def usable_bbox(bbox) -> bool:
+    if not bbox or len(bbox) != 4:
+        return False
+    (min_lat, min_lon, max_lat, max_lon) = bbox
+    return min_lat < max_lat and min_lon < max_lon
+
+
+def extract_tiles(config: IngestConfig, extract: dict, zoom: int) -> Iterator[tuple[int, int]]:
+    """(x, y) of the tiles covering the extract's bbox, [min_lat, min_lon,
+    max_lat, max_lon], or, when the extract names a .poly file relative to
+    the extracts file, only those meeting the polygon.  Extracts such as
+    world list a [0, 0, 0, 0] bbox; the polygon's bounds stand in for it,
+    and without a polygon there is nothing to tell the tiles by."""
+    rings = None
+    if extract.get("poly"):
+        with open(Path(config.extracts).parent / extract["poly"], encoding="utf8") as poly:
+            rings = read_poly(poly.read().splitlines())
+    bbox = extract.get("bbox")
+    if not usable_bbox(bbox):
+        points = [point for ring in rings or [] for point in ring]
+        if not points:
+            raise ValueError(f"extract {extract['name']} has no usable bbox or poly to render tiles for")
+        bbox = [
+            min(lat for (_, lat) in points),
+            min(lon for (lon, _) in points),
+            max(lat for (_, lat) in points),
+            max(lon for (lon, _) in points),
+        ]
+    return cover_tiles(bbox, rings, zoom)
+
+
+def cover_tiles(bbox, rings, zoom: int) -> Iterator[tuple[int, int]]:
+    """The tiles of extract_tiles one at a time; a state holds millions."""
+    (min_lat, min_lon, max_lat, max_lon) = bbox
+    (x_lo, y_lo) = tile_for_coords(max_lat, min_lon, zoom)
+    (x_hi, y_hi) = tile_for_coords(min_lat, max_lon, zoom)
+    for x in range(x_lo, x_hi + 1):
+        for y in range(y_lo, y_hi + 1):
+            if rings is None or tile_meets_poly(tile_bounds(zoom, x, y), rings):
+                yield (x, y)
+
+
+def tile_batches(tiles: Iterable[tuple[int, int]], size: int) -> Iterator[list[tuple[int, int]]]:
+    tiles = iter(tiles)
+    while batch := list(itertools.islice(tiles, size)):
+        yield batch
+
+
+# Same data generation as gentiles.py reads: the oid of osm_roads, which
+# changes when an import rotates new tables into production, or 0 until
+# the derived tables are rebuilt from them
+TILE_GENERATION_QUERY = "SELECT soundscape_tile_generation()"
+
+# Tiles without features, most of a bbox over sea or countryside, are not
+# stored; gentiles.py generates them, which costs no more than the lookup
+RENDER_TILES_QUERY = """
+    SELECT x, y, body
+      FROM (SELECT x, y, convert_to(soundscape_tile_json(%(zoom)s, x, y), 'UTF8') AS body
+              FROM unnest(%(xs)s::int[], %(ys)s::int[]) AS tiles(x, y)) AS rendered
+     WHERE body != convert_to('{"features": [], "type": "FeatureCollection"}', 'UTF8')
+"""
+
+STORE_TILES_QUERY = """
+    INSERT INTO soundscape_tiles_build (z, x, y, body, gzip, brotli, etag, generation)
+    SELECT %(zoom)s, x, y, body, gzip, brotli, etag, %(generation)s
+      FROM unnest(%(xs)s::int[], %(ys)s::int[], %(bodies)s::bytea[], %(gzips)s::bytea[],
+                  %(brotlis)s::bytea[], %(etags)s::text[]) AS tiles(x, y, body, gzip, brotli, etag)
+"""
+
+# Compressed as gentiles.py compresses tiles, so a rendered tile is served
+# without hashing or compressing it again
+RENDER_GZIP_LEVEL = 6
+RENDER_BROTLI_QUALITY = 6
+
+
+def compress_rendered_tile(body: bytes) -> tuple[bytes | None, bytes | None, str]:
+    """(gzip, brotli, etag) of a rendered tile; a compressed form no smaller
+    than the body is left out, as gentiles.py leaves it out."""
+    gzipped = gzip.compress(body, compresslevel=RENDER_GZIP_LEVEL, mtime=0)
+    brotlied = brotli.compress(body, quality=RENDER_BROTLI_QUALITY)
+    return (
+        gzipped if len(gzipped) < len(body) else None,
+        brotlied if len(brotlied) < len(body) else None,
+        hashlib.sha256(body).hexdigest()[:32],
+    )
+
+
+def compress_rendered_tiles(rows) -> dict:
+    compressed = [compress_rendered_tile(bytes(body)) for (_, _, body) in rows]
+    return {
+        "xs": [x for (x, _, _) in rows],
+        "ys": [y for (_, y, _) in rows],
+        "bodies": [bytes(body) for (_, _, body) in rows],
+        "gzips": [gzipped for (gzipped, _, _) in compressed],
+        "brotlis": [brotlied for (_, brotlied, _) in compressed],
+        "etags": [etag for (_, _, etag) in compressed],
+    }
+
+
+async def render_tiles_async(osm_dsn: str, zoom: int, tiles: Iterable[tuple[int, int]], concurrency: int) -> int | None:
+    """Render the tiles into a new table and swap it in for soundscape_tiles
+    in one transaction, returning the tiles stored, or None when the tiles
+    of the current generation were rendered already."""
+    async with aiopg.connect(dsn=osm_dsn) as conn:
+        cursor = await conn.cursor()
+        await cursor.execute(TILE_GENERATION_QUERY)
+        (generation,) = await cursor.fetchone()
+        if generation == 0:
+            raise RuntimeError("derived tables are not built from the tables in production")
+        await cursor.execute("SELECT EXISTS (SELECT 1 FROM soundscape_tiles WHERE generation = %s)", (generation,))
+        (rendered,) = await cursor.fetchone()
+        if rendered:
+            return None
+        await cursor.execute(
+            "DROP TABLE IF EXISTS soundscape_tiles_build; CREATE TABLE soundscape_tiles_build (LIKE soundscape_tiles)"
+        )
+        # shared by the renderers, each taking the next batch as it is done
+        batches = tile_batches(tiles, RENDER_BATCH_TILES)
+        stored = 0
+
+        async def render_batches():
+            nonlocal stored
+            loop = asyncio.get_running_loop()
+            async with aiopg.connect(dsn=osm_dsn) as render_conn:
+                render_cursor = await render_conn.cursor()
+                for batch in batches:
+                    params = {"zoom": zoom, "xs": [x for (x, _) in batch], "ys": [y for (_, y) in batch]}
+                    await render_cursor.execute(RENDER_TILES_QUERY, params)
+                    rows = await render_cursor.fetchall()
+                    if not rows:
+                        continue
+                    columns = await loop.run_in_executor(None, compress_rendered_tiles, rows)
+                    await render_cursor.execute(STORE_TILES_QUERY, {"zoom": zoom, "generation": generation, **columns})
+                    stored += len(rows)
+
+        await asyncio.gather(*[render_batches() for _ in range(concurrency)])
+        await cursor.execute("ALTER TABLE soundscape_tiles_build ADD PRIMARY KEY (z, x, y)")
+        # gentiles.py reads the old table or the new one, never a part of either
+        await cursor.execute(
+            """
+            BEGIN;
+            DROP TABLE soundscape_tiles;
+            ALTER TABLE soundscape_tiles_build RENAME TO soundscape_tiles;
+            ALTER INDEX soundscape_tiles_build_pkey RENAME TO soundscape_tiles_pkey;
+            COMMIT;
+            """
+        )
+        await cursor.execute("ANALYZE soundscape_tiles")
+    return stored
+
+
+def render_tiles(config: IngestConfig, extract: dict):
+    logger.info("Rendering tiles: START")
+    start = datetime.now(timezone.utc)
+    tiles = extract_tiles(config, extract, EXPIRE_TILES_ZOOM)
+    rendered = run_async(render_tiles_async(config.dsn, EXPIRE_TILES_ZOOM, tiles, config.render_concurrency))
+    if rendered is None:
+        logger.info("Tiles of the current data generation are already rendered")
+    else:
+        logger.info("Rendered %s tiles with features of %s", rendered, extract["name"])
+    end = datetime.now(timezone.utc)
+    telemetry_log(config, "render_tiles", start, end)
+    logger.info("Rendering tiles: DONE")
+
+
 def ensure_import_state_table(cursor):
     cursor.execute(
         f"""
@@ -956,6 +1246,12 @@ def run_weekly_cycle(config: IngestConfig, extract: dict) -> bool:
             except Exception as exc:
                 raise DbIngestError(str(exc)) from exc
 
+        if config.render_tiles:
+            try:
+                render_tiles(config, extract)
+            except Exception as exc:
+                raise DbIngestError(str(exc)) from exc
+
     end = datetime.now(timezone.utc)
     telemetry_log(config, "ingest_cycle", start, end)
     return True
@@ -0,0 +1,159 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Profile the branches of soundscape_tile against a PostGIS database
+# provisioned by ingest.py.  Tiles are read as "x,y,z" lines, the output
+# format of enumerate_tiles.py, and every branch of the tile query runs on
+# its own under EXPLAIN (ANALYZE, BUFFERS) for each tile, followed by the
+# whole tile query.  The report ranks the branches by total execution time
+# and lists the slowest tiles with the time of each branch, for example:
+#
+#   python enumerate_tiles.py 16 district-of-columbia.poly | \
+#       python profile_tiles.py --dsn "host=localhost dbname=osm user=postgres password=secret"
+#
+# Blocks "hit" were found in shared buffers, blocks "read" were not; run
+# the same tiles twice to tell a cold cache from a slow plan.
+#
+
+import argparse
+import sys
+
+import psycopg2
+
+from benchmark_tiles import read_tiles
+
+explain_prefix = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+
+# The branches of soundscape_tile in tilefunc.sql, each as it runs inside
+# the tile query; keep them in step with it
+branch_queries = [
+    ('roads', """
+        SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties
+          FROM osm_roads
+         WHERE geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326) and service != 'parking_aisle'
+    """),
+    ('places', """
+        SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties
+          FROM osm_places
+         WHERE geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326) and not (properties ? 'boundary' and properties ? 'historic')
+    """),
+    ('intersections', """
+        SELECT osm_ids, 'highway' as feature_type, 'gd_intersection' as feature_value, geometry, hstore('') as properties
+          FROM osm_intersections WHERE ST_Within(geometry, TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326))
+    """),
+    ('entrance_lists', """
+        SELECT building_osm_id || array_agg(entrance_osm_id ORDER BY entrance_osm_id) as osm_ids, 'gd_entrance_list' as feature_type, 'yes' as feature_value, ST_Collect(geometry ORDER BY entrance_osm_id) as geometry, hstore('') as properties
+          FROM osm_entrance_lists
+         WHERE geometry && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326) AND building_bbox && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326)
+         GROUP BY building_osm_id
+    """),
+    ('non_osm_data', """
+        SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geom as geometry, properties
+          FROM non_osm_data WHERE geom && TileBBox(%(zoom)s, %(tile_x)s, %(tile_y)s, 4326)
+    """),
+]
+
+# the whole tile, including the union, GeoJSON encoding and ordering the
+# branches leave out
+tile_branch = 'tile'
+tile_query = """
+    SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
+"""
+
+# {time, rows, hit, read} from EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)
+# output; the top plan node's buffer counts include its children's
+def plan_stats(explain):
+    (result,) = explain
+    plan = result['Plan']
+    return {
+        'time': result['Execution Time'] / 1000,
+        'rows': plan['Actual Rows'] * plan.get('Actual Loops', 1),
+        'hit': plan.get('Shared Hit Blocks', 0),
+        'read': plan.get('Shared Read Blocks', 0),
+    }
+
+def explain_query(cursor, query, params):
+    cursor.execute(explain_prefix + query, params)
+    (explain,) = cursor.fetchone()
+    return plan_stats(explain)
+
+# {branch: stats} for one tile, the whole tile query last
+def profile_tile(cursor, zoom, x, y):
+    params = {'zoom': zoom, 'tile_x': x, 'tile_y': y}
+    profile = {}
+    for name, query in branch_queries + [(tile_branch, tile_query)]:
+        profile[name] = explain_query(cursor, query, params)
+    return profile
+
+def branch_names():
+    return [name for name, _ in branch_queries] + [tile_branch]
+
+# per branch totals over all tiles, the slowest branch first
+def summarize(profiles):
+    totals = []
+    for name in branch_names():
+        stats = [profile[name] for _, profile in profiles]
+        totals.append({
+            'branch': name,
+            'time': sum(s['time'] for s in stats),
+            'max': max(s['time'] for s in stats),
+            'rows': sum(s['rows'] for s in stats),
+            'hit': sum(s['hit'] for s in stats),
+            'read': sum(s['read'] for s in stats),
+        })
+    branches = sorted([t for t in totals if t['branch'] != tile_branch], key=lambda t: t['time'], reverse=True)
+    return branches + [t for t in totals if t['branch'] == tile_branch]
+
+def hit_percent(hit, read):
+    if hit + read == 0:
+        return 100.0
+    return hit * 100.0 / (hit + read)
+
+def report(profiles, top):
+    count = len(profiles)
+    lines = ['{0} tiles'.format(count), '',
+             '{0:<16} {1:>10} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10} {7:>10} {8:>6}'.format(
+                 'branch', 'total ms', 'share', 'mean ms', 'max ms', 'rows', 'hit', 'read', 'hit %')]
+    totals = summarize(profiles)
+    tile_time = totals[-1]['time']
+    for t in totals:
+        share = t['time'] / tile_time * 100 if tile_time else 0.0
+        lines.append('{0:<16} {1:>10.2f} {2:>8.1f}% {3:>9.2f} {4:>9.2f} {5:>10} {6:>10} {7:>10} {8:>6.1f}'.format(
+            t['branch'], t['time'] * 1000, share, t['time'] * 1000 / count, t['max'] * 1000,
+            t['rows'], t['hit'], t['read'], hit_percent(t['hit'], t['read'])))
+
+    names = branch_names()
+    slowest = sorted(profiles, key=lambda p: p[1][tile_branch]['time'], reverse=True)[:top]
+    lines += ['', 'slowest {0} tiles, ms'.format(len(slowest)),
+              ' '.join(['{0:<18}'.format('tile')] + ['{0:>14}'.format(name) for name in names])]
+    for (zoom, x, y), profile in slowest:
+        lines.append(' '.join(['{0:<18}'.format('{0}/{1}/{2}'.format(zoom, x, y))] +
+                              ['{0:>14.2f}'.format(profile[name]['time'] * 1000) for name in names]))
+    return '\n'.join(lines)
+
+def run_profile(dsn, tiles):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            return [((zoom, x, y), profile_tile(cursor, zoom, x, y)) for (zoom, x, y) in tiles]
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='per branch tile query profile for Soundscape')
+    parser.add_argument('tiles', nargs='?', type=argparse.FileType('r'), default=sys.stdin, help='file of x,y,z tile lines')
+    parser.add_argument('--dsn', type=str, help='specify dsn', default='dbname=osm')
+    parser.add_argument('--top', type=int, default=10, help='slowest tiles to list')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help='report file, stdout by default')
+    args = parser.parse_args()
+
+    tiles = read_tiles(args.tiles)
+    if not tiles:
+        parser.error('no tiles to profile')
+    if args.top < 0:
+        parser.error('--top must not be negative')
+    args.output.write(report(run_profile(args.dsn, tiles), args.top) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Golden files under tests/golden/ hold tile features (<case>.features.json)
+# and the bytes json.dumps(tile, sort_keys=True) produced for them
+# (<case>.json) before the serializers were made pluggable.  Every
+# serializer must reproduce those bytes exactly.
+
+import importlib.util
+import json
+import random
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+import pytest
+
+
+DATA_DIR = Path(__file__).resolve().parents[1]
+GOLDEN_DIR = Path(__file__).resolve().parent / "golden"
+GOLDEN_CASES = sorted(path.name[: -len(".features.json")] for path in GOLDEN_DIR.glob("*.features.json"))
+
+if str(DATA_DIR) not in sys.path:
+    sys.path.insert(0, str(DATA_DIR))
+
+import canonical_json  # noqa: E402
+
+
+def load_golden(case):
+    features = json.loads((GOLDEN_DIR / "{0}.features.json".format(case)).read_text(encoding="utf8"))
+    expected = (GOLDEN_DIR / "{0}.json".format(case)).read_bytes()
+    return features, expected
+
+
+def load_make_static_tiles():
+    path = DATA_DIR / "utilities" / "make_static_tiles.py"
+    spec = importlib.util.spec_from_file_location("make_static_tiles_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_golden_cases_are_present():
+    assert set(GOLDEN_CASES) >= {"empty", "floats", "geometries", "nested_properties", "unicode"}
+
+
+@pytest.mark.parametrize("case", GOLDEN_CASES)
+def test_golden_files_match_json_dumps(case):
+    features, expected = load_golden(case)
+
+    assert json.dumps({"type": "FeatureCollection", "features": features}, sort_keys=True).encode("utf8") == expected
+
+
+@pytest.mark.parametrize("serializer", sorted(canonical_json.serializers))
+@pytest.mark.parametrize("case", GOLDEN_CASES)
+def test_serializers_reproduce_golden_bytes(case, serializer):
+    features, expected = load_golden(case)
+
+    assert canonical_json.serializers[serializer](features).encode("utf8") == expected
+
+
+@pytest.mark.parametrize("case", GOLDEN_CASES)
+def test_fast_serializer_without_orjson_reproduces_golden_bytes(monkeypatch, case):
+    monkeypatch.setattr(canonical_json, "orjson", None)
+    features, expected = load_golden(case)
+
+    assert canonical_json.serialize_tile_fast(features).encode("utf8") == expected
+
+
+def random_number(rng):
+    choice = rng.random()
+    if choice < 0.4:
+        return round(rng.uniform(-180, 180), rng.randint(0, 9))
+    if choice < 0.6:
+        return rng.uniform(-1, 1) * 10 ** rng.randint(-30, 30)
+    if choice < 0.8:
+        return rng.randint(-(2 ** 70), 2 ** 70)
+    return rng.choice([0.0, -0.0, 1e-4, 1e-5, 1e15, 1e16, 5e-324, 1.7976931348623157e308, float("nan"), float("inf"), True, None])
+
+
+def test_fast_serializer_matches_json_dumps_on_random_coordinates():
+    rng = random.Random(20240611)
+    for _ in range(2000):
+        coordinates = [[random_number(rng), random_number(rng)] for _ in range(rng.randint(0, 4))]
+        features = [{
+            "type": "Feature",
+            "osm_ids": [rng.randint(1, 2 ** 40)],
+            "feature_type": "highway",
+            "feature_value": "footway",
+            "geometry": {"type": "LineString", "coordinates": coordinates},
+            "properties": {"ele": random_number(rng)},
+        }]
+
+        assert canonical_json.serialize_tile_fast(features) == canonical_json.serialize_tile_json(features)
+
+
+def test_make_static_tiles_uses_canonical_serializer():
+    make_static_tiles = load_make_static_tiles()
+    features, expected = load_golden("unicode")
+    Row = namedtuple("Row", "type osm_ids feature_type feature_value geometry properties")
+
+    class Cursor:
+        def execute(self, query, params):
+            self.params = params
+
+        def fetchall(self):
+            return [Row(**feature) for feature in features]
+
+    for serializer in canonical_json.serializers:
+        assert make_static_tiles.tile(Cursor(), 1, 2, 16, serializer).encode("utf8") == expected
@@ -0,0 +1,1696 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+
+import asyncio
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import sys
+import warnings
+from collections import namedtuple
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiohttp
+import psycopg2
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+
+GENTILES_PATH = Path(__file__).resolve().parents[1] / "gentiles.py"
+DATA_DIR = GENTILES_PATH.parent
+
+TileRow = namedtuple("TileRow", "type osm_ids feature_type feature_value geometry properties")
+
+
+def load_gentiles(module_name="gentiles_under_test"):
+    if str(DATA_DIR) not in sys.path:
+        sys.path.insert(0, str(DATA_DIR))
+    spec = importlib.util.spec_from_file_location(module_name, GENTILES_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def import_data_module(name):
+    if str(DATA_DIR) not in sys.path:
+        sys.path.insert(0, str(DATA_DIR))
+    return importlib.import_module(name)
+
+
+def tile_row(osm_id, lon=-77.0365, lat=38.8977, **properties):
+    return TileRow(
+        "Feature",
+        [osm_id],
+        "amenity",
+        "cafe",
+        {"type": "Point", "coordinates": [lon, lat]},
+        properties,
+    )
+
+
+class FakeTileDatabase:
+    def __init__(self, tiles=None):
+        self.tiles = tiles or {}
+        self.queries = []
+        self.statements = []
+        self.gate = None
+        self.generation = 1
+        self.sequence = 0
+        self.down = False
+        self.cursor_rows = []
+        self.materialized = {}
+        self.lookups = []
+
+    def rows(self, params):
+        return self.tiles.get((params["tile_x"], params["tile_y"]), [])
+
+    def json_tile(self, params):
+        features = [row._asdict() for row in self.rows(params)]
+        return json.dumps({"type": "FeatureCollection", "features": features}, sort_keys=True).encode("utf8")
+
+
+class FakeTileCursor:
+    def __init__(self, db):
+        self.db = db
+        self.result = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def execute(self, sql, params=None):
+        if self.db.down:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if params is None:
+            self.db.statements.append(" ".join(sql.split()))
+            if "soundscape_tile_generation" in sql:
+                self.result = [(self.db.generation,)]
+            elif "soundscape_osm_import_state" in sql:
+                self.result = [(self.db.sequence,)]
+            elif sql.startswith("FETCH"):
+                count = int(sql.split()[1])
+                (self.result, self.db.cursor_rows) = (self.db.cursor_rows[:count], self.db.cursor_rows[count:])
+        elif "soundscape_materialized_tile_entry" in sql:
+            self.db.lookups.append((params["tile_x"], params["tile_y"]))
+            tile = self.db.materialized.get((params["tile_x"], params["tile_y"]))
+            self.result = [tile if tile is None else (memoryview(tile[0]),) + tile[1:]]
+        else:
+            self.db.queries.append(params)
+            if self.db.gate is not None:
+                await self.db.gate.wait()
+            if "DECLARE" in sql:
+                self.db.cursor_rows = list(self.db.rows(params))
+            elif "soundscape_tile_json" in sql:
+                self.result = [(memoryview(self.db.json_tile(params)),)]
+            else:
+                self.result = self.db.rows(params)
+
+    async def fetchall(self):
+        return self.result
+
+    async def fetchone(self):
+        return self.result[0]
+
+
+class FakeTileConnection:
+    def __init__(self, db, on_connect=None):
+        self.db = db
+        self.on_connect = on_connect
+
+    async def __aenter__(self):
+        if self.on_connect is not None:
+            await self.on_connect(self)
+            self.on_connect = None
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def cursor(self, cursor_factory=None):
+        return FakeTileCursor(self.db)
+
+
+class FakePool:
+    minsize = 0
+    size = 1
+    freesize = 1
+    maxsize = 10
+
+    def __init__(self, db, on_connect=None):
+        self.db = db
+        self.connection = FakeTileConnection(db, on_connect)
+
+    def acquire(self):
+        return self.connection
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeAsyncpgConnection:
+    def __init__(self, db):
+        self.db = db
+        self.codecs = []
+
+    async def set_type_codec(self, name, **kwargs):
+        self.codecs.append(name)
+
+    def params(self, zoom, x, y):
+        return {"zoom": zoom, "tile_x": x, "tile_y": y}
+
+    async def fetch(self, sql, zoom, x, y):
+        self.db.queries.append(self.params(zoom, x, y))
+        return [row._asdict() for row in self.db.rows(self.params(zoom, x, y))]
+
+    def transaction(self):
+        db = self.db
+
+        class Transaction:
+            async def __aenter__(self):
+                db.statements.append("BEGIN")
+
+            async def __aexit__(self, exc_type, exc, tb):
+                db.statements.append("COMMIT")
+
+        return Transaction()
+
+    async def cursor(self, sql, zoom, x, y):
+        rows = await self.fetch(sql, zoom, x, y)
+        db = self.db
+
+        class Cursor:
+            async def fetch(self, count):
+                nonlocal rows
+                db.statements.append("FETCH {0}".format(count))
+                (chunk, rows) = (rows[:count], rows[count:])
+                return chunk
+
+        return Cursor()
+
+    async def fetchrow(self, sql, zoom, x, y):
+        assert "soundscape_tile_materialized" in sql
+        self.db.lookups.append((x, y))
+        return self.db.materialized.get((x, y))
+
+    async def fetchval(self, sql, *args):
+        if not args:
+            return self.db.generation
+        (zoom, x, y) = args
+        self.db.queries.append(self.params(zoom, x, y))
+        return self.db.json_tile(self.params(zoom, x, y))
+
+
+class FakeAsyncpgPool:
+    def __init__(self, db, init, kwargs):
+        self.connection = FakeAsyncpgConnection(db)
+        self.init = init
+        self.kwargs = kwargs
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                if pool.init is not None:
+                    await pool.init(pool.connection)
+                    pool.init = None
+                return pool.connection
+
+            async def __aexit__(self, exc_type, exc, tb):
+                pass
+
+        return Acquire()
+
+    def get_min_size(self):
+        return 0
+
+    def get_size(self):
+        return 1
+
+    def get_max_size(self):
+        return self.kwargs["max_size"]
+
+    def get_idle_size(self):
+        return 1
+
+    async def close(self):
+        pass
+
+
+def fake_asyncpg_module(db, pools):
+    async def create_pool(init=None, **kwargs):
+        pool = FakeAsyncpgPool(db, init, kwargs)
+        pools.append(pool)
+        return pool
+
+    return SimpleNamespace(create_pool=create_pool)
+
+
+# db is a FakeTileDatabase, or a dict of them by dsn
+def run_with_client(gentiles, monkeypatch, db, scenario, argv=(), app_kwargs=None, **client_kwargs):
+    async def create_pool(dsn, on_connect=None, **kwargs):
+        return FakePool(db[dsn] if isinstance(db, dict) else db, on_connect)
+
+    monkeypatch.setattr(gentiles.aiopg, "create_pool", create_pool)
+    gentiles.args = gentiles.parse_args(list(argv))
+    gentiles.logger = logging.getLogger()
+
+    async def run():
+        app = await gentiles.app_factory(**(app_kwargs or {}))
+        async with TestClient(TestServer(app), **client_kwargs) as client:
+            return await scenario(client)
+
+    return asyncio.run(run())
+
+
+def test_import_is_safe(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["gentiles.py", "--invalid-argument"])
+
+    load_gentiles("gentiles_import_safe")
+
+
+def test_tile_cache_evicts_least_recently_used_by_bytes():
+    from tile_cache import TileCache
+
+    cache = TileCache(max_bytes=10)
+    assert cache.put("a", b"aaaa", 4) == 0
+    assert cache.put("b", b"bbbb", 4) == 0
+    assert cache.get("a") == b"aaaa"
+
+    assert cache.put("c", b"cccc", 4) == 1
+    assert "b" not in cache
+    assert cache.keys() == ["a", "c"]
+    assert cache.size == 8
+
+    assert cache.put("huge", b"x" * 11, 11) == 0
+    assert "huge" not in cache
+    assert cache.size == 8
+
+
+def test_tile_cache_expires_entries_after_ttl():
+    from tile_cache import TileCache
+
+    now = [100.0]
+    cache = TileCache(max_bytes=100, ttl=10, clock=lambda: now[0])
+    cache.put("a", b"aaaa", 4)
+
+    now[0] = 109.0
+    assert cache.get("a") == b"aaaa"
+    now[0] = 110.0
+    assert cache.get("a") is None
+    assert cache.size == 0
+    assert len(cache) == 0
+
+
+def test_repeated_tile_requests_are_served_from_cache(monkeypatch):
+    gentiles = load_gentiles("gentiles_cache_hits")
+    db = FakeTileDatabase({(18745, 25070): [tile_row(1, name="Cafe")]})
+
+    async def scenario(client):
+        first = await client.get("/16/18745/25070.json")
+        second = await client.get("/tiles/16/18745/25070.json")
+        metrics = await client.get("/metrics")
+        return first.status, await first.text(), second.status, await second.text(), await metrics.text()
+
+    first_status, first_body, second_status, second_body, metrics = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert first_status == 200
+    assert second_status == 200
+    assert first_body == second_body
+    assert json.loads(first_body)["features"][0]["properties"] == {"name": "Cafe"}
+    assert len(db.queries) == 1
+    assert "tile_cache_hit_count 1\n" in metrics
+    assert "tile_cache_miss_count 1\n" in metrics
+    cached_size = gentiles.tile_entry_size(gentiles.compress_tile(first_body.encode("utf8")))
+    assert "tile_cache_bytes {0}\n".format(cached_size) in metrics
+
+
+def test_cache_size_zero_disables_caching(monkeypatch):
+    gentiles = load_gentiles("gentiles_cache_disabled")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    async def scenario(client):
+        for _ in range(2):
+            response = await client.get("/16/1/2.json")
+            assert response.status == 200
+
+    run_with_client(gentiles, monkeypatch, db, scenario, ["--cache-size", "0"])
+
+    assert len(db.queries) == 2
+
+
+def test_statement_timeout_and_prepare_run_once_per_connection(monkeypatch):
+    gentiles = load_gentiles("gentiles_prepared")
+    db = FakeTileDatabase({(x, 2): [tile_row(x)] for x in range(3)})
+
+    async def scenario(client):
+        for x in range(3):
+            response = await client.get("/16/{0}/2.json".format(x))
+            assert response.status == 200
+
+    run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert len(db.queries) == 3
+    # besides the data generation poll
+    assert db.statements[1:] == ["SELECT soundscape_tile_generation()"]
+    assert db.statements[0].startswith("set statement_timeout=2000;")
+    assert "PREPARE soundscape_tile_rows (int, int, int)" in db.statements[0]
+    assert "soundscape_tile_json_bytes" not in db.statements[0]
+
+
+def write_expire_file(directory, day, name, lines):
+    path = directory / day / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n".join(lines) + "\n", encoding="utf8")
+    return path
+
+
+def test_expire_watcher_reads_only_new_files_and_maps_to_tile_zoom(tmp_path):
+    from expire_tiles import ExpireTileWatcher
+
+    write_expire_file(tmp_path, "20260101", "010000.000.tiles", ["16/1/1"])
+    watcher = ExpireTileWatcher(tmp_path, 16)
+    watcher.skip_existing()
+    assert watcher.poll() == set()
+
+    write_expire_file(tmp_path, "20260101", "020000.000.tiles", ["16/10/20", "not/a/tile", ""])
+    write_expire_file(tmp_path, "20260102", "000000.000.tiles", ["15/3/4", "17/9/9"])
+
+    assert watcher.poll() == {
+        (16, 10, 20),
+        (16, 6, 8),
+        (16, 6, 9),
+        (16, 7, 8),
+        (16, 7, 9),
+        (16, 4, 4),
+    }
+    assert watcher.files_processed == 2
+    assert watcher.last == "20260102/000000.000.tiles"
+    assert watcher.poll() == set()
+
+
+def test_expired_tiles_are_dropped_from_cache(monkeypatch):
+    gentiles = load_gentiles("gentiles_expire_invalidation")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)], (3, 4): [tile_row(2)]})
+
+    async def scenario(client):
+        await client.get("/16/1/2.json")
+        await client.get("/16/3/4.json")
+        assert gentiles.invalidate_tiles(client.app, {(16, 1, 2), (16, 9, 9)}) == 1
+        await client.get("/16/1/2.json")
+        await client.get("/16/3/4.json")
+
+    run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert [(query["tile_x"], query["tile_y"]) for query in db.queries] == [(1, 2), (3, 4), (1, 2)]
+    assert gentiles.tile_cache_expired.value == 1
+
+
+def test_accept_encoding_negotiation_prefers_smallest_accepted_form():
+    gentiles = load_gentiles("gentiles_encoding_choice")
+    entry = gentiles.TileEntry(b"raw", b"gz", b"br", "tag")
+
+    assert gentiles.choose_encoding(entry, "") == (None, b"raw")
+    assert gentiles.choose_encoding(entry, "gzip, deflate") == ("gzip", b"gz")
+    assert gentiles.choose_encoding(entry, "gzip, deflate, br") == ("br", b"br")
+    assert gentiles.choose_encoding(entry, "br;q=0, gzip;q=0.5") == ("gzip", b"gz")
+    assert gentiles.choose_encoding(entry, "*") == ("br", b"br")
+    assert gentiles.choose_encoding(gentiles.TileEntry(b"raw", None, None, "tag"), "gzip, br") == (None, b"raw")
+    assert gentiles.choose_encoding(entry, "br;q=0.1, gzip;q=1") == ("gzip", b"gz")
+    assert gentiles.choose_encoding(entry, "br;q=0.1, gzip;q=0.1") == ("br", b"br")
+    assert gentiles.choose_encoding(entry, "br;q=0.5, identity") == (None, b"raw")
+    assert gentiles.choose_encoding(entry, "deflate, identity;q=0") == (None, None)
+    assert gentiles.choose_encoding(gentiles.TileEntry(b"raw", None, None, "tag"), "gzip, identity;q=0") == (None, None)
+    assert gentiles.choose_encoding(gentiles.TileEntry(b"raw", None, None, "tag"), "*;q=0") == (None, None)
+
+
+def test_tiles_are_compressed_once_and_served_per_accept_encoding(monkeypatch):
+    gentiles = load_gentiles("gentiles_precompressed")
+    db = FakeTileDatabase({(1, 2): [tile_row(osm_id, name="Cafe {0}".format(osm_id)) for osm_id in range(20)]})
+    compressions = []
+    real_compress = gentiles.gzip.compress
+
+    def counting_compress(data, **kwargs):
+        compressions.append(len(data))
+        return real_compress(data, **kwargs)
+
+    monkeypatch.setattr(gentiles.gzip, "compress", counting_compress)
+
+    async def scenario(client):
+        results = []
+        for accept in ("gzip", "gzip", "identity"):
+            response = await client.get("/16/1/2.json", headers={"Accept-Encoding": accept})
+            results.append((response.headers.get("Content-Encoding"), response.headers["Vary"], await response.read()))
+        refused = await client.get("/16/1/2.json", headers={"Accept-Encoding": "deflate, identity;q=0"})
+        results.append(refused.status)
+        return results
+
+    gzipped, gzipped_again, identity, refused = run_with_client(gentiles, monkeypatch, db, scenario, auto_decompress=False)
+
+    assert len(compressions) == 1
+    assert gzipped == gzipped_again
+    assert gzipped[0] == "gzip"
+    assert gzipped[1] == "Accept-Encoding"
+    assert identity[0] is None
+    assert gzip.decompress(gzipped[2]) == identity[2]
+    assert json.loads(identity[2])["features"][19]["properties"] == {"name": "Cafe 19"}
+    assert refused == 406
+
+
+def test_if_none_match_is_answered_with_304_from_stored_etag(monkeypatch):
+    gentiles = load_gentiles("gentiles_etag")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    async def scenario(client):
+        first = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        etag = first.headers["ETag"]
+        body = await first.read()
+        revalidated = await client.get(
+            "/16/1/2.json",
+            headers={"Accept-Encoding": "identity", "If-None-Match": 'W/"other", ' + etag},
+        )
+        gzip_variant = await client.get(
+            "/16/1/2.json",
+            headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+        )
+        return etag, body, revalidated.status, revalidated.headers["ETag"], await revalidated.read(), gzip_variant
+
+    etag, body, status, revalidated_etag, revalidated_body, gzip_variant = run_with_client(
+        gentiles, monkeypatch, db, scenario, auto_decompress=False
+    )
+
+    assert etag == '"{0}"'.format(gentiles.tile_etag(body))
+    assert status == 304
+    assert revalidated_etag == etag
+    assert revalidated_body == b""
+    assert gzip_variant.status == 200
+    assert gzip_variant.headers["ETag"] == '"{0}-gzip"'.format(gentiles.tile_etag(body))
+    assert len(db.queries) == 1
+    assert gentiles.tile_not_modified.value == 1
+
+
+def test_concurrent_identical_requests_share_one_query(monkeypatch):
+    gentiles = load_gentiles("gentiles_single_flight")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)], (3, 4): [tile_row(2)]})
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        requests = [asyncio.ensure_future(client.get("/16/1/2.json")) for _ in range(5)]
+        requests.append(asyncio.ensure_future(client.get("/16/3/4.json")))
+        while len(db.queries) < 2 or gentiles.tile_inflight_waiters.value < 4:
+            await asyncio.sleep(0.01)
+        waiting = gentiles.tile_inflight_waiters.value
+        db.gate.set()
+        responses = await asyncio.gather(*requests)
+        bodies = [await response.read() for response in responses]
+        return waiting, [response.status for response in responses], bodies
+
+    waiting, statuses, bodies = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert waiting == 4
+    assert statuses == [200] * 6
+    assert len(set(bodies[:5])) == 1
+    assert sorted((query["tile_x"], query["tile_y"]) for query in db.queries) == [(1, 2), (3, 4)]
+    assert gentiles.tile_coalesced.value == 4
+    assert gentiles.tile_inflight_waiters.value == 0
+    assert gentiles.tile_inflight.value == 0
+
+
+def test_db_json_mode_passes_postgis_bytes_through(monkeypatch):
+    gentiles = load_gentiles("gentiles_db_json")
+    db = FakeTileDatabase({(1, 2): [tile_row(1, name="Caf\u00e9")]})
+
+    async def row_serialization(*args, **kwargs):
+        pytest.fail("rows should not be serialized in Python")
+
+    monkeypatch.setattr(gentiles, "gentile_async", row_serialization)
+
+    async def scenario(client):
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        return response.status, await response.read()
+
+    status, body = run_with_client(gentiles, monkeypatch, db, scenario, ["--db-json"])
+
+    assert status == 200
+    assert body == db.json_tile({"tile_x": 1, "tile_y": 2})
+
+
+TEST_DSN = os.environ.get("SOUNDSCAPE_TEST_DSN")
+# Downtown Washington, DC tiles, matching the default docker-compose region
+TEST_TILES = os.environ.get("SOUNDSCAPE_TEST_TILES", "18745,25070 18746,25070 18744,25071 18747,25069")
+
+
+@pytest.mark.skipif(not TEST_DSN, reason="set SOUNDSCAPE_TEST_DSN to a provisioned Soundscape database")
+def test_soundscape_tile_json_matches_python_serialization():
+    import psycopg2
+    from psycopg2.extras import NamedTupleCursor
+
+    conn = psycopg2.connect(TEST_DSN)
+    try:
+        with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            for tile in TEST_TILES.split():
+                x, y = (int(part) for part in tile.split(","))
+                params = {"zoom": 16, "tile_x": x, "tile_y": y}
+                cursor.execute("SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)", params)
+                features = [row._asdict() for row in cursor.fetchall()]
+                expected = json.dumps({"type": "FeatureCollection", "features": features}, sort_keys=True)
+                cursor.execute("SELECT soundscape_tile_json(%(zoom)s, %(tile_x)s, %(tile_y)s) AS tile", params)
+                assert cursor.fetchone().tile == expected
+
+            # jsonb text as PostGIS and hstore_to_jsonb hand it to psycopg2
+            values = [
+                '{"name": "Caf\u00e9 \U0001f600 \\\\ \\"quoted\\" \\t\x7f", "b": "1", "a": "", "\u00e9": "key"}',
+                '{"coordinates": [[-77.036565, 38.8977], [0.00001, -0.5], [12, 1.50], [-0.0, 123456789.123456]]}',
+                '{"type": "MultiPoint", "coordinates": [[-77.1, 38.9], [-77.000001, 38.100001]]}',
+                '{"large": 1234567890123456.5, "coordinates": [[1000000000000000.0, -9999999999999998.0]]}',
+                '{"nested": {"list": [1, "two", null, true, false, {"z": 1, "y": [2.25, 3]}]}}',
+                "[]",
+                "{}",
+            ]
+            for value in values:
+                cursor.execute("SET extra_float_digits = 1")
+                cursor.execute("SELECT %s::jsonb AS value, soundscape_canonical_json(%s::jsonb) AS text", (value, value))
+                row = cursor.fetchone()
+                assert row.text == json.dumps(row.value, sort_keys=True)
+    finally:
+        conn.close()
+
+
+@pytest.mark.skipif(not TEST_DSN, reason="set SOUNDSCAPE_TEST_DSN to a provisioned Soundscape database")
+def test_precomputed_features_match_recomputed_tiles():
+    import psycopg2
+    from psycopg2.extras import NamedTupleCursor
+
+    load_gentiles("gentiles_precomputed")
+    import benchmark_tiles
+
+    def geometry(value):
+        # entrance lists used to collect their points in no particular order
+        if value["type"] == "MultiPoint":
+            value = dict(value, coordinates=sorted(value["coordinates"]))
+        return json.dumps(value, sort_keys=True)
+
+    def features(cursor, sql, params):
+        cursor.execute(sql, params)
+        return sorted((sorted(row.osm_ids), row.feature_type, geometry(row.geometry)) for row in cursor.fetchall())
+
+    conn = psycopg2.connect(TEST_DSN)
+    try:
+        with conn.cursor(cursor_factory=NamedTupleCursor) as cursor:
+            for tile in TEST_TILES.split():
+                x, y = (int(part) for part in tile.split(","))
+                params = {"zoom": 16, "tile_x": x, "tile_y": y}
+                assert features(cursor, "SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)", params) == \
+                    features(cursor, benchmark_tiles.recomputed_tile_query, params)
+    finally:
+        conn.close()
+
+
+def test_benchmark_reads_enumerated_tiles_and_compares_methods():
+    load_gentiles("gentiles_benchmark")
+    import benchmark_tiles
+
+    assert benchmark_tiles.read_tiles(["18745,25070,16\n", "\n", "18746,25070,16\n"]) == [
+        (16, 18745, 25070),
+        (16, 18746, 25070),
+    ]
+
+    baseline = benchmark_tiles.summarize([0.010, 0.020, 0.030, 0.040], 0.1)
+    prepared = benchmark_tiles.summarize([0.005, 0.010, 0.015, 0.020], 0.05)
+    assert baseline["p50"] == 0.020
+    assert baseline["p99"] == 0.040
+
+    output = benchmark_tiles.report([("round-trips", baseline), ("prepared", prepared)])
+    assert "round-trips" in output.splitlines()[1]
+    assert output.splitlines()[-1] == "prepared vs round-trips: p50 -50.0%, p99 -50.0%, throughput +100.0%"
+
+
+class FakeExplainCursor:
+    def __init__(self, times):
+        self.times = times
+        self.executed = []
+
+    def execute(self, sql, params):
+        self.executed.append((" ".join(sql.split()), params))
+
+    def fetchone(self):
+        (sql, params) = self.executed[-1]
+        time = self.times[(params["tile_x"], len(self.executed) - 1)]
+        plan = {"Actual Rows": 3, "Actual Loops": 1, "Shared Hit Blocks": 6, "Shared Read Blocks": 2}
+        return ([{"Plan": plan, "Planning Time": 0.1, "Execution Time": time}],)
+
+
+def test_profiler_explains_each_branch_and_ranks_them():
+    load_gentiles("gentiles_profile")
+    import profile_tiles
+
+    names = profile_tiles.branch_names()
+    assert names == ["roads", "places", "intersections", "entrance_lists", "non_osm_data", "tile"]
+    # ms per (tile x, query index), places slowest and tile x=2 slowest
+    times = {}
+    for x, scale in ((1, 1.0), (2, 3.0)):
+        for index, ms in enumerate([1.0, 4.0, 0.5, 0.25, 0.25, 7.0]):
+            times[(x, index)] = ms * scale
+
+    profiles = []
+    for x in (1, 2):
+        cursor = FakeExplainCursor(times)
+        profiles.append(((16, x, 5), profile_tiles.profile_tile(cursor, 16, x, 5)))
+        assert all(sql.startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT") for sql, _ in cursor.executed)
+        assert cursor.executed[-1][0].endswith("soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)")
+        assert {tuple(params.values()) for _, params in cursor.executed} == {(16, x, 5)}
+
+    assert profiles[0][1]["places"] == {"time": 0.004, "rows": 3, "hit": 6, "read": 2}
+    totals = profile_tiles.summarize(profiles)
+    assert [t["branch"] for t in totals] == ["places", "roads", "intersections", "entrance_lists", "non_osm_data", "tile"]
+    assert totals[0]["hit"] == 12 and totals[0]["read"] == 4
+
+    lines = profile_tiles.report(profiles, 1).splitlines()
+    assert lines[0] == "2 tiles"
+    assert lines[3].split()[:3] == ["places", "16.00", "57.1%"]
+    assert lines[3].split()[-1] == "75.0"
+    assert lines[-1].split()[0] == "16/2/5"
+    assert lines[-1].split()[-1] == "21.00"
+
+
+@pytest.mark.skipif(not TEST_DSN, reason="set SOUNDSCAPE_TEST_DSN to a provisioned Soundscape database")
+def test_profiler_runs_every_branch_against_postgis():
+    load_gentiles("gentiles_profile_postgis")
+    import profile_tiles
+
+    tiles = [(16, int(x), int(y)) for (x, y) in (tile.split(",") for tile in TEST_TILES.split())]
+    profiles = profile_tiles.run_profile(TEST_DSN, tiles)
+
+    assert [tile for tile, _ in profiles] == tiles
+    for _, profile in profiles:
+        assert list(profile) == profile_tiles.branch_names()
+        assert all(stats["time"] > 0 for stats in profile.values())
+
+
+def test_asyncpg_connect_args_translate_libpq_dsn():
+    gentiles = load_gentiles("gentiles_asyncpg_dsn")
+
+    assert gentiles.asyncpg_connect_args("host=postgis port=5432 dbname=osm user=postgres password=secret") == {
+        "host": "postgis",
+        "port": 5432,
+        "database": "osm",
+        "user": "postgres",
+        "password": "secret",
+    }
+    with pytest.raises(ValueError, match="application_name"):
+        gentiles.asyncpg_connect_args("dbname=osm application_name=tiles")
+
+
+def test_asyncpg_engine_produces_identical_tile_bytes(monkeypatch):
+    db = FakeTileDatabase({(1, 2): [tile_row(osm_id, name="Caf\u00e9 {0}".format(osm_id)) for osm_id in range(5)]})
+
+    async def scenario(client):
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        return await response.read()
+
+    aiopg_tile = run_with_client(load_gentiles("gentiles_aiopg_engine"), monkeypatch, db, scenario)
+
+    gentiles = load_gentiles("gentiles_asyncpg_engine")
+    pools = []
+    monkeypatch.setattr(gentiles, "asyncpg", fake_asyncpg_module(db, pools))
+    asyncpg_tile = run_with_client(gentiles, monkeypatch, db, scenario, ["--engine", "asyncpg", "--pool-size", "4"])
+
+    assert asyncpg_tile == aiopg_tile
+    assert pools[0].kwargs["max_size"] == 4
+    assert pools[0].kwargs["server_settings"] == {"statement_timeout": "2000"}
+    assert pools[0].kwargs["database"] == "osm"
+    assert pools[0].connection.codecs == ["jsonb"]
+
+
+def test_serializers_serve_identical_tile_bytes(monkeypatch):
+    db = FakeTileDatabase({(1, 2): [tile_row(osm_id, lon=1e-05 * osm_id, name="Café \U0001F381 {0}".format(osm_id), levels={"b": [1.5, None], "a": True}) for osm_id in range(5)]})
+
+    async def scenario(client):
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        return await response.read()
+
+    tiles = [run_with_client(load_gentiles("gentiles_serializer_" + name), monkeypatch, db, scenario, ["--serializer", name]) for name in ("json", "fast")]
+
+    assert tiles[0] == tiles[1]
+    assert tiles[0] == db.json_tile({"tile_x": 1, "tile_y": 2})
+
+
+def test_batch_streams_requested_tiles_in_order_with_single_tile_bytes(monkeypatch):
+    gentiles = load_gentiles("gentiles_batch")
+    db = FakeTileDatabase({(1, 2): [tile_row(1, name="Café")], (3, 4): [tile_row(2), tile_row(3)]})
+
+    async def scenario(client):
+        batch = await client.get("/tiles/batch?tiles=16/3/4,16/1/2,16/3/4,16/5/6", headers={"Accept-Encoding": "identity"})
+        single = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        return batch.status, batch.headers["Content-Type"], await batch.read(), single.headers["ETag"], await single.read()
+
+    status, content_type, body, etag, single_body = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert status == 200
+    assert content_type == "application/x-ndjson"
+    lines = body.decode("utf8").splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [(record["z"], record["x"], record["y"]) for record in records] == [(16, 3, 4), (16, 1, 2), (16, 5, 6)]
+    assert lines[1].encode("utf8").endswith(b', "tile": ' + single_body + b"}")
+    assert '"{0}"'.format(records[1]["etag"]) == etag
+    assert records[2]["tile"] == {"type": "FeatureCollection", "features": []}
+    assert gentiles.tile_batch_requests.value == 1
+    assert gentiles.tile_batch_tiles.value == 3
+
+
+def test_batch_bounds_concurrent_tile_generation(monkeypatch):
+    gentiles = load_gentiles("gentiles_batch_concurrency")
+    db = FakeTileDatabase({(x, 0): [tile_row(x)] for x in range(6)})
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        request = asyncio.ensure_future(client.get("/batch?tiles=" + ",".join("16/{0}/0".format(x) for x in range(6))))
+        while len(db.queries) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        started = len(db.queries)
+        db.gate.set()
+        response = await request
+        return started, await response.text()
+
+    started, body = run_with_client(gentiles, monkeypatch, db, scenario, ["--batch-concurrency", "2"])
+
+    assert started == 2
+    assert [json.loads(line)["x"] for line in body.splitlines()] == list(range(6))
+
+
+def test_batch_bbox_covers_tile_range(monkeypatch):
+    gentiles = load_gentiles("gentiles_batch_bbox")
+    (north, west) = gentiles.num2deg(18745.5, 25069.5, 16)
+    (south, east) = gentiles.num2deg(18747.5, 25070.5, 16)
+
+    async def scenario(client):
+        response = await client.get("/batch?bbox={0},{1},{2},{3}".format(south, west, north, east))
+        return await response.text()
+
+    body = run_with_client(gentiles, monkeypatch, FakeTileDatabase(), scenario)
+
+    assert [(record["x"], record["y"]) for record in map(json.loads, body.splitlines())] == [
+        (x, y) for y in (25069, 25070) for x in (18745, 18746, 18747)
+    ]
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "tiles=16/1",
+    "tiles=15/1/2",
+    "tiles=16/1/x",
+    "bbox=1,2,3",
+    "bbox=89,0,89.5,1",
+    "bbox=38,-78,39,-77",
+    "tiles=" + ",".join("16/{0}/0".format(x) for x in range(257)),
+])
+def test_batch_rejects_malformed_requests(monkeypatch, query):
+    gentiles = load_gentiles("gentiles_batch_rejects")
+
+    async def scenario(client):
+        response = await client.get("/batch?" + query)
+        return response.status
+
+    assert run_with_client(gentiles, monkeypatch, FakeTileDatabase(), scenario) == 400
+
+
+def test_radius_cover_is_exact_and_nearest_first():
+    gentiles = load_gentiles("gentiles_radius_cover")
+    tile_cover = import_data_module("tile_cover")
+
+    (lat, lon) = (38.8977, -77.0365)
+    tiles = tile_cover.radius_tiles(lat, lon, 400, 16)
+    centre = tile_cover.fractional_tile(lat, lon, 16)
+    reach = 400 / tile_cover.tile_metres(lat, 16)
+    distances = [tile_cover.point_tile_distance(centre, x, y) for (_, x, y) in tiles]
+    nearby = {(16, x, y) for x in range(int(centre[0]) - 3, int(centre[0]) + 4) for y in range(int(centre[1]) - 3, int(centre[1]) + 4)
+              if tile_cover.point_tile_distance(centre, x, y) <= reach}
+
+    assert tiles[0] == (16,) + gentiles.osm_deg2num(lat, lon, 16)
+    assert tile_cover.radius_tiles(lat, lon, 0, 16) == [tiles[0]]
+    assert distances == sorted(distances)
+    assert set(tiles) == nearby
+
+
+def test_route_cover_follows_route_order():
+    tile_cover = import_data_module("tile_cover")
+
+    (north, west) = (38.8977, -77.0365)
+    east = west + 5 * 360.0 / 2 ** 16
+    eastbound = tile_cover.corridor_tiles([(north, west), (north, east)], 0, 16)
+    westbound = tile_cover.corridor_tiles([(north, east), (north, west)], 0, 16)
+
+    assert [x for (_, x, _) in eastbound] == sorted(x for (_, x, _) in eastbound)
+    assert westbound == list(reversed(eastbound))
+    assert len(eastbound) == 6
+    with pytest.raises(tile_cover.TooManyTiles):
+        tile_cover.corridor_tiles([(north, west), (north, west + 2.0)], 0, 16, limit=256)
+
+
+def test_prefetch_streams_radius_and_route_tiles(monkeypatch):
+    gentiles = load_gentiles("gentiles_prefetch")
+    tile_cover = import_data_module("tile_cover")
+
+    (lat, lon) = (38.8977, -77.0365)
+    route = [(lat, lon), (lat + 0.01, lon + 0.01)]
+
+    async def scenario(client):
+        radius = await client.get("/tiles/prefetch?lat={0}&lon={1}&radius=300".format(lat, lon))
+        corridor = await client.get("/prefetch?route={0}&radius=20".format(",".join("{0},{1}".format(*point) for point in route)))
+        return await radius.text(), await corridor.text()
+
+    radius_body, corridor_body = run_with_client(gentiles, monkeypatch, FakeTileDatabase(), scenario)
+
+    def tiles(body):
+        return [(record["z"], record["x"], record["y"]) for record in map(json.loads, body.splitlines())]
+
+    assert tiles(radius_body) == tile_cover.radius_tiles(lat, lon, 300, 16)
+    assert tiles(corridor_body) == tile_cover.corridor_tiles(route, 20, 16)
+    assert gentiles.tile_prefetch_requests.value == 2
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "lat=38.9",
+    "lat=38.9&lon=-77&radius=5000",
+    "lat=38.9&lon=-77&radius=-1",
+    "lat=88&lon=-77",
+    "route=38.9,-77,38.91",
+    "route=38.9,-77,39.9,-76",
+])
+def test_prefetch_rejects_malformed_requests(monkeypatch, query):
+    gentiles = load_gentiles("gentiles_prefetch_rejects")
+
+    async def scenario(client):
+        response = await client.get("/prefetch?" + query)
+        return response.status
+
+    assert run_with_client(gentiles, monkeypatch, FakeTileDatabase(), scenario) == 400
+
+
+def test_worker_pool_sizes_add_up_to_pool_size():
+    gentiles = load_gentiles("gentiles_worker_pools")
+
+    sizes = [gentiles.worker_pool_size(10, gentiles.WorkerInfo(index, 4, None)) for index in range(4)]
+
+    assert sizes == [3, 3, 2, 2]
+    assert gentiles.worker_pool_size(10, None) == 10
+    with pytest.raises(SystemExit):
+        gentiles.parse_args(["--workers", "4", "--pool-size", "2"])
+
+
+def test_worker_metrics_combine_other_workers_snapshots(monkeypatch, tmp_path):
+    gentiles = load_gentiles("gentiles_worker_metrics")
+    other = gentiles.WorkerInfo(1, 2, str(tmp_path))
+    gentiles.tilesrv_start.inc()
+    gentiles.tile_served.inc(3)
+    gentiles.tile_cache_entries.set(5)
+    gentiles.tile_generation.set(16400)
+    gentiles.tile_replicas_healthy.set(2)
+    gentiles.tile_querytime.sample(0.1)
+    gentiles.write_metrics_snapshot(other, gentiles.metrics_snapshot())
+
+    async def scenario(client):
+        response = await client.get("/metrics")
+        return await response.text()
+
+    text = run_with_client(gentiles, monkeypatch, FakeTileDatabase(), scenario, app_kwargs={"worker": gentiles.WorkerInfo(0, 2, str(tmp_path))})
+
+    assert "tilesrv_start_count 1\n" in text
+    assert "tile_served_count 6\n" in text
+    assert "tile_cache_entries 10\n" in text
+    assert "tile_data_generation 16400\n" in text
+    assert "tile_replicas_healthy 2\n" in text
+    assert 'tile_querytime_seconds_bucket{le="0.2"} 2\n' in text
+    assert "tile_querytime_seconds_count 2\n" in text
+    assert (tmp_path / "0.json").exists()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="--workers forks")
+def test_workers_share_port_and_aggregate_metrics(tmp_path):
+    import signal
+    import socket
+    import subprocess
+    import time
+    import urllib.request
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    log = open(tmp_path / "server.log", "w+")
+    server = subprocess.Popen(
+        [sys.executable, str(GENTILES_PATH), "--workers", "2", "--pool-size", "2", "--server", str(port), "--dsn", "host=127.0.0.1 port=9"],
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+
+    def get(path):
+        with urllib.request.urlopen("http://127.0.0.1:{0}{1}".format(port, path), timeout=5) as response:
+            return response.read().decode("utf8")
+
+    try:
+        deadline = time.monotonic() + 20
+        text = ""
+        while "tilesrv_aliveprobe_count 10\n" not in text:
+            assert time.monotonic() < deadline, text
+            try:
+                if "tilesrv_aliveprobe_count" not in text:
+                    for _ in range(10):
+                        get("/probe/alive")
+                text = get("/metrics")
+            except OSError:
+                text = ""
+            time.sleep(0.2)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        returncode = server.wait(timeout=20)
+
+    log.seek(0)
+    output = log.read()
+    assert "tilesrv_start_count 1\n" in text
+    assert returncode == 0
+    assert "worker 0 of 2 started, pool size 1" in output
+    assert "worker 1 of 2 started, pool size 1" in output
+
+
+def test_tile_store_keys_tiles_by_generation_and_expires_them(tmp_path):
+    tile_store = import_data_module("tile_store")
+    now = [1000.0]
+    writer = tile_store.TileStore(tmp_path / "tiles.sqlite", ttl=60, clock=lambda: now[0])
+    reader = tile_store.TileStore(tmp_path / "tiles.sqlite", ttl=60, clock=lambda: now[0])
+
+    writer.put((16, 1, 2), 7, (b"body", b"gz", None, "etag"))
+    writer.put((16, 3, 4), 7, (b"other", None, None, "etag2"))
+    writer.put((16, 1, 2), 6, (b"old", None, None, "etag0"))
+
+    assert reader.get((16, 1, 2), 7) == (b"body", b"gz", None, "etag")
+    assert reader.get((16, 1, 2), 8) is None
+    assert reader.discard([(16, 3, 4), (16, 5, 6)]) == 1
+    assert reader.prune(7) == 1
+    assert reader.count() == 1
+    now[0] += 61
+    assert reader.get((16, 1, 2), 7) is None
+    assert writer.prune(7) == 1
+    writer.close()
+    reader.close()
+
+
+def test_tile_store_is_shared_between_servers_and_follows_generation(monkeypatch, tmp_path):
+    db = FakeTileDatabase({(1, 2): [tile_row(1, name="Café")]})
+    argv = ["--store", str(tmp_path / "tiles.sqlite")]
+
+    async def first(client):
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "gzip"})
+        store = client.server.app["store"]
+        while store.count() == 0:
+            await asyncio.sleep(0.01)
+        return response.headers["ETag"], await response.read()
+
+    async def second(client):
+        app = client.server.app
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "gzip"})
+        before = (response.headers["ETag"], await response.read(), len(db.queries))
+        db.generation = 2
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            await gentiles.refresh_generation(app)
+        stored = app["store"].count()
+        await client.get("/16/1/2.json")
+        return before, stored, len(app["cache"]), len(db.queries)
+
+    etag, body = run_with_client(load_gentiles("gentiles_store_first"), monkeypatch, db, first, argv)
+    gentiles = load_gentiles("gentiles_store_second")
+    before, stored, cached, queries = run_with_client(gentiles, monkeypatch, db, second, argv)
+
+    assert before == (etag, body, 1)
+    assert gentiles.tile_store_hit.value == 1
+    assert stored == 0
+    assert cached == 1
+    assert queries == 2
+    assert gentiles.tile_generation.value == 2
+
+
+def test_tiles_are_not_kept_while_derived_tables_are_rebuilt(monkeypatch, tmp_path):
+    gentiles = load_gentiles("gentiles_store_unsettled")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    async def scenario(client):
+        app = client.server.app
+        db.generation = 0
+        await gentiles.refresh_generation(app)
+        await client.get("/16/1/2.json")
+        await asyncio.sleep(0.05)
+        unsettled = (app["generation"].current, app["store"].count(), len(app["cache"]))
+        db.generation = 2
+        await gentiles.refresh_generation(app)
+        settled = (app["generation"].current, app["store"].count(), len(app["cache"]))
+        return unsettled, settled
+
+    unsettled, settled = run_with_client(gentiles, monkeypatch, db, scenario, ["--store", str(tmp_path / "tiles.sqlite")])
+
+    assert unsettled == (None, 0, 1)
+    assert settled == (2, 0, 0)
+    assert gentiles.tile_generation.value == 2
+
+
+def test_new_generation_clears_the_cache_without_a_store(monkeypatch):
+    gentiles = load_gentiles("gentiles_generation_no_store")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    async def scenario(client):
+        app = client.server.app
+        await client.get("/16/1/2.json")
+        cached = len(app["cache"])
+        db.generation = 0
+        while app["generation"].current is not None:
+            await asyncio.sleep(0.01)
+        unsettled = len(app["cache"])
+        await client.get("/16/1/2.json")
+        db.generation = 2
+        while app["generation"].current != 2:
+            await asyncio.sleep(0.01)
+        return cached, unsettled, len(app["cache"]), len(db.queries)
+
+    cached, unsettled, settled, queries = run_with_client(gentiles, monkeypatch, db, scenario, ["--generation-poll", "0.01"])
+
+    assert (cached, unsettled, settled) == (1, 0, 0)
+    assert queries == 2
+    assert gentiles.tile_generation.value == 2
+
+
+def test_tile_store_has_its_own_ttl_and_prunes_on_generation_change(monkeypatch, tmp_path):
+    gentiles = load_gentiles("gentiles_store_ttl")
+    db = FakeTileDatabase()
+    pruned = []
+
+    async def scenario(client):
+        app = client.server.app
+        monkeypatch.setattr(app["store"], "prune", lambda generation: pruned.append(generation))
+        await gentiles.refresh_generation(app)
+        db.generation = 2
+        await gentiles.refresh_generation(app)
+        await gentiles.refresh_generation(app)
+        return app["store"].ttl
+
+    ttl = run_with_client(gentiles, monkeypatch, db, scenario, ["--store", str(tmp_path / "tiles.sqlite"), "--cache-ttl", "60"])
+
+    assert ttl is None
+    assert pruned == [2]
+    assert gentiles.parse_args(["--store-ttl", "86400"]).store_ttl == 86400
+    with pytest.raises(SystemExit):
+        gentiles.parse_args(["--store-ttl", "0"])
+
+
+def test_static_tree_is_served_before_the_database(monkeypatch, tmp_path):
+    import bz2
+
+    gentiles = load_gentiles("gentiles_static")
+    db = FakeTileDatabase({(x, 2): [tile_row(x, name="database")] for x in range(1, 5)})
+    for x in (1, 3, 4):
+        features = [tile_row(x, name="static é")._asdict()]
+        path = tmp_path / "16" / str(x) / "2.json.bz2"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(bz2.compress(gentiles.canonical_json.serialize_tile_json(features).encode("utf8")))
+    old = tmp_path / "16" / "3" / "2.json.bz2"
+    os.utime(old, (old.stat().st_atime, old.stat().st_mtime - 7200))
+
+    async def scenario(client):
+        gentiles.invalidate_tiles(client.server.app, [(16, 4, 2)])
+        static = await client.get("/16/1/2.json", headers={"Accept-Encoding": "gzip"})
+        bodies = {x: await (await client.get("/16/{0}/2.json".format(x))).json() for x in range(2, 5)}
+        return static.headers.get("Content-Encoding"), await static.json(), bodies
+
+    encoding, static, bodies = run_with_client(gentiles, monkeypatch, db, scenario, ["--static-dir", str(tmp_path), "--static-max-age", "3600"])
+
+    assert encoding == "gzip"
+    assert static["features"][0]["properties"] == {"name": "static é"}
+    assert [bodies[x]["features"][0]["properties"]["name"] for x in (2, 3, 4)] == ["database"] * 3
+    assert sorted(query["tile_x"] for query in db.queries) == [2, 3, 4]
+    assert (gentiles.tile_static_hit.value, gentiles.tile_static_miss.value, gentiles.tile_static_stale.value) == (1, 1, 2)
+
+
+def test_static_tree_replays_expire_lists_written_before_startup(monkeypatch, tmp_path):
+    import bz2
+
+    gentiles = load_gentiles("gentiles_static_replay")
+    db = FakeTileDatabase({(x, 2): [tile_row(x, name="database")] for x in (1, 2)})
+    static_dir = tmp_path / "static"
+    for x in (1, 2):
+        path = static_dir / "16" / str(x) / "2.json.bz2"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(bz2.compress(gentiles.canonical_json.serialize_tile_json([tile_row(x, name="static")._asdict()]).encode("utf8")))
+        os.utime(path, (1000, 1000))
+    expiredir = tmp_path / "expired"
+    # x=1 expired before its static tile was written, x=2 after
+    os.utime(write_expire_file(expiredir, "20260101", "010000.000.tiles", ["16/1/2"]), (900, 900))
+    os.utime(write_expire_file(expiredir, "20260101", "020000.000.tiles", ["16/2/2"]), (1100, 1100))
+
+    async def scenario(client):
+        return {x: await (await client.get("/16/{0}/2.json".format(x))).json() for x in (1, 2)}
+
+    bodies = run_with_client(gentiles, monkeypatch, db, scenario,
+                             ["--static-dir", str(static_dir), "--expiredir", str(expiredir)])
+
+    assert bodies[1]["features"][0]["properties"] == {"name": "static"}
+    assert bodies[2]["features"][0]["properties"] == {"name": "database"}
+    assert gentiles.tile_static_stale.value == 1
+
+
+def test_tile_requests_are_timed_per_stage_with_pool_gauges(monkeypatch):
+    gentiles = load_gentiles("gentiles_stages")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    class GatedPool:
+        def __init__(self, pool, gate):
+            self.pool = pool
+            self.gate = gate
+            self.minsize = pool.minsize
+            self.size = pool.size
+            self.freesize = pool.freesize
+            self.maxsize = pool.maxsize
+
+        def acquire(self):
+            pool = self
+
+            class Acquire:
+                async def __aenter__(self):
+                    await pool.gate.wait()
+                    return await pool.pool.acquire().__aenter__()
+
+                async def __aexit__(self, exc_type, exc, tb):
+                    pass
+
+            return Acquire()
+
+    def gauge(text, name):
+        return [line for line in text.splitlines() if line.startswith(name + " ")][0]
+
+    async def scenario(client):
+        engine = client.server.app["engine"]
+        engine.pool = GatedPool(engine.pool, asyncio.Event())
+        request = asyncio.ensure_future(client.get("/16/1/2.json"))
+        while engine.waiters == 0:
+            await asyncio.sleep(0.01)
+        waiting = await (await client.get("/metrics")).text()
+        engine.pool.gate.set()
+        await (await request).read()
+        engine.pool = engine.pool.pool
+        return waiting, await (await client.get("/metrics")).text()
+
+    waiting, done = run_with_client(gentiles, monkeypatch, db, scenario, ["--pool-size", "4"])
+
+    assert gauge(waiting, "tile_pool_waiters") == "tile_pool_waiters 1"
+    assert gauge(done, "tile_pool_waiters") == "tile_pool_waiters 0"
+    assert gauge(done, "tile_pool_max") == "tile_pool_max 10"
+    for stage in ("pool_wait", "execute", "fetch", "decode", "serialize", "compress", "write"):
+        assert gauge(done, "tile_stage_{0}_seconds_count".format(stage)) == "tile_stage_{0}_seconds_count 1".format(stage)
+
+
+def test_access_log_ring_samples_and_overwrites_oldest_records():
+    access_log = import_data_module("access_log")
+    draws = iter([0.1, 0.9, 0.4])
+    log = access_log.AccessLog("-", 2, 0.5, rng=lambda: next(draws))
+
+    assert [log.sampled() for _ in range(3)] == [True, False, True]
+    for ts in range(3):
+        log.add(access_log.AccessRecord(ts, "GET", "/tiles/16/1/2.json", 200, 0.001, 10, "127.0.0.1"))
+    records, dropped = log.drain()
+
+    assert [record.ts for record in records] == [1, 2]
+    assert dropped == 1
+    assert log.drain() == ([], 0)
+
+
+def test_access_log_writes_visualizer_compatible_json_lines(monkeypatch, tmp_path, capsys):
+    gentiles = load_gentiles("gentiles_access_log")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+    path = tmp_path / "tiles.log.json"
+
+    async def scenario(client):
+        await (await client.get("/tiles/16/1/2.json", headers={"X-Real-IP": "203.0.113.9"})).read()
+        await (await client.get("/tiles/13/1/2.json")).read()
+
+    run_with_client(gentiles, monkeypatch, db, scenario, ["--access-log", str(path), "--verbose"])
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(record["uri"], record["status"]) for record in records] == [("/tiles/16/1/2.json", 200), ("/tiles/13/1/2.json", 404)]
+    assert records[0]["remote_ip"] == "203.0.113.9"
+    assert records[0]["size"] > 0
+    assert all(isinstance(record["ts"], float) for record in records)
+    assert records[0]["uri"].strip("/").split("/")[0] == "tiles"
+    assert gentiles.tile_access_log_records.value == 2
+    assert "pool:" not in capsys.readouterr().out
+
+
+def test_verbose_alone_writes_no_access_log(monkeypatch, capsys):
+    gentiles = load_gentiles("gentiles_verbose")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)]})
+
+    async def scenario(client):
+        await (await client.get("/tiles/16/1/2.json")).read()
+        return "access_log" in client.server.app
+
+    assert run_with_client(gentiles, monkeypatch, db, scenario, ["--verbose"]) is False
+    assert "/tiles/16/1/2.json" not in capsys.readouterr().out
+
+
+def test_admission_gate_hands_slots_over_in_order_and_expires_waiters():
+    admission = import_data_module("admission")
+
+    async def scenario():
+        gate = admission.AdmissionGate(1, 2, 0.05)
+        await gate.acquire()
+        first = asyncio.ensure_future(gate.acquire())
+        second = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(admission.Overloaded):
+            await gate.acquire()
+        gate.release()
+        await first
+        with pytest.raises(admission.Overloaded):
+            await second
+        gate.release()
+        return gate.active, gate.queued
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_overload_is_shed_with_retry_after_while_admitted_tiles_complete(monkeypatch):
+    gentiles = load_gentiles("gentiles_admission")
+    db = FakeTileDatabase({(x, 0): [tile_row(x)] for x in range(5)})
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        requests = [asyncio.ensure_future(client.get("/16/{0}/0.json".format(x))) for x in range(3)]
+        while len(db.queries) < 2:
+            await asyncio.sleep(0.01)
+        while client.server.app["admission"].queued < 1:
+            await asyncio.sleep(0.01)
+        shed = await client.get("/16/3/0.json")
+        metrics = await (await client.get("/metrics")).text()
+        queued = await requests[2]
+        db.gate.set()
+        admitted = [await requests[x] for x in range(2)]
+        return shed, metrics, queued, admitted
+
+    shed, metrics, queued, admitted = run_with_client(
+        gentiles, monkeypatch, db, scenario, ["--admission-limit", "2", "--admission-queue", "1", "--admission-wait", "0.2"])
+
+    assert (shed.status, shed.headers["Retry-After"]) == (503, "1")
+    assert (queued.status, queued.headers["Retry-After"]) == (503, "1")
+    assert [response.status for response in admitted] == [200, 200]
+    assert "tile_admission_active 2\n" in metrics
+    assert "tile_admission_queue 1\n" in metrics
+    assert gentiles.tile_shed.value == 2
+    assert len(db.queries) == 2
+
+
+def test_replicas_take_load_and_are_ejected_when_lagging_or_failing(monkeypatch):
+    gentiles = load_gentiles("gentiles_replicas")
+    tiles = {(x, 0): [tile_row(x)] for x in range(10)}
+    primary = FakeTileDatabase(tiles)
+    replica = FakeTileDatabase(tiles)
+
+    async def scenario(client):
+        engine = client.server.app["engine"]
+        await engine.check()
+        primary.gate = asyncio.Event()
+        busy = asyncio.ensure_future(client.get("/16/0/0.json"))
+        while len(primary.queries) < 1:
+            await asyncio.sleep(0.01)
+        spread = await client.get("/16/1/0.json")
+
+        (primary.sequence, replica.sequence) = (5, 4)
+        await engine.check()
+        lagging = asyncio.ensure_future(client.get("/16/2/0.json"))
+        while len(primary.queries) < 2:
+            await asyncio.sleep(0.01)
+        primary.gate.set()
+        primary.gate = None
+        statuses = [spread.status, (await busy).status, (await lagging).status]
+
+        replica.sequence = 5
+        await engine.check()
+        readmitted = [replica.healthy for replica in engine.replicas]
+        primary.down = True
+        for x in range(3, 6):
+            statuses.append((await client.get("/16/{0}/0.json".format(x))).status)
+        statuses.append((await client.get("/16/6/0.json")).status)
+        metrics = await (await client.get("/metrics")).text()
+        return statuses, readmitted, metrics
+
+    statuses, readmitted, metrics = run_with_client(
+        gentiles, monkeypatch, {"dbname=primary": primary, "dbname=replica": replica}, scenario,
+        ["--dsn", "dbname=primary", "--replica", "dbname=replica", "--replica-check", "60"])
+
+    assert statuses == [200, 200, 200, 500, 500, 500, 200]
+    assert readmitted == [True, True]
+    assert [query["tile_x"] for query in primary.queries] == [0, 2]
+    assert [query["tile_x"] for query in replica.queries] == [1, 6]
+    assert "tile_replica_ejected_count 2\n" in metrics
+    assert "tile_pool_max 20\n" in metrics
+
+
+def test_replica_health_check_ejects_unreachable_databases(monkeypatch):
+    gentiles = load_gentiles("gentiles_replica_check")
+    primary = FakeTileDatabase()
+    replica = FakeTileDatabase()
+
+    async def scenario(client):
+        engine = client.server.app["engine"]
+        replica.down = True
+        await engine.check()
+        ejected = [replica.healthy for replica in engine.replicas]
+        replica.down = False
+        await engine.check()
+        return ejected, [replica.healthy for replica in engine.replicas]
+
+    ejected, readmitted = run_with_client(
+        gentiles, monkeypatch, {"dbname=osm": primary, "dbname=replica": replica}, scenario,
+        ["--replica", "dbname=replica", "--replica-check", "60"])
+
+    assert ejected == [True, False]
+    assert readmitted == [True, True]
+    assert gentiles.tile_replicas_healthy.value == 2
+
+
+def test_lower_zoom_tiles_are_composed_from_cached_children(monkeypatch):
+    gentiles = load_gentiles("gentiles_composed")
+    shared = TileRow("Feature", [7], "highway", "footway", {"type": "LineString", "coordinates": [[0, 0], [1, 1]]}, {})
+    db = FakeTileDatabase({
+        (20, 30): [tile_row(9), shared],
+        (21, 30): [shared, tile_row(3, name="corner")],
+        (20, 31): [],
+        (21, 31): [tile_row(1)],
+    })
+
+    async def scenario(client):
+        composed = await client.get("/15/10/15.json")
+        again = await client.get("/tiles/15/10/15.json")
+        filtered = await client.get("/15/10/15.json?feature_type=highway")
+        child = await client.get("/16/21/30.json?feature_value=cafe")
+        too_low = await client.get("/13/5/7.json")
+        return ([await response.json() for response in (composed, again, filtered, child)],
+                [composed.headers["ETag"], again.headers["ETag"]], too_low.status)
+
+    (composed, again, filtered, child), etags, too_low = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert [feature["osm_ids"] for feature in composed["features"]] == [[1], [3], [7], [9]]
+    assert composed == again and etags[0] == etags[1]
+    assert [feature["osm_ids"] for feature in filtered["features"]] == [[7]]
+    assert [feature["osm_ids"] for feature in child["features"]] == [[3]]
+    assert too_low == 404
+    assert sorted((query["tile_x"], query["tile_y"]) for query in db.queries) == [(20, 30), (20, 31), (21, 30), (21, 31)]
+    assert {query["zoom"] for query in db.queries} == {16}
+    assert gentiles.tile_composed.value == 3
+
+
+def test_composed_tiles_keep_features_sharing_osm_ids(monkeypatch):
+    gentiles = load_gentiles("gentiles_composed_shared")
+    polygon = {"type": "Polygon", "coordinates": [[[0, 0], [0, 1], [1, 1], [0, 0]]]}
+    building = TileRow("Feature", [5], "building", "yes", polygon, {})
+    amenity = TileRow("Feature", [5], "amenity", "school", polygon, {})
+    crossing = TileRow("Feature", [2, 4], "highway", "gd_intersection", {"type": "Point", "coordinates": [0, 0]}, {})
+    again = TileRow("Feature", [2, 4], "highway", "gd_intersection", {"type": "Point", "coordinates": [1, 1]}, {})
+    west = TileRow("Feature", [5, 11, 12], "gd_entrance_list", "yes",
+                   {"type": "MultiPoint", "coordinates": [[0, 0], [0.5, 0.5]]}, {})
+    east = TileRow("Feature", [5, 12, 13], "gd_entrance_list", "yes",
+                   {"type": "MultiPoint", "coordinates": [[0.5, 0.5], [1, 1]]}, {})
+    db = FakeTileDatabase({
+        (20, 30): [crossing, building, amenity, west],
+        (21, 30): [again, building, amenity, east],
+        (20, 31): [],
+        (21, 31): [],
+    })
+
+    async def scenario(client):
+        return await (await client.get("/15/10/15.json")).json()
+
+    composed = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert [(feature["osm_ids"], feature["feature_type"]) for feature in composed["features"]] == [
+        ([2, 4], "highway"), ([2, 4], "highway"),
+        ([5], "amenity"), ([5], "building"), ([5, 11, 12, 13], "gd_entrance_list"),
+    ]
+    assert composed["features"][-1]["geometry"] == {"type": "MultiPoint", "coordinates": [[0, 0], [0.5, 0.5], [1, 1]]}
+
+
+def test_composed_tiles_are_cached_until_a_child_changes(monkeypatch):
+    gentiles = load_gentiles("gentiles_composed_cache")
+    db = FakeTileDatabase({(20, 30): [tile_row(9)], (21, 30): [], (20, 31): [], (21, 31): []})
+
+    async def scenario(client):
+        first = await client.get("/15/10/15.json")
+        cached = await client.get("/15/10/15.json", headers={"If-None-Match": first.headers["ETag"]})
+        db.tiles[(21, 30)] = [tile_row(3)]
+        gentiles.invalidate_tiles(client.server.app, [(16, 21, 30)])
+        changed = await client.get("/15/10/15.json")
+        return cached.status, await changed.json()
+
+    cached, changed = run_with_client(gentiles, monkeypatch, db, scenario)
+
+    assert cached == 304
+    assert [feature["osm_ids"] for feature in changed["features"]] == [[3], [9]]
+    assert gentiles.tile_composed.value == 2
+
+
+def test_hot_tiles_are_ranked_from_access_logs_and_lists(tmp_path):
+    warmup = import_data_module("warmup")
+    log = tmp_path / "tiles.log.json"
+    log.write_text("".join(json.dumps({"ts": 1.0, "uri": uri}) + "\n" for uri in [
+        "/tiles/16/1/2.json", "/16/3/4.json", "/tiles/16/3/4.json", "/metrics", "/tiles/15/0/1.json?feature_type=highway",
+    ]) + "not json\n")
+    ranked = tmp_path / "hot.txt"
+    ranked.write_text("# hottest first\n16/5/6 120\n\n/16/7/8.json\nbogus\n")
+
+    assert warmup.read_hot_tiles(log) == [(16, 3, 4), (16, 1, 2), (15, 0, 1)]
+    assert warmup.read_hot_tiles(ranked) == [(16, 5, 6), (16, 7, 8)]
+
+
+def test_cache_is_warmed_before_instance_reports_ready(monkeypatch, tmp_path):
+    gentiles = load_gentiles("gentiles_warmup")
+    db = FakeTileDatabase({(x, 0): [tile_row(x)] for x in range(8)})
+    hot = tmp_path / "hot.txt"
+    hot.write_text("16/1/0\n16/2/0\n15/0/0\n16/3/0\n16/4/0\n")
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        while len(db.queries) < 2:
+            await asyncio.sleep(0.01)
+        cold = await client.get("/probe/ready")
+        db.gate.set()
+        warmup = client.server.app["warmup"]
+        while not warmup.ready:
+            await asyncio.sleep(0.01)
+        ready = await client.get("/probe/ready")
+        queried = len(db.queries)
+        served = await client.get("/16/0/1.json")
+        metrics = await (await client.get("/metrics")).text()
+        return cold.status, ready.status, queried, served.status, len(db.queries), metrics
+
+    cold, ready, queried, served, after, metrics = run_with_client(
+        gentiles, monkeypatch, db, scenario,
+        ["--warm-from", str(hot), "--warm-tiles", "5", "--warm-concurrency", "2", "--warm-ready", "0.8"])
+
+    assert (cold, ready, served) == (503, 200, 200)
+    assert queried >= 4 and after == queried
+    assert [(q["tile_x"], q["tile_y"]) for q in db.queries[:2]] == [(1, 0), (2, 0)]
+    assert {(q["tile_x"], q["tile_y"]) for q in db.queries} == {(1, 0), (2, 0), (0, 0), (1, 1), (0, 1)}
+    assert "tile_warmup_tiles 5\n" in metrics
+
+
+def test_workers_report_ready_only_once_every_worker_is_warm(monkeypatch, tmp_path):
+    gentiles = load_gentiles("gentiles_warmup_workers")
+    db = FakeTileDatabase({(1, 0): [tile_row(1)]})
+    hot = tmp_path / "hot.txt"
+    hot.write_text("16/1/0\n")
+    metrics_dir = tmp_path / "metrics"
+    metrics_dir.mkdir()
+    other = gentiles.WorkerInfo(1, 2, str(metrics_dir))
+
+    async def scenario(client):
+        app = client.server.app
+        while not app["warmup"].ready:
+            await asyncio.sleep(0.01)
+        unpublished = await client.get("/probe/ready")
+        gentiles.write_metrics_snapshot(other, {"tile_warmup_ready": 0})
+        cold = await client.get("/probe/ready")
+        gentiles.write_metrics_snapshot(other, {"tile_warmup_ready": 1})
+        ready = await client.get("/probe/ready")
+        stored = app["store"].get((16, 1, 0), app["generation"].current)
+        return unpublished.status, cold.status, await cold.text(), ready.status, stored
+
+    unpublished, cold, text, ready, stored = run_with_client(
+        gentiles, monkeypatch, db, scenario,
+        ["--warm-from", str(hot), "--store", str(tmp_path / "tiles.sqlite")],
+        app_kwargs={"worker": gentiles.WorkerInfo(0, 2, str(metrics_dir))})
+
+    assert (unpublished, cold, ready) == (503, 503, 200)
+    assert text == "warming up, 1 of 2 workers ready"
+    # warm-up runs after the store has its generation, so it fills the store
+    assert stored is not None
+
+
+@pytest.mark.parametrize("engine", ["aiopg", "asyncpg"])
+def test_stream_writes_tiles_from_server_side_cursor_in_chunks(monkeypatch, engine):
+    gentiles = load_gentiles("gentiles_stream_" + engine)
+    db = FakeTileDatabase({
+        (1, 2): [tile_row(osm_id, name="Café {0}".format(osm_id)) for osm_id in range(5)],
+        (1, 3): [],
+        (1, 4): [tile_row(osm_id, name="x" * 100) for osm_id in range(5)],
+    })
+    monkeypatch.setattr(gentiles, "stream_chunk_rows", 2)
+    monkeypatch.setattr(gentiles, "stream_keep_bytes", 1200)
+    if engine == "asyncpg":
+        monkeypatch.setattr(gentiles, "asyncpg", fake_asyncpg_module(db, []))
+
+    async def scenario(client):
+        streamed = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        body = await streamed.read()
+        cached = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        empty = await (await client.get("/16/1/3.json")).read()
+        for _ in range(2):
+            response = await client.get("/16/1/4.json")
+            dense = await response.read()
+        return streamed.headers, body, cached.headers, await cached.read(), empty, (response.headers, dense)
+
+    (streamed_headers, body, cached_headers, cached_body, empty, (dense_headers, dense)) = run_with_client(
+        gentiles, monkeypatch, db, scenario, ["--stream", "--engine", engine])
+
+    features = [row._asdict() for row in db.tiles[(1, 2)]]
+    assert body == json.dumps({"type": "FeatureCollection", "features": features}, sort_keys=True).encode("utf8")
+    # a tile within stream_keep_bytes is buffered and answered as any other
+    assert streamed_headers["ETag"] == cached_headers["ETag"]
+    assert cached_body == body
+    assert "ETag" not in dense_headers
+    assert json.loads(empty) == {"type": "FeatureCollection", "features": []}
+    assert len(json.loads(dense)["features"]) == 5
+    assert [q["tile_y"] for q in db.queries] == [2, 3, 4, 4]
+    assert [s.split()[:2] for s in db.statements if s.startswith("FETCH")][:4] == [["FETCH", "2"]] * 4
+    assert db.statements.count("BEGIN") == db.statements.count("COMMIT") == 4
+    assert gentiles.tile_streamed.value == 4
+
+
+def test_concurrent_stream_requests_share_one_cursor(monkeypatch):
+    gentiles = load_gentiles("gentiles_stream_coalesced")
+    db = FakeTileDatabase({(1, 2): [tile_row(osm_id) for osm_id in range(3)]})
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        requests = [asyncio.ensure_future(client.get("/16/1/2.json")) for _ in range(3)]
+        while not db.queries:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        db.gate.set()
+        return [(response.status, await response.read()) for response in await asyncio.gather(*requests)]
+
+    responses = run_with_client(gentiles, monkeypatch, db, scenario, ["--stream"])
+
+    assert len({body for (_, body) in responses}) == 1
+    assert [status for (status, _) in responses] == [200] * 3
+    assert len(db.queries) == 1
+    assert gentiles.tile_streamed.value == 1
+    assert gentiles.tile_coalesced.value == 2
+    assert gentiles.tile_inflight.value == 0
+
+
+def test_stream_failing_after_headers_aborts_the_response(monkeypatch):
+    gentiles = load_gentiles("gentiles_stream_abort")
+    db = FakeTileDatabase({(1, 2): [tile_row(osm_id, name="x" * 100) for osm_id in range(5)]})
+    monkeypatch.setattr(gentiles, "stream_chunk_rows", 2)
+    monkeypatch.setattr(gentiles, "stream_keep_bytes", 300)
+    fetches = 0
+
+    async def failing_stream(engine, zoom, x, y, chunk_rows):
+        for chunk in [[row._asdict() for row in db.tiles[(1, 2)][:2]]] * 2:
+            yield chunk
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    monkeypatch.setattr(gentiles.AiopgTileEngine, "stream", failing_stream)
+
+    async def scenario(client):
+        response = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        assert response.status == 200
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await response.read()
+        return len(client.server.app["cache"])
+
+    assert run_with_client(gentiles, monkeypatch, db, scenario, ["--stream"]) == 0
+
+
+def test_batch_waits_for_a_streaming_flight(monkeypatch):
+    gentiles = load_gentiles("gentiles_stream_batch")
+    db = FakeTileDatabase({(1, 2): [tile_row(1)], (1, 3): [tile_row(osm_id, name="x" * 100) for osm_id in range(5)]})
+    monkeypatch.setattr(gentiles, "stream_keep_bytes", 300)
+
+    async def scenario(client):
+        db.gate = asyncio.Event()
+        streams = [asyncio.ensure_future(client.get("/16/{0}.json".format(tile))) for tile in ("1/2", "1/3")]
+        while len(db.queries) < 2:
+            await asyncio.sleep(0.01)
+        batch = asyncio.ensure_future(client.get("/batch?tiles=16/1/2,16/1/3"))
+        await asyncio.sleep(0.05)
+        db.gate.set()
+        for stream in streams:
+            await (await stream).read()
+        lines = (await (await batch).text()).splitlines()
+        return [json.loads(line) for line in lines]
+
+    lines = run_with_client(gentiles, monkeypatch, db, scenario, ["--stream"])
+
+    assert [(line["x"], line["y"]) for line in lines] == [(1, 2), (1, 3)]
+    assert all("error" not in line for line in lines)
+    # the dense tile was not kept by its stream, so the batch generated it
+    assert [(q["tile_x"], q["tile_y"]) for q in db.queries].count((1, 3)) == 2
+    assert [(q["tile_x"], q["tile_y"]) for q in db.queries].count((1, 2)) == 1
+
+
+def test_stream_cannot_be_combined_with_db_json():
+    gentiles = load_gentiles("gentiles_stream_args")
+
+    with pytest.raises(SystemExit):
+        gentiles.parse_args(["--stream", "--db-json"])
+    with pytest.raises(SystemExit):
+        gentiles.parse_args(["--stream", "--materialized"])
+
+
+@pytest.mark.parametrize("engine", ["aiopg", "asyncpg"])
+def test_materialized_tiles_are_looked_up_before_generating(monkeypatch, engine):
+    gentiles = load_gentiles("gentiles_materialized_" + engine)
+    db = FakeTileDatabase({(1, 2): [tile_row(1)], (1, 3): [tile_row(2)]})
+    rendered = db.json_tile({"tile_x": 1, "tile_y": 2})
+    # the stored etag and compressed form are served as they are
+    db.materialized = {(1, 2): (rendered, b"rendered gzip", None, "rendered-etag")}
+    if engine == "asyncpg":
+        monkeypatch.setattr(gentiles, "asyncpg", fake_asyncpg_module(db, []))
+
+    async def scenario(client):
+        hit = await client.get("/16/1/2.json", headers={"Accept-Encoding": "identity"})
+        gzipped = await client.get("/16/1/2.json", headers={"Accept-Encoding": "gzip"}, auto_decompress=False)
+        miss = await client.get("/16/1/3.json", headers={"Accept-Encoding": "identity"})
+        metrics = await client.get("/metrics")
+        return (await hit.read(), hit.headers["ETag"], await gzipped.read(), gzipped.headers["ETag"],
+                await miss.read(), await metrics.text())
+
+    (hit, etag, gzipped, gzip_etag, miss, metrics) = run_with_client(
+        gentiles, monkeypatch, db, scenario, ["--materialized", "--engine", engine])
+
+    assert hit == rendered
+    assert etag == '"rendered-etag"'
+    assert (gzipped, gzip_etag) == (b"rendered gzip", '"rendered-etag-gzip"')
+    assert json.loads(miss)["features"][0]["osm_ids"] == [2]
+    assert db.lookups == [(1, 2), (1, 3)]
+    assert [(q["tile_x"], q["tile_y"]) for q in db.queries] == [(1, 3)]
+    assert "tile_materialized_hit_count 1\n" in metrics
+    assert "tile_materialized_miss_count 1\n" in metrics
+    if engine == "aiopg":
+        assert "PREPARE soundscape_materialized_tile_entry (int, int, int)" in db.statements[0]
@@ -1,6 +1,8 @@
 # Copyright (c) Soundscape Community Contributors.
 # Licensed under the MIT License.
 
+import gzip
+import hashlib
 import importlib.util
 import io
 import json
@@ -12,6 +14,7 @@ from dataclasses import replace
 from pathlib import Path
 from types import SimpleNamespace
 
+import brotli
 import pytest
 
 
@@ -363,6 +366,7 @@ def test_generated_imposm_config_includes_daily_replication(tmp_path):
     assert generated["replication_url"] == "https://example.test/updates/"
     assert generated["replication_interval"] == "24h"
     assert generated["expiretiles_dir"] == cfg.expiredir
+    assert generated["expiretiles_zoom"] == 16
     assert generated["schemas"] == {
         "import": "import",
         "production": "public",
@@ -1167,3 +1171,158 @@ def test_import_database_wraps_subprocess_failures_as_db_errors(tmp_path, monkey
 
     with pytest.raises(ingest.DbIngestError):
         ingest.import_database(cfg, ext)
+
+
+def test_soundscape_provisioning_refreshes_derived_tables_after_tile_functions(tmp_path, monkeypatch):
+    ingest = load_ingest("ingest_refresh_derived_tables")
+
+    class Cursor(FakeAsyncCursor):
+        async def fetchone(self):
+            return (42,)
+
+    cursor = Cursor()
+    (tmp_path / "postgis-vt-util.sql").write_text("SELECT 'vt-util'", encoding="utf8")
+    (tmp_path / "tilefunc.sql").write_text("SELECT 'tilefunc'", encoding="utf8")
+    monkeypatch.setenv("INGEST", str(tmp_path))
+    monkeypatch.setattr(ingest.aiopg, "connect", lambda dsn: FakeAiopgConnection(cursor))
+
+    ingest.run_async(ingest.provision_database_soundscape_async("host=postgis dbname=osm"))
+
+    assert sql_texts(cursor) == [
+        "SELECT 'vt-util'",
+        "SELECT 'tilefunc'",
+        "SELECT soundscape_refresh_intersections()",
+        "SELECT soundscape_refresh_entrance_lists()",
+    ]
+
+
+def test_render_tiles_requires_weekly_mode():
+    ingest = load_ingest("ingest_render_args")
+
+    config = ingest.parse_args(["--where", "district-of-columbia", "--render-tiles", "--render-concurrency", "8"])
+    assert config.render_tiles is True
+    assert config.render_concurrency == 8
+    with pytest.raises(SystemExit):
+        ingest.parse_args(
+            ["--where", "district-of-columbia", "--render-tiles", "--ingest-mode", ingest.INGEST_MODE_IMPOSM_RUN]
+        )
+
+
+def test_extract_tiles_cover_bbox_and_keep_those_meeting_poly(tmp_path):
+    ingest = load_ingest("ingest_extract_tiles")
+    cfg = base_config(ingest, tmp_path)
+    # a quarter of the z2 world: tiles x 2-3, y 0-1
+    ext = dict(extract(), bbox=[1, 1, 80, 170])
+
+    assert list(ingest.extract_tiles(cfg, ext, 2)) == [(2, 0), (2, 1), (3, 0), (3, 1)]
+
+    # a triangle with a hole, missing x 3 / y 0, then a second part inside it
+    poly = "region\n1\n1 1\n170 1\n1 80\n1 1\nEND\n!2\n5 5\n6 5\n6 6\nEND\n"
+    (tmp_path / "region.poly").write_text(poly + "END\n", encoding="utf8")
+    ext["poly"] = "region.poly"
+    assert list(ingest.extract_tiles(cfg, ext, 2)) == [(2, 0), (2, 1), (3, 1)]
+    (tmp_path / "region.poly").write_text(poly + "3\n160 75\n165 75\n165 78\nEND\nEND\n", encoding="utf8")
+    assert list(ingest.extract_tiles(cfg, ext, 2)) == [(2, 0), (2, 1), (3, 0), (3, 1)]
+    # world and the like list a [0, 0, 0, 0] bbox: the poly bounds it, or nothing does
+    ext["bbox"] = [0, 0, 0, 0]
+    assert list(ingest.extract_tiles(cfg, ext, 2)) == [(2, 0), (2, 1), (3, 0), (3, 1)]
+    del ext["poly"]
+    with pytest.raises(ValueError, match="no usable bbox or poly"):
+        ingest.extract_tiles(cfg, ext, 2)
+    assert ingest.tile_meets_poly((10, 10, 20, 20), [[(0, 0), (30, 0), (30, 30), (0, 30)]]) is True
+    assert ingest.tile_meets_poly((10, 10, 20, 20), [[(0, 0), (30, 0), (0, 30)], [(9, 9), (21, 9), (9, 21)]]) is True
+    assert ingest.tile_meets_poly((10, 10, 20, 20), [[(0, 0), (30, 0), (30, 30), (0, 30)], [(5, 5), (25, 5), (25, 25), (5, 25)]]) is False
+    assert ingest.tile_meets_poly((40, 40, 50, 50), [[(0, 0), (30, 0), (30, 30), (0, 30)]]) is False
+
+
+def test_render_tiles_fills_build_table_and_swaps_it_in(monkeypatch):
+    ingest = load_ingest("ingest_render_tiles")
+    monkeypatch.setattr(ingest, "RENDER_BATCH_TILES", 2)
+    results = [(7,), (False,)]
+    body = json.dumps({"type": "FeatureCollection", "features": [{"name": "x" * 200}] * 4}).encode("utf8")
+
+    class Cursor(FakeAsyncCursor):
+        async def fetchone(self):
+            return results.pop(0)
+
+        async def fetchall(self):
+            (_, params) = self.commands[-1]
+            # the query leaves out tiles without features, all of the second batch here
+            return [(x, y, memoryview(body if y == 2 else b"{}")) for (x, y) in zip(params["xs"], params["ys"]) if x == 1]
+
+    cursor = Cursor()
+    monkeypatch.setattr(ingest.aiopg, "connect", lambda dsn: FakeAiopgConnection(cursor))
+
+    tiles = [(1, 2), (1, 3), (2, 2)]
+    assert ingest.run_async(ingest.render_tiles_async("host=postgis dbname=osm", 16, iter(tiles), 2)) == 2
+
+    texts = sql_texts(cursor)
+    assert texts[1] == "SELECT EXISTS (SELECT 1 FROM soundscape_tiles WHERE generation = %s)"
+    assert texts[2].startswith("DROP TABLE IF EXISTS soundscape_tiles_build;")
+    renders = [params for sql, params in cursor.commands if "INSERT INTO soundscape_tiles_build" in sql]
+    selects = [params for sql, params in cursor.commands if "soundscape_tile_json" in sql]
+    assert sorted((params["xs"], params["ys"]) for params in selects) == [([1, 1], [2, 3]), ([2], [2])]
+    assert [(params["xs"], params["ys"]) for params in renders] == [([1, 1], [2, 3])]
+    assert {(params["zoom"], params["generation"]) for params in renders} == {(16, 7)}
+    # hashed and compressed as gentiles.py does, small tiles left uncompressed
+    stored = {(x, y): tile for params in renders for (x, y, *tile) in zip(
+        params["xs"], params["ys"], params["bodies"], params["gzips"], params["brotlis"], params["etags"])}
+    (stored_body, gzipped, brotlied, etag) = stored[(1, 2)]
+    assert stored_body == body and gzip.decompress(gzipped) == body and brotli.decompress(brotlied) == body
+    assert etag == hashlib.sha256(body).hexdigest()[:32]
+    assert stored[(1, 3)][1:3] == [None, None]
+    assert texts[-3] == "ALTER TABLE soundscape_tiles_build ADD PRIMARY KEY (z, x, y)"
+    assert texts[-2] == (
+        "BEGIN; DROP TABLE soundscape_tiles; ALTER TABLE soundscape_tiles_build RENAME TO soundscape_tiles;"
+        " ALTER INDEX soundscape_tiles_build_pkey RENAME TO soundscape_tiles_pkey; COMMIT;"
+    )
+
+
+def test_render_tiles_skips_generation_already_rendered(monkeypatch):
+    ingest = load_ingest("ingest_render_tiles_current")
+    results = [(7,), (True,)]
+
+    class Cursor(FakeAsyncCursor):
+        async def fetchone(self):
+            return results.pop(0)
+
+    cursor = Cursor()
+    monkeypatch.setattr(ingest.aiopg, "connect", lambda dsn: FakeAiopgConnection(cursor))
+
+    assert ingest.run_async(ingest.render_tiles_async("host=postgis dbname=osm", 16, [(1, 2)], 2)) is None
+    assert len(cursor.commands) == 2
+
+
+def test_render_tiles_refuses_tables_without_derived_tables(monkeypatch):
+    ingest = load_ingest("ingest_render_tiles_unsettled")
+    results = [(0,)]
+
+    class Cursor(FakeAsyncCursor):
+        async def fetchone(self):
+            return results.pop(0)
+
+    cursor = Cursor()
+    monkeypatch.setattr(ingest.aiopg, "connect", lambda dsn: FakeAiopgConnection(cursor))
+
+    with pytest.raises(RuntimeError, match="derived tables"):
+        ingest.run_async(ingest.render_tiles_async("host=postgis dbname=osm", 16, [(1, 2)], 2))
+    assert sql_texts(cursor) == ["SELECT soundscape_tile_generation()"]
+
+
+def test_weekly_cycle_renders_tiles_after_imports(tmp_path, monkeypatch):
+    ingest = load_ingest("ingest_weekly_render")
+    cfg = base_config(ingest, tmp_path, config=str(tmp_path / "imposm.json"), render_tiles=True)
+    ext = extract()
+    ingest.pbf_path(cfg, ext).write_text("pbf", encoding="utf8")
+    events = []
+
+    monkeypatch.setattr(ingest, "sync_pbf", lambda config, selected: None)
+    monkeypatch.setattr(ingest, "pbf_replication_sequence", lambda path: 43)
+    monkeypatch.setattr(ingest, "read_import_state", lambda config, region, sequence_number: None)
+    monkeypatch.setattr(ingest, "import_weekly_extracts_and_write", lambda config, selected: events.append("import"))
+    monkeypatch.setattr(ingest, "write_import_state", lambda config, marker: None)
+    monkeypatch.setattr(ingest, "run_startup_imports", lambda config: events.append("startup"))
+    monkeypatch.setattr(ingest, "render_tiles", lambda config, selected: events.append(("render", selected["name"])))
+
+    assert ingest.run_weekly_cycle(cfg, ext) is True
+    assert events == ["import", "startup", ("render", "district-of-columbia")]
@@ -0,0 +1,69 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# In-memory cache of serialized tiles for the tile server.
+#
+# Entries are evicted in least-recently-used order once the total size of
+# the cached tile bodies exceeds a byte budget, so a handful of very dense
+# downtown tiles cannot crowd out the rest of the working set unnoticed.
+#
+
+import time
+from collections import OrderedDict
+
+
+class TileCache(object):
+    def __init__(self, max_bytes, ttl=None, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, size, expires = entry
+        if expires is not None and expires <= self.clock():
+            self.discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, size):
+        """Store value under key, returning the number of entries evicted."""
+        self.discard(key)
+        if size > self.max_bytes:
+            return 0
+        expires = None
+        if self.ttl:
+            expires = self.clock() + self.ttl
+        self._entries[key] = (value, size, expires)
+        self.size += size
+        evicted = 0
+        while self.size > self.max_bytes:
+            _, (_, old_size, _) = self._entries.popitem(last=False)
+            self.size -= old_size
+            evicted += 1
+        return evicted
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
@@ -0,0 +1,149 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Slippy map tiles covering a circle around a point or a corridor along a
+# route, ordered by how soon a client moving from the start needs them.
+#
+# Distances are measured in fractional tile coordinates, where web mercator
+# is locally uniform, and converted to metres with the ground size of a tile
+# at the latitude involved (at the middle of each route segment).
+#
+
+import math
+
+EARTH_CIRCUMFERENCE = 40075016.686  # metres, at the equator
+
+
+class TooManyTiles(ValueError):
+    pass
+
+
+def fractional_tile(lat, lon, zoom):
+    """Tile coordinates of a point, the integer part naming its tile."""
+    n = 2.0 ** zoom
+    fx = (lon + 180.0) / 360.0 * n
+    fy = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return (fx, fy)
+
+
+def tile_metres(lat, zoom):
+    return EARTH_CIRCUMFERENCE * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def point_tile_distance(point, x, y):
+    dx = max(x - point[0], 0.0, point[0] - (x + 1))
+    dy = max(y - point[1], 0.0, point[1] - (y + 1))
+    return math.hypot(dx, dy)
+
+
+def segment_position(point, a, b):
+    """Fraction of the way along a-b of the point on it closest to point."""
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return 0.0
+    t = ((point[0] - a[0]) * dx + (point[1] - a[1]) * dy) / length2
+    return min(1.0, max(0.0, t))
+
+
+def point_segment_distance(point, a, b):
+    t = segment_position(point, a, b)
+    return math.hypot(a[0] + t * (b[0] - a[0]) - point[0], a[1] + t * (b[1] - a[1]) - point[1])
+
+
+# Liang-Barsky clip of the segment against the tile square
+def segment_crosses_tile(a, b, x, y):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    (t0, t1) = (0.0, 1.0)
+    for (p, q) in ((-dx, a[0] - x), (dx, x + 1 - a[0]), (-dy, a[1] - y), (dy, y + 1 - a[1])):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+def segment_tile_distance(a, b, x, y):
+    if segment_crosses_tile(a, b, x, y):
+        return 0.0
+    corners = ((x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1))
+    return min(point_tile_distance(a, x, y), point_tile_distance(b, x, y),
+               *(point_segment_distance(corner, a, b) for corner in corners))
+
+
+def grid_range(low, high, zoom):
+    last = 2 ** zoom - 1
+    return range(max(0, math.floor(low)), min(last, math.floor(high)) + 1)
+
+
+def radius_tiles(lat, lon, radius, zoom, limit=None):
+    """Tiles within radius metres of the point, nearest first."""
+    centre = fractional_tile(lat, lon, zoom)
+    reach = radius / tile_metres(lat, zoom)
+    found = []
+    for y in grid_range(centre[1] - reach, centre[1] + reach, zoom):
+        for x in grid_range(centre[0] - reach, centre[0] + reach, zoom):
+            distance = point_tile_distance(centre, x, y)
+            if distance <= reach:
+                middle = math.hypot(x + 0.5 - centre[0], y + 0.5 - centre[1])
+                found.append((distance, middle, x, y))
+    if limit is not None and len(found) > limit:
+        raise TooManyTiles('radius covers more than {0} tiles'.format(limit))
+    return [(zoom, x, y) for (_, _, x, y) in sorted(found)]
+
+
+# x extent of the part of segment a-b lying between rows ylow and yhigh
+def segment_x_extent(a, b, ylow, yhigh):
+    dy = b[1] - a[1]
+    if dy == 0:
+        if ylow <= a[1] <= yhigh:
+            return (min(a[0], b[0]), max(a[0], b[0]))
+        return None
+    (t0, t1) = sorted(((ylow - a[1]) / dy, (yhigh - a[1]) / dy))
+    (t0, t1) = (max(t0, 0.0), min(t1, 1.0))
+    if t0 > t1:
+        return None
+    (x0, x1) = (a[0] + t0 * (b[0] - a[0]), a[0] + t1 * (b[0] - a[0]))
+    return (min(x0, x1), max(x0, x1))
+
+
+def corridor_tiles(points, radius, zoom, limit=None):
+    """Tiles within radius metres of the route through points, a list of
+    (lat, lon), ordered by how far along the route they are first needed."""
+    if len(points) == 1:
+        return radius_tiles(points[0][0], points[0][1], radius, zoom, limit)
+    progress = {}
+    along = 0.0
+    for ((alat, alon), (blat, blon)) in zip(points, points[1:]):
+        a = fractional_tile(alat, alon, zoom)
+        b = fractional_tile(blat, blon, zoom)
+        scale = tile_metres((alat + blat) / 2, zoom)
+        reach = radius / scale
+        length = math.hypot(b[0] - a[0], b[1] - a[1])
+        # a corridor touches at least one tile per tile of its length
+        if limit is not None and length > limit:
+            raise TooManyTiles('route covers more than {0} tiles'.format(limit))
+        for y in grid_range(min(a[1], b[1]) - reach, max(a[1], b[1]) + reach, zoom):
+            extent = segment_x_extent(a, b, y - reach, y + 1 + reach)
+            if extent is None:
+                continue
+            for x in grid_range(extent[0] - reach, extent[1] + reach, zoom):
+                distance = segment_tile_distance(a, b, x, y)
+                if distance > reach:
+                    continue
+                key = (along + segment_position((x + 0.5, y + 0.5), a, b) * length * scale, distance * scale)
+                if (x, y) not in progress or key < progress[(x, y)]:
+                    progress[(x, y)] = key
+        if limit is not None and len(progress) > limit:
+            raise TooManyTiles('route covers more than {0} tiles'.format(limit))
+        along += length * scale
+    return [(zoom, x, y) for ((x, y), _) in sorted(progress.items(), key=lambda item: (item[1], item[0]))]
@@ -0,0 +1,115 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Persistent tile store shared by tile server processes.
+#
+# Tiles are kept in one SQLite file in WAL mode, so any number of worker
+# processes and both blue/green containers can read it concurrently while
+# one of them writes.  Rows are keyed by (zoom, x, y, generation): a new
+# data generation simply misses until tiles are regenerated, and prune()
+# later drops the rows of older generations.
+#
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tiles (
+        zoom INTEGER NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        generation INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        body BLOB NOT NULL,
+        gzip BLOB,
+        brotli BLOB,
+        etag TEXT NOT NULL,
+        PRIMARY KEY (zoom, x, y, generation)
+    )
+"""
+
+# milliseconds a statement waits for another process's write to finish
+busy_timeout = 5000
+
+
+class TileStore(object):
+    def __init__(self, path, ttl=None, clock=time.time):
+        self.path = str(path)
+        self.ttl = ttl
+        self.clock = clock
+        # sqlite3 connections belong to the thread that opened them, and
+        # the tile server calls in from its executor threads
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._connection().execute(SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=busy_timeout / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout={0}'.format(busy_timeout))
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _oldest(self):
+        if not self.ttl:
+            return None
+        return self.clock() - self.ttl
+
+    def get(self, key, generation):
+        """Return (body, gzip, brotli, etag) for the tile, or None."""
+        (zoom, x, y) = key
+        row = self._connection().execute(
+            'SELECT stored_at, body, gzip, brotli, etag FROM tiles'
+            ' WHERE zoom = ? AND x = ? AND y = ? AND generation = ?',
+            (zoom, x, y, generation)).fetchone()
+        if row is None:
+            return None
+        oldest = self._oldest()
+        if oldest is not None and row[0] < oldest:
+            return None
+        (_, body, gzip, brotli, etag) = row
+        return (bytes(body), gzip and bytes(gzip), brotli and bytes(brotli), etag)
+
+    def put(self, key, generation, entry):
+        (zoom, x, y) = key
+        (body, gzip, brotli, etag) = entry
+        self._connection().execute(
+            'INSERT OR REPLACE INTO tiles (zoom, x, y, generation, stored_at, body, gzip, brotli, etag)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (zoom, x, y, generation, self.clock(), body, gzip, brotli, etag))
+
+    def discard(self, tiles):
+        """Drop every generation of the given tiles, returning the rows removed."""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN')
+            removed = 0
+            for (zoom, x, y) in tiles:
+                removed += conn.execute('DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?', (zoom, x, y)).rowcount
+        return removed
+
+    def prune(self, generation):
+        """Drop rows of other generations and rows older than the ttl."""
+        oldest = self._oldest()
+        if oldest is None:
+            oldest = float('-inf')
+        return self._connection().execute(
+            'DELETE FROM tiles WHERE generation != ? OR stored_at < ?', (generation, oldest)).rowcount
+
+    def count(self):
+        return self._connection().execute('SELECT count(*) FROM tiles').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
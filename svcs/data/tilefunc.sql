@@ -1,6 +1,253 @@
 -- Copyright (c) Microsoft Corporation.
 -- Licensed under the MIT License.
 
+-- Features derived from more than one imposm table are precomputed into
+-- tables of their own, built aside and swapped in after each import by
+-- the soundscape_refresh_* functions, which ingest.py calls after running
+-- this file, and kept current by the triggers at the end of this file
+-- while imposm run applies diffs.
+
+-- Road intersections: vertices shared by more than one road (or twice by
+-- one closed road), with the ids of the roads meeting there in order.
+-- soundscape_tile reads them from osm_intersections rather than dumping
+-- the vertices of every road in the tile on each request.
+CREATE TABLE IF NOT EXISTS osm_intersections (
+   osm_ids bigint[] NOT NULL,
+   geometry geometry(Point, 4326) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS osm_intersections_geometry ON osm_intersections USING gist (geometry);
+
+-- oids of the imposm tables each derived table was built from; imposm
+-- replaces its tables, and so their oids, on every import
+CREATE TABLE IF NOT EXISTS soundscape_derived_sources (
+   name text PRIMARY KEY,
+   sources oid[] NOT NULL
+);
+
+-- Whether the derived table still matches its sources, which exist
+CREATE OR REPLACE FUNCTION
+   soundscape_derived_current (derived text, sources oid[])
+   RETURNS boolean
+   AS $$
+   SELECT array_position(sources, NULL) IS NOT NULL
+          OR sources = (SELECT d.sources FROM soundscape_derived_sources d WHERE d.name = derived)
+$$
+    LANGUAGE SQL
+    STABLE;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_derived_built (derived text, sources oid[])
+   RETURNS void
+   AS $$
+   INSERT INTO soundscape_derived_sources (name, sources) VALUES (derived, sources)
+       ON CONFLICT (name) DO UPDATE SET sources = EXCLUDED.sources
+$$
+    LANGUAGE SQL;
+
+-- Intersections at the given points, recomputed from osm_roads
+CREATE OR REPLACE FUNCTION
+   soundscape_intersections_at (points geometry[])
+   RETURNS TABLE(osm_ids bigint[], geometry geometry)
+   AS $$
+   SELECT array_agg(roads.osm_id ORDER BY roads.osm_id), p.point
+     FROM (SELECT DISTINCT point FROM unnest(points) AS u(point)) AS p
+     CROSS JOIN LATERAL (
+        SELECT r.osm_id, (ST_DumpPoints(r.geometry)).geom AS vertex
+          FROM osm_roads r
+         WHERE r.geometry && p.point AND r.service != 'parking_aisle'
+     ) AS roads
+    WHERE roads.vertex = p.point
+    GROUP BY p.point
+   HAVING count(*) > 1
+$$
+    LANGUAGE SQL
+    STABLE;
+
+-- Rebuilds osm_intersections unless it was built from the current
+-- osm_roads, returning the intersections written or NULL.  The new table
+-- is built and indexed aside, so tile queries only wait for the swap.
+CREATE OR REPLACE FUNCTION
+   soundscape_refresh_intersections ()
+   RETURNS bigint
+   AS $$
+   DECLARE
+      current_sources oid[] := ARRAY[to_regclass('osm_roads')];
+      written bigint;
+   BEGIN
+      IF soundscape_derived_current('osm_intersections', current_sources) THEN
+         RETURN NULL;
+      END IF;
+      DROP TABLE IF EXISTS osm_intersections_build;
+      CREATE TABLE osm_intersections_build AS
+         SELECT array_agg(osm_id ORDER BY osm_id) AS osm_ids, point::geometry(Point, 4326) AS geometry
+           FROM (SELECT osm_id, (ST_DumpPoints(geometry)).geom AS point
+                   FROM osm_roads WHERE service != 'parking_aisle') AS vertices
+          GROUP BY point
+         HAVING count(*) > 1;
+      ALTER TABLE osm_intersections_build ALTER COLUMN osm_ids SET NOT NULL, ALTER COLUMN geometry SET NOT NULL;
+      CREATE INDEX osm_intersections_build_geometry ON osm_intersections_build USING gist (geometry);
+      SELECT count(*) INTO written FROM osm_intersections_build;
+      DROP TABLE osm_intersections;
+      ALTER TABLE osm_intersections_build RENAME TO osm_intersections;
+      ALTER INDEX osm_intersections_build_geometry RENAME TO osm_intersections_geometry;
+      ANALYZE osm_intersections;
+      PERFORM soundscape_derived_built('osm_intersections', current_sources);
+      RETURN written;
+   END;
+$$
+    LANGUAGE plpgsql;
+
+-- Statement trigger on osm_roads: the intersections at every vertex of
+-- the roads a diff inserted, updated or deleted are recomputed
+CREATE OR REPLACE FUNCTION
+   soundscape_roads_changed ()
+   RETURNS trigger
+   AS $$
+   DECLARE
+      points geometry[];
+   BEGIN
+      IF TG_OP = 'INSERT' THEN
+         SELECT array_agg(v.point) INTO points
+           FROM (SELECT (ST_DumpPoints(geometry)).geom AS point FROM new_roads) AS v;
+      ELSIF TG_OP = 'DELETE' THEN
+         SELECT array_agg(v.point) INTO points
+           FROM (SELECT (ST_DumpPoints(geometry)).geom AS point FROM old_roads) AS v;
+      ELSE
+         SELECT array_agg(v.point) INTO points
+           FROM (SELECT (ST_DumpPoints(geometry)).geom AS point
+                   FROM (SELECT geometry FROM old_roads UNION ALL SELECT geometry FROM new_roads) AS r) AS v;
+      END IF;
+      IF points IS NULL THEN
+         RETURN NULL;
+      END IF;
+      DELETE FROM osm_intersections i
+       USING (SELECT DISTINCT point FROM unnest(points) AS u(point)) AS p
+       WHERE i.geometry && p.point AND i.geometry = p.point;
+      INSERT INTO osm_intersections (osm_ids, geometry)
+         SELECT * FROM soundscape_intersections_at(points);
+      RETURN NULL;
+   END;
+$$
+    LANGUAGE plpgsql;
+
+-- Building entrances: an entrance node on a vertex of a building outline,
+-- one row per (building, entrance) pair with the building's bounding box,
+-- so a tile lists a building's entrances within it exactly as joining
+-- the buildings and entrances of the tile did.
+CREATE TABLE IF NOT EXISTS osm_entrance_lists (
+   building_osm_id bigint NOT NULL,
+   entrance_osm_id bigint NOT NULL,
+   geometry geometry NOT NULL,
+   building_bbox geometry NOT NULL
+);
+CREATE INDEX IF NOT EXISTS osm_entrance_lists_geometry ON osm_entrance_lists USING gist (geometry);
+CREATE INDEX IF NOT EXISTS osm_entrance_lists_building ON osm_entrance_lists (building_osm_id);
+CREATE INDEX IF NOT EXISTS osm_entrance_lists_entrance ON osm_entrance_lists (entrance_osm_id);
+
+-- Entrance pairs of the given buildings
+CREATE OR REPLACE FUNCTION
+   soundscape_building_entrances (buildings bigint[])
+   RETURNS TABLE(building_osm_id bigint, entrance_osm_id bigint, geometry geometry, building_bbox geometry)
+   AS $$
+   SELECT b.osm_id, e.osm_id, e.geometry, b.bbox
+     FROM (SELECT p.osm_id, ST_Envelope(p.geometry) AS bbox, (ST_DumpPoints(p.geometry)).geom AS point
+             FROM osm_places p
+            WHERE p.osm_id = ANY(buildings) AND p.feature_type = 'building'
+              AND not (p.properties ? 'boundary' and p.properties ? 'historic')) AS b
+     JOIN osm_entrances e ON e.geometry && b.point AND e.geometry = b.point
+$$
+    LANGUAGE SQL
+    STABLE;
+
+-- Building pairs of the given entrances
+CREATE OR REPLACE FUNCTION
+   soundscape_entrance_buildings (entrances bigint[])
+   RETURNS TABLE(building_osm_id bigint, entrance_osm_id bigint, geometry geometry, building_bbox geometry)
+   AS $$
+   SELECT b.osm_id, e.osm_id, e.geometry, b.bbox
+     FROM osm_entrances e
+     CROSS JOIN LATERAL (
+        SELECT p.osm_id, ST_Envelope(p.geometry) AS bbox, (ST_DumpPoints(p.geometry)).geom AS point
+          FROM osm_places p
+         WHERE p.geometry && e.geometry AND p.feature_type = 'building'
+           AND not (p.properties ? 'boundary' and p.properties ? 'historic')
+     ) AS b
+    WHERE e.osm_id = ANY(entrances) AND b.point = e.geometry
+$$
+    LANGUAGE SQL
+    STABLE;
+
+-- Rebuilds osm_entrance_lists unless it was built from the current
+-- osm_places and osm_entrances, returning the pairs written or NULL
+CREATE OR REPLACE FUNCTION
+   soundscape_refresh_entrance_lists ()
+   RETURNS bigint
+   AS $$
+   DECLARE
+      current_sources oid[] := ARRAY[to_regclass('osm_places'), to_regclass('osm_entrances')];
+      written bigint;
+   BEGIN
+      IF soundscape_derived_current('osm_entrance_lists', current_sources) THEN
+         RETURN NULL;
+      END IF;
+      DROP TABLE IF EXISTS osm_entrance_lists_build;
+      CREATE TABLE osm_entrance_lists_build AS
+         SELECT b.osm_id AS building_osm_id, e.osm_id AS entrance_osm_id, e.geometry, b.bbox AS building_bbox
+           FROM (SELECT osm_id, ST_Envelope(geometry) AS bbox, (ST_DumpPoints(geometry)).geom AS point
+                   FROM osm_places
+                  WHERE feature_type = 'building' AND not (properties ? 'boundary' and properties ? 'historic')) AS b
+           JOIN osm_entrances e ON e.geometry && b.point AND e.geometry = b.point;
+      ALTER TABLE osm_entrance_lists_build
+         ALTER COLUMN building_osm_id SET NOT NULL, ALTER COLUMN entrance_osm_id SET NOT NULL,
+         ALTER COLUMN geometry SET NOT NULL, ALTER COLUMN building_bbox SET NOT NULL;
+      CREATE INDEX osm_entrance_lists_build_geometry ON osm_entrance_lists_build USING gist (geometry);
+      CREATE INDEX osm_entrance_lists_build_building ON osm_entrance_lists_build (building_osm_id);
+      CREATE INDEX osm_entrance_lists_build_entrance ON osm_entrance_lists_build (entrance_osm_id);
+      SELECT count(*) INTO written FROM osm_entrance_lists_build;
+      DROP TABLE osm_entrance_lists;
+      ALTER TABLE osm_entrance_lists_build RENAME TO osm_entrance_lists;
+      ALTER INDEX osm_entrance_lists_build_geometry RENAME TO osm_entrance_lists_geometry;
+      ALTER INDEX osm_entrance_lists_build_building RENAME TO osm_entrance_lists_building;
+      ALTER INDEX osm_entrance_lists_build_entrance RENAME TO osm_entrance_lists_entrance;
+      ANALYZE osm_entrance_lists;
+      PERFORM soundscape_derived_built('osm_entrance_lists', current_sources);
+      RETURN written;
+   END;
+$$
+    LANGUAGE plpgsql;
+
+-- Statement trigger on osm_places and osm_entrances: the pairs of every
+-- building or entrance a diff inserted, updated or deleted are recomputed
+CREATE OR REPLACE FUNCTION
+   soundscape_entrance_lists_changed ()
+   RETURNS trigger
+   AS $$
+   DECLARE
+      ids bigint[];
+   BEGIN
+      IF TG_OP = 'INSERT' THEN
+         SELECT array_agg(DISTINCT osm_id) INTO ids FROM new_rows;
+      ELSIF TG_OP = 'DELETE' THEN
+         SELECT array_agg(DISTINCT osm_id) INTO ids FROM old_rows;
+      ELSE
+         SELECT array_agg(DISTINCT osm_id) INTO ids
+           FROM (SELECT osm_id FROM old_rows UNION ALL SELECT osm_id FROM new_rows) AS r;
+      END IF;
+      IF ids IS NULL THEN
+         RETURN NULL;
+      END IF;
+      IF TG_TABLE_NAME = 'osm_places' THEN
+         DELETE FROM osm_entrance_lists WHERE building_osm_id = ANY(ids);
+         INSERT INTO osm_entrance_lists SELECT * FROM soundscape_building_entrances(ids);
+      ELSE
+         DELETE FROM osm_entrance_lists WHERE entrance_osm_id = ANY(ids);
+         INSERT INTO osm_entrance_lists SELECT * FROM soundscape_entrance_buildings(ids);
+      END IF;
+      RETURN NULL;
+   END;
+$$
+    LANGUAGE plpgsql;
+
 CREATE OR REPLACE FUNCTION
    soundscape_tile (zoom int, tile_x int, tile_y int)
    RETURNS TABLE(type text, osm_ids bigint[], feature_type varchar, feature_value varchar, geometry jsonb, properties jsonb)
@@ -11,25 +258,18 @@ CREATE OR REPLACE FUNCTION
                  SELECT osm_id as osm_id, feature_type, feature_value, geometry, properties from osm_roads where geometry && TileBBox(zoom, tile_x, tile_y, 4326) and service != 'parking_aisle' order by osm_id
                ), places as (
                  SELECT osm_id, feature_type, feature_value, geometry, properties from osm_places where geometry && TileBBox(zoom, tile_x, tile_y, 4326) and not (properties ? 'boundary' and properties ? 'historic')
-               ), entrances as (
-                 SELECT osm_id, feature_value, properties, geometry from osm_entrances where geometry && TileBBox(zoom, tile_x, tile_y, 4326)
                )
                SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties from places
                UNION
                SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geometry, properties from roads
                UNION
-               SELECT DISTINCT array_agg(osm_id) as osm_ids, 'highway' as feature_type, 'gd_intersection' as feature_value, point AS geometry, hstore('') as properties
-                 FROM ( SELECT osm_id, (ST_DumpPoints(geometry)).geom as point
-                        FROM roads
-                 ) as ps
-                 WHERE ST_Within(point, TileBBox(zoom, tile_x, tile_y, 4326))
-               GROUP BY point HAVING COUNT(osm_id) > 1
+               SELECT osm_ids, 'highway' as feature_type, 'gd_intersection' as feature_value, geometry, hstore('') as properties
+                 FROM osm_intersections WHERE ST_Within(geometry, TileBBox(zoom, tile_x, tile_y, 4326))
                UNION
-               SELECT building.osm_id || array_agg(e.osm_id) as osm_ids, 'gd_entrance_list' as feature_type, 'yes' as feature_value, ST_Collect(e.geometry) as geometry, hstore('') as properties
-                 FROM (
-                   SELECT properties, osm_id, (ST_DumpPoints(geometry)).geom as building_point from places where feature_type='building'
-                 ) as building, entrances e
-               WHERE building.building_point = e.geometry group by building.osm_id
+               SELECT building_osm_id || array_agg(entrance_osm_id ORDER BY entrance_osm_id) as osm_ids, 'gd_entrance_list' as feature_type, 'yes' as feature_value, ST_Collect(geometry ORDER BY entrance_osm_id) as geometry, hstore('') as properties
+                 FROM osm_entrance_lists
+                WHERE geometry && TileBBox(zoom, tile_x, tile_y, 4326) AND building_bbox && TileBBox(zoom, tile_x, tile_y, 4326)
+                GROUP BY building_osm_id
                UNION
                SELECT ARRAY[osm_id] as osm_ids, feature_type, feature_value, geom as geometry, properties
                  FROM non_osm_data WHERE geom && TileBBox(zoom, tile_x, tile_y, 4326)
@@ -38,3 +278,209 @@ CREATE OR REPLACE FUNCTION
 $$
     LANGUAGE SQL
     STABLE;
+
+-- The functions below render a tile as the exact text gentiles.py produces
+-- with json.dumps(tile, sort_keys=True), so the tile server can pass the
+-- FeatureCollection through without decoding rows or re-encoding JSON.
+
+-- json.dumps string escaping: to_json handles quotes, backslashes and
+-- control characters; DEL and non-ASCII become \uXXXX (surrogate pairs
+-- outside the BMP) because json.dumps defaults to ensure_ascii.
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_string (value text)
+   RETURNS text
+   AS $$
+   SELECT CASE WHEN escaped ~ '[^\x01-\x7e]' THEN (
+             SELECT string_agg(CASE
+                      WHEN ascii(c) < 127 THEN c
+                      WHEN ascii(c) < 65536 THEN '\u' || lpad(to_hex(ascii(c)), 4, '0')
+                      ELSE '\u' || to_hex(55296 + ((ascii(c) - 65536) >> 10)) || '\u' || to_hex(56320 + ((ascii(c) - 65536) & 1023))
+                    END, '' ORDER BY position)
+               FROM regexp_split_to_table(escaped, '') WITH ORDINALITY AS chars(c, position))
+          ELSE escaped END
+     FROM (SELECT to_json(value)::text AS escaped) AS e
+$$
+    LANGUAGE SQL
+    IMMUTABLE;
+
+-- psycopg2 parses jsonb numbers containing '.' as Python floats, which
+-- json.dumps writes using repr().  float8 output with extra_float_digits
+-- above zero is the same shortest round-trip form, except that repr()
+-- keeps a trailing '.0' on integral values and only switches to exponent
+-- notation at 1e16 where float8 does at 1e15.
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_number (value text)
+   RETURNS text
+   AS $$
+   SELECT CASE
+             WHEN position('.' in value) = 0 THEN value
+             -- spell out [1e15, 1e16) from the exponent form's digits
+             WHEN repr ~ 'e\+15$' THEN
+                sign || left(digits, 16) || '.' || coalesce(nullif(substr(digits, 17), ''), '0')
+             WHEN repr ~ '[.e]' THEN repr
+             ELSE repr || '.0'
+          END
+     FROM (SELECT value::float8::text AS repr) AS f,
+          LATERAL (SELECT substring(repr from '^-?') AS sign,
+                          translate(split_part(repr, 'e', 1), '-.', '')
+                          || repeat('0', 16 - length(translate(split_part(repr, 'e', 1), '-.', ''))) AS digits) AS m
+$$
+    LANGUAGE SQL
+    IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_canonical_json (value jsonb)
+   RETURNS text
+   AS $$
+   DECLARE
+      result text;
+   BEGIN
+      CASE jsonb_typeof(value)
+         WHEN 'object' THEN
+            SELECT '{' || coalesce(string_agg(soundscape_canonical_string(key) || ': ' || soundscape_canonical_json(item), ', ' ORDER BY key COLLATE "C"), '') || '}'
+              INTO result
+              FROM jsonb_each(value) AS members(key, item);
+         WHEN 'array' THEN
+            result := value::text;
+            -- Arrays of plain numbers (geometry coordinates) are already in
+            -- json.dumps form unless a number has trailing zeros, more than
+            -- 15 significant digits, or needs repr()'s exponent notation.
+            IF result ~ '["{]' OR result ~ '\.[0-9]*0([^0-9]|$)' OR result ~ '\.[0-9]{7}'
+               OR result ~ '[0-9]{10}\.' OR result ~ '(^|[^0-9])0\.0000' THEN
+               SELECT '[' || coalesce(string_agg(soundscape_canonical_json(item), ', ' ORDER BY position), '') || ']'
+                 INTO result
+                 FROM jsonb_array_elements(value) WITH ORDINALITY AS elements(item, position);
+            END IF;
+         WHEN 'string' THEN
+            result := soundscape_canonical_string(value #>> '{}');
+         WHEN 'number' THEN
+            result := soundscape_canonical_number(value::text);
+         ELSE
+            result := value::text;
+      END CASE;
+      RETURN result;
+   END;
+$$
+    LANGUAGE plpgsql
+    IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION
+   soundscape_tile_json (zoom int, tile_x int, tile_y int)
+   RETURNS text
+   AS $$
+   SELECT '{"features": [' || coalesce(string_agg(
+             '{"feature_type": ' || coalesce(soundscape_canonical_string(feature_type), 'null')
+             || ', "feature_value": ' || coalesce(soundscape_canonical_string(feature_value), 'null')
+             || ', "geometry": ' || coalesce(soundscape_canonical_json(geometry), 'null')
+             || ', "osm_ids": ' || coalesce(soundscape_canonical_json(to_jsonb(osm_ids)), 'null')
+             || ', "properties": ' || coalesce(soundscape_canonical_json(properties), 'null')
+             || ', "type": ' || coalesce(soundscape_canonical_string(type), 'null') || '}',
+             ', ' ORDER BY position), '') || '], "type": "FeatureCollection"}'
+     FROM soundscape_tile(zoom, tile_x, tile_y) WITH ORDINALITY
+          AS features(type, osm_ids, feature_type, feature_value, geometry, properties, position)
+$$
+    LANGUAGE SQL
+    STABLE
+    SET extra_float_digits = 1;
+
+-- Tiles rendered ahead of time by ingest.py --render-tiles, bodies exactly
+-- as soundscape_tile_json renders them, and compressed forms and etags as
+-- gentiles.py computes them, NULL where compressing does not pay; a tile
+-- is served without hashing or compressing it again.  generation is the
+-- oid of the osm_roads table a tile was rendered from, the data generation
+-- gentiles.py tracks, so once an import rotates new tables into production
+-- the rows of the old ones are no longer served, and the render of the new
+-- ones is swapped in as a whole.
+CREATE TABLE IF NOT EXISTS soundscape_tiles (
+   z int NOT NULL,
+   x int NOT NULL,
+   y int NOT NULL,
+   body bytea NOT NULL,
+   gzip bytea,
+   brotli bytea,
+   etag text NOT NULL,
+   generation bigint NOT NULL,
+   PRIMARY KEY (z, x, y)
+);
+ALTER TABLE soundscape_tiles ADD COLUMN IF NOT EXISTS gzip bytea, ADD COLUMN IF NOT EXISTS brotli bytea;
+
+-- The data generation tiles are cached, stored and rendered under: the
+-- oid of osm_roads once the derived tables have been rebuilt from the
+-- tables an import rotated into production, and 0 until then, so tiles
+-- served in between are not kept as those of the new tables
+CREATE OR REPLACE FUNCTION
+   soundscape_tile_generation ()
+   RETURNS bigint
+   AS $$
+   SELECT CASE WHEN soundscape_derived_current('osm_intersections', ARRAY[to_regclass('osm_roads')::oid])
+                    AND soundscape_derived_current('osm_entrance_lists',
+                                                   ARRAY[to_regclass('osm_places')::oid, to_regclass('osm_entrances')::oid])
+               THEN coalesce(to_regclass('osm_roads')::oid::bigint, 0)
+               ELSE 0 END
+$$
+    LANGUAGE SQL
+    STABLE;
+
+-- soundscape_tile_materialized used to return the body alone.  A return
+-- type cannot be replaced, so that version is dropped, once; the current
+-- one is left in place for the tile servers using it.
+DO $$
+BEGIN
+   IF (SELECT prorettype FROM pg_proc
+        WHERE oid = to_regprocedure('soundscape_tile_materialized(int, int, int)')) = 'bytea'::regtype THEN
+      DROP FUNCTION soundscape_tile_materialized (int, int, int);
+   END IF;
+END
+$$;
+
+-- The rendered tile, or no row when it was not rendered from the tables
+-- in production
+CREATE OR REPLACE FUNCTION
+   soundscape_tile_materialized (zoom int, tile_x int, tile_y int)
+   RETURNS TABLE(body bytea, gzip bytea, brotli bytea, etag text)
+   AS $$
+   SELECT t.body, t.gzip, t.brotli, t.etag FROM soundscape_tiles t
+    WHERE t.z = zoom AND t.x = tile_x AND t.y = tile_y
+      AND t.generation = soundscape_tile_generation()
+$$
+    LANGUAGE SQL
+    STABLE;
+
+-- imposm creates its tables anew on every import, so the triggers are
+-- installed again each time this file is run
+DROP TRIGGER IF EXISTS soundscape_roads_inserted ON osm_roads;
+CREATE TRIGGER soundscape_roads_inserted AFTER INSERT ON osm_roads
+   REFERENCING NEW TABLE AS new_roads
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_roads_changed();
+DROP TRIGGER IF EXISTS soundscape_roads_updated ON osm_roads;
+CREATE TRIGGER soundscape_roads_updated AFTER UPDATE ON osm_roads
+   REFERENCING OLD TABLE AS old_roads NEW TABLE AS new_roads
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_roads_changed();
+DROP TRIGGER IF EXISTS soundscape_roads_deleted ON osm_roads;
+CREATE TRIGGER soundscape_roads_deleted AFTER DELETE ON osm_roads
+   REFERENCING OLD TABLE AS old_roads
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_roads_changed();
+DROP TRIGGER IF EXISTS soundscape_places_inserted ON osm_places;
+CREATE TRIGGER soundscape_places_inserted AFTER INSERT ON osm_places
+   REFERENCING NEW TABLE AS new_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
+DROP TRIGGER IF EXISTS soundscape_places_updated ON osm_places;
+CREATE TRIGGER soundscape_places_updated AFTER UPDATE ON osm_places
+   REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
+DROP TRIGGER IF EXISTS soundscape_places_deleted ON osm_places;
+CREATE TRIGGER soundscape_places_deleted AFTER DELETE ON osm_places
+   REFERENCING OLD TABLE AS old_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
+DROP TRIGGER IF EXISTS soundscape_entrances_inserted ON osm_entrances;
+CREATE TRIGGER soundscape_entrances_inserted AFTER INSERT ON osm_entrances
+   REFERENCING NEW TABLE AS new_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
+DROP TRIGGER IF EXISTS soundscape_entrances_updated ON osm_entrances;
+CREATE TRIGGER soundscape_entrances_updated AFTER UPDATE ON osm_entrances
+   REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
+DROP TRIGGER IF EXISTS soundscape_entrances_deleted ON osm_entrances;
+CREATE TRIGGER soundscape_entrances_deleted AFTER DELETE ON osm_entrances
+   REFERENCING OLD TABLE AS old_rows
+   FOR EACH STATEMENT EXECUTE FUNCTION soundscape_entrance_lists_changed();
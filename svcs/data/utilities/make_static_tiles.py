@@ -4,7 +4,6 @@ enumerate_tiles.py), and generates z/x/y.json tile files to the specified
 output directory.
 """
 import argparse
-import json
 from pathlib import Path
 import sys
 
@@ -13,26 +12,29 @@ from psycopg2.extras import NamedTupleCursor
 
 import bz2
 
+# share the tile server's serializer so static and served tiles are identical
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import canonical_json
+
 tile_query = """
     SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
 """
 
-def tile(cursor, x, y, zoom):
+def tile(cursor, x, y, zoom, serializer=canonical_json.serializer_default):
     cursor.execute(tile_query, {'zoom': int(zoom), 'tile_x': x, 'tile_y': y})
     value = cursor.fetchall()
-    obj = {
-        'type': 'FeatureCollection',
-        'features': list(map(lambda x: x._asdict(), value))
-    }
-    if len(obj["features"]) == 0:
+    features = list(map(lambda x: x._asdict(), value))
+    if len(features) == 0:
         return None
-    return json.dumps(obj, sort_keys=True)
+    return canonical_json.serializers[serializer](features)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("output_dir", type=Path)
     parser.add_argument("postgres_dsn", type=str)
+    parser.add_argument("--serializer", choices=list(canonical_json.serializers),
+                        default=canonical_json.serializer_default)
     args = parser.parse_args()
 
     conn = psycopg2.connect(args.postgres_dsn)
@@ -47,7 +49,7 @@ if __name__ == "__main__":
         tile_path = tile_dir / f"{y}.json.bz2"
         if tile_path.exists():
             continue
-        output = tile(cursor, x, y, z)
+        output = tile(cursor, x, y, z, args.serializer)
         if output:
             tile_dir.mkdir(parents=True, exist_ok=True)
             nonempty_tiles += 1
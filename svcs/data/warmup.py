@@ -0,0 +1,104 @@
+# Copyright (c) Soundscape Community Contributors.
+# Licensed under the MIT License.
+#
+# Cache warm-up from tiles clients asked for before.
+#
+# The input is either an access log in the tiles.log.json format the tile
+# server writes and utilities/visualize_tiles_map.py reads, one JSON
+# object with a "uri" per request, or a ranked list with one z/x/y per
+# line, hottest first (anything after the tile on a line, such as a
+# count, is ignored, as are blank lines and # comments).  Access logs are
+# ranked by how often each tile was requested.
+#
+
+import asyncio
+import json
+import re
+from collections import Counter
+
+TILE_URI = re.compile(r'^/(?:tiles/)?(\d+)/(\d+)/(\d+)\.json(?:\?|$)')
+TILE_NAME = re.compile(r'^(\d+)/(\d+)/(\d+)(?:\.json)?$')
+
+
+def tile_from_uri(uri):
+    match = TILE_URI.match(uri)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.groups())
+
+
+def read_access_log(lines):
+    counts = Counter()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            tile = tile_from_uri(json.loads(line)['uri'])
+        except (ValueError, KeyError, TypeError):
+            continue
+        if tile is not None:
+            counts[tile] += 1
+    # most requested first, ties in the order first requested
+    return [tile for (tile, _) in counts.most_common()]
+
+
+def read_ranked_list(lines):
+    tiles = []
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        match = TILE_NAME.match(fields[0].strip('/'))
+        if match is not None:
+            tiles.append(tuple(int(part) for part in match.groups()))
+    return tiles
+
+
+def read_hot_tiles(path):
+    """Tiles named by an access log or ranked list, hottest first."""
+    with open(path, encoding='utf8') as f:
+        lines = f.read().splitlines()
+    first = next((line for line in lines if line.strip()), '')
+    if first.lstrip().startswith('{'):
+        return read_access_log(lines)
+    return read_ranked_list(lines)
+
+
+class WarmUp(object):
+    def __init__(self, ready_fraction=1.0):
+        self.ready_fraction = ready_fraction
+        self.tiles = None
+        self.done = 0
+        self.failed = 0
+        self.finished = False
+
+    @property
+    def ready(self):
+        if self.finished:
+            return True
+        if self.tiles is None:
+            return False
+        # failed tiles count as done: a tile that cannot be generated
+        # must not keep the instance out of service
+        return self.done >= self.ready_fraction * len(self.tiles)
+
+    async def run(self, tiles, fetch, concurrency):
+        """Await fetch(tile) for every tile, concurrency at a time, in rank
+        order.  fetch returning None or raising counts as a failure."""
+        self.tiles = tiles
+        remaining = iter(tiles)
+
+        async def worker():
+            for tile in remaining:
+                try:
+                    if await fetch(tile) is None:
+                        self.failed += 1
+                except Exception:
+                    self.failed += 1
+                self.done += 1
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+        finally:
+            self.finished = True